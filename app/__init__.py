@@ -2,26 +2,38 @@ from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_pagedown import PageDown
 from flask_ckeditor import CKEditor
 from config import config
+from .last_seen import LastSeenBuffer
+from .rendering import render_cache
+from .cache import TTLCache
+from .page_cache import page_cache
+from .profiler import query_profiler
+from .metrics import metrics
+from .routing import RoutingSQLAlchemy
+from .assets import assets
 
 bootstrap = Bootstrap()
 mail = Mail()
 moment = Moment()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 pagedown = PageDown()
 ckeditor = CKEditor()
 login_manager = LoginManager()
+last_seen_buffer = LastSeenBuffer()
+token_cache = TTLCache('FLASKY_TOKEN_CACHE')
+user_cache = TTLCache('FLASKY_USER_CACHE')
 login_manager.login_view = 'auth.login'
 
 
-def create_app(config_name):
+def create_app(config_name, replicas = None):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
+    if replicas is not None:
+        app.config['FLASKY_DB_REPLICAS'] = list(replicas)
 
     bootstrap.init_app(app)
     mail.init_app(app)
@@ -30,6 +42,20 @@ def create_app(config_name):
     login_manager.init_app(app)
     pagedown.init_app(app)
     ckeditor.init_app(app)
+    last_seen_buffer.init_app(app)
+    render_cache.init_app(app)
+    token_cache.init_app(app)
+    user_cache.init_app(app)
+    page_cache.init_app(app)
+    query_profiler.init_app(app)
+    metrics.init_app(app)
+    assets.init_app(app)
+
+    from .email import email_queue
+    email_queue.init_app(app)
+    from .purge import purge_worker
+    purge_worker.init_app(app)
+    from . import search
     
     if app.config['SSL_REDIRECT']:
         from flask_sslify import SSLify
@@ -4,7 +4,7 @@
 from flask import g, jsonify
 from flask_httpauth import HTTPBasicAuth
 from ..models import User, AnonymousUser
-from .errors import forbidden
+from .errors import forbidden, unauthorized
 from . import api
 
 auth = HTTPBasicAuth()
@@ -14,6 +14,17 @@ auth = HTTPBasicAuth()
 def before_request():
     if not g.current_user.is_anonymous and not g.current_user.confirmed:
         return forbidden('未确认的账户')
+    # API clients rarely keep the session cookie that makes browsers read
+    # their own writes, so the marker is kept with the user instead
+    if not g.current_user.is_anonymous and g.current_user.wrote_recently():
+        g.db_primary = True
+
+@api.after_request
+def after_request(response):
+    user = g.get('current_user')
+    if g.get('db_wrote', False) and user is not None and not user.is_anonymous:
+        user.record_write()
+    return response
 
 @auth.verify_password
 def verify_password(email_or_token, password):
@@ -23,7 +34,7 @@ def verify_password(email_or_token, password):
     if password == '':
         g.current_user = User.verify_auth_token(email_or_token)
         g.token_used = True
-        return g.current_user is not None
+        return g.current_user is not None and not g.current_user.disabled
     user = User.query.filter_by(email = email_or_token).first()
     if not user:
         return False
@@ -1,17 +1,18 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-from flask import jsonify, request, g, url_for, current_app
+from flask import jsonify, request, g, url_for, current_app, abort
 from .. import db
 from ..models import Post, Permission, Comment
 from . import api
-from .decorators import permission_required
+from .decorators import permission_required, conditional, collection_state, row_state
 
 
 @api.route('/comments/')
+@conditional(lambda: collection_state(Comment.query, Comment))
 def get_comments():
     page = request.args.get('page', 1, type = int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+    pagination = Comment.query.filter(Comment.visible()).order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
     comments = pagination.items
     prev = None
     if pagination.has_prev:
@@ -28,15 +29,19 @@ def get_comments():
 
 
 @api.route('/comments/<int:id>')
+@conditional(lambda id: row_state(Comment.query.filter_by(id = id), Comment.updated_at))
 def get_comment(id):
     comment = Comment.query.get_or_404(id)
+    if comment.deleted:
+        abort(404)
     return jsonify(comment.to_json())
 
 @api.route('/posts/<int:id>/comments')
+@conditional(lambda id: collection_state(Comment.query.filter_by(post_id = id), Comment))
 def get_post_comments(id):
     post = Post.query.get_or_404(id)
     page = request.args.get('page', 1, type = int)
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+    pagination = post.comments.filter(Comment.visible()).order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
     comments = pagination.items
     prev = None
     if pagination.has_prev:
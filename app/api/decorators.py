@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import hashlib
 from functools import wraps
-from flask import g
+from flask import g, request, current_app, make_response
+from .. import db
+from ..models import TableVersion
 from .errors import forbidden
 
 def permission_required(permission):
@@ -15,4 +18,50 @@ def permission_required(permission):
         return decorated_function
     return decorator
 
+def conditional(state):
+    '''Answer If-None-Match / If-Modified-Since with 304 before the view runs.
 
+    ``state`` takes the view's arguments and returns ``(validators,
+    last_modified)``: a cheap tuple that changes whenever the response body
+    would, and the time of the newest change or None. The strong ETag is a
+    hash of the URL and the validators.
+    '''
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            validators, last_modified = state(*args, **kwargs)
+            etag = hashlib.sha1(repr((request.full_path, current_app.config['FLASKY_POSTS_PER_PAGE'],
+                                      current_app.config['FLASKY_COMMENTS_PER_PAGE'])
+                                     + tuple(validators)).encode('utf-8')).hexdigest()
+            if request.if_none_match:
+                fresh = request.if_none_match.contains(etag)
+            else:
+                fresh = (last_modified is not None and request.if_modified_since is not None
+                         and last_modified.replace(microsecond = 0) <= request.if_modified_since)
+            if fresh:
+                response = current_app.response_class(status = 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            if response.status_code in (200, 304):
+                response.set_etag(etag)
+                if last_modified is not None:
+                    response.last_modified = last_modified
+            return response
+        return decorated_function
+    return decorator
+
+def collection_state(query, model):
+    '''``conditional`` state for a list: the highest id catches inserts, the
+    newest ``updated_at`` edits and soft deletes, and the table's
+    ``TableVersion`` hard deletes. Both aggregates are read off an index.'''
+    last_id, newest = query.with_entities(db.func.max(model.id), db.func.max(model.updated_at)) \
+            .order_by(None).first()
+    version, deleted_at = TableVersion.get(model.__tablename__)
+    changes = [stamp for stamp in (newest, deleted_at) if stamp is not None]
+    return (last_id, newest, version), max(changes) if changes else None
+
+def row_state(query, updated_at):
+    '''``conditional`` state for a single row.'''
+    row = query.with_entities(updated_at).first()
+    newest = row[0] if row is not None else None
+    return (newest, ), newest
@@ -1,17 +1,25 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-from flask import jsonify, request, g, url_for, current_app
-from .. import db
+from flask import jsonify, request, g, url_for, current_app, abort
+from .. import db, timeline
 from ..models import Post, Permission
+from ..pagination import keyset_paginate, cursor_links
 from . import api
-from .decorators import permission_required
+from .decorators import permission_required, conditional, collection_state, row_state
 from .errors import forbidden
 
 @api.route('/posts/')
+@conditional(lambda: collection_state(Post.query, Post))
 def get_posts():
+    per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    if 'page' not in request.args:
+        pagination = keyset_paginate(Post.query.filter(Post.visible()), Post, request.args.get('cursor'), per_page = per_page)
+        json_posts = {'posts': [post.to_json() for post in pagination.items]}
+        json_posts.update(cursor_links(pagination, 'api.get_posts'))
+        return jsonify(json_posts)
     page = request.args.get('page', 1, type = int)
-    pagination = Post.query.paginate(page, per_page = current_app.config['FLASKY_POSTS_PER_PAGE'], error_out =False)
+    pagination = Post.query.filter(Post.visible()).order_by(Post.timestamp.desc()).paginate(page, per_page = per_page, error_out =False)
     posts = pagination.items
     prev = None
     if pagination.has_prev:
@@ -27,8 +35,11 @@ def get_posts():
         })
 
 @api.route('/posts/<int:id>')
+@conditional(lambda id: row_state(Post.query.filter_by(id = id), Post.updated_at))
 def get_post(id):
-    psot = Post.query.get_or_404(id)
+    post = Post.query.get_or_404(id)
+    if post.deleted:
+        abort(404)
     return jsonify(post.to_json())
 
 @api.route('/posts/', methods = ['POST'])
@@ -37,6 +48,8 @@ def new_post():
     post = Post.from_json(request.json)
     post.author = g.current_user
     db.session.add(post)
+    db.session.flush()
+    timeline.push_post(post)
     db.session.commit()
     return jsonify(post.to_json()), 201, {'Location': url_for('api.get_post', id = post.id)}
 
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from flask import jsonify, request, url_for, current_app
+from .. import search as search_index
+from . import api
+from .errors import bad_request
+
+
+@api.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('missing q')
+    results = search_index.search(q, request.args.get('cursor'),
+                                  per_page = current_app.config['FLASKY_SEARCH_PER_PAGE'])
+    next = None
+    if results.has_next:
+        next = url_for('api.search', q = q, cursor = results.next_cursor, _external = True)
+    return jsonify({
+        'results': [{'type': search_index.doc_type(item), 'score': score, 'item': item.to_json()}
+                    for score, item in results.items],
+        'next': next,
+        'next_cursor': results.next_cursor
+        })
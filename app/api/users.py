@@ -3,27 +3,41 @@
 
 from flask import jsonify, request, current_app, url_for
 from . import api
-from ..models import User, Post
+from .. import timeline
+from .. import db
+from ..models import User, Post, UserCounters
+from ..pagination import cursor_links
+from .decorators import conditional, collection_state
+
+
+def user_state(id):
+    # everything User.to_json shows; last_seen is not a modification time,
+    # so there is no Last-Modified
+    row = db.session.query(User.username, User.member_since, User.last_seen, UserCounters.posts) \
+            .outerjoin(UserCounters, UserCounters.user_id == User.id).filter(User.id == id).first()
+    return tuple(row or ()), None
 
 @api.route('/users/<int:id>')
+@conditional(user_state)
 def get_user(id):
     user = User.query.get_or_404(id)
     return jsonify(user.to_json())
 
 @api.route('/users/<int:id>/posts')
+@conditional(lambda id: collection_state(Post.query.filter_by(author_id = id), Post))
 def get_user_posts(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type = int)
-    Pagination = user.posts.order_by(Post.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_POSTS_PER_PAGE'], error_out = False)
-    posts = Pagination.items
+    pagination = user.posts.filter(Post.visible()).order_by(Post.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_POSTS_PER_PAGE'], error_out = False)
+    posts = pagination.items
     prev = None
     if pagination.has_prev:
         prev = url_for('api.get_user_posts', id = id, page = page - 1)
     next = None
     if pagination.has_next:
-        next - url_for('api.get_user_posts', id = id,page = page + 1)
+        next = url_for('api.get_user_posts', id = id, page = page + 1)
     return jsonify({
-        'posts': [posts.to_json() for post in posts],
+        'posts': [post.to_json() for post in posts],
         'prev': prev,
         'next': next,
         'count': pagination.total
@@ -32,8 +46,15 @@ def get_user_posts(id):
 @api.route('/users/<int:id>/timeline/')
 def get_user_followed_posts(id):
     user = User.query.get_or_404(id)
+    per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    if 'page' not in request.args:
+        pagination = timeline.timeline_paginate(user, request.args.get('cursor'), per_page = per_page)
+        json_posts = {'posts': [post.to_json() for post in pagination.items]}
+        json_posts.update(cursor_links(pagination, 'api.get_user_followed_posts', id = id))
+        return jsonify(json_posts)
     page = request.args.get('page', 1, type = int)
-    pagination = user.get_user_followed_posts.order_by(Post.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_POSTS_PER_PAGE'], error_out = False)
+    pagination = user.followed_posts.filter(Post.visible()).order_by(Post.timestamp.desc()).paginate(page, per_page = per_page, error_out = False)
+    posts = pagination.items
     prev = None
     if pagination.has_prev:
         prev = url_for('api.get_user_followed_posts', id = id, page = page - 1)
@@ -46,3 +67,11 @@ def get_user_followed_posts(id):
         'next': next,
         'count': pagination.total
         })
+
+@api.route('/users/<int:id>/recommendations')
+def get_user_recommendations(id):
+    user = User.query.get_or_404(id)
+    limit = min(request.args.get('limit', 5, type = int), current_app.config['FLASKY_RECOMMEND_COUNT'])
+    return jsonify({
+        'recommendations': [candidate.to_json() for candidate in user.recommended(max(limit, 0))]
+        })
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import posixpath
+from flask import request, send_file, current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# already compressed formats are not worth a variant
+COMPRESSIBLE = ('.css', '.js', '.map', '.svg', '.ico', '.html', '.txt', '.json', '.xml', '.eot', '.ttf', '.otf')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok = True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def gzipped(data):
+    out = io.BytesIO()
+    # mtime 0 keeps rebuilds of the same file byte-identical
+    with gzip.GzipFile(fileobj = out, mode = 'wb', compresslevel = 9, mtime = 0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class StaticAssets(object):
+    '''Fingerprinted, precompressed copies of the static files.
+
+    ``build()`` (``manage.py build_static``) copies the app's static folder
+    and those of the blueprints in FLASKY_STATIC_BLUEPRINTS into
+    FLASKY_STATIC_BUILD_DIR as ``name.<hash>.ext``, next to ``.gz`` and,
+    when the brotli package is installed, ``.br`` variants, and records
+    them in ``manifest.json``. Once a manifest exists, ``url_for`` on those
+    static endpoints returns the fingerprinted names, which the same routes
+    serve with the best variant the client accepts and one-year immutable
+    caching. Names not in the manifest are served as before. Old builds
+    are left in place for pages rendered before a deploy.
+
+    The manifest is kept per application in ``app.extensions``, so several
+    apps in one process each serve their own build.
+    '''
+
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_STATIC_BUILD_DIR', os.path.join(app.root_path, 'static-build'))
+        app.config.setdefault('FLASKY_STATIC_BLUEPRINTS', ())
+        app.config.setdefault('FLASKY_STATIC_MAX_AGE', 365 * 24 * 3600)
+        app.config.setdefault('FLASKY_STATIC_COMPRESS_MIN_SIZE', 256)
+        self.load(app)
+        for endpoint, folder in self.sources(app):
+            app.view_functions[endpoint] = self.view(endpoint, app.view_functions[endpoint])
+        app.url_defaults(self.url_defaults)
+
+    def sources(self, app):
+        '''(endpoint, folder) of every static folder the pipeline handles.'''
+        if app.static_folder:
+            yield 'static', app.static_folder
+        for name in app.config['FLASKY_STATIC_BLUEPRINTS']:
+            blueprint = app.blueprints.get(name)
+            if blueprint is not None and blueprint.has_static_folder:
+                yield name + '.static', blueprint.static_folder
+
+    def load(self, app = None):
+        app = app or current_app
+        path = os.path.join(app.config['FLASKY_STATIC_BUILD_DIR'], 'manifest.json')
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            manifest = {}
+        app.extensions['static_assets'] = {
+                'manifest': dict((endpoint, dict((name, entry['path']) for name, entry in files.items()))
+                                 for endpoint, files in manifest.items()),
+                'built': dict((endpoint, dict((entry['path'], entry['encodings']) for entry in files.values()))
+                              for endpoint, files in manifest.items())
+                }
+
+    def state(self):
+        return current_app.extensions['static_assets']
+
+    def url_defaults(self, endpoint, values):
+        names = self.state()['manifest'].get(endpoint)
+        if names and 'filename' in values:
+            values['filename'] = names.get(values['filename'], values['filename'])
+
+    def view(self, endpoint, fallback):
+        def serve(filename):
+            encodings = self.state()['built'].get(endpoint, {}).get(filename)
+            if encodings is None:
+                return fallback(filename)
+            path = os.path.join(current_app.config['FLASKY_STATIC_BUILD_DIR'], endpoint, *filename.split('/'))
+            encoding = None
+            for name, suffix in ENCODINGS:
+                if name in encodings and request.accept_encodings[name]:
+                    encoding, path = name, path + suffix
+                    break
+            max_age = current_app.config['FLASKY_STATIC_MAX_AGE']
+            response = send_file(path, mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                 conditional = True, cache_timeout = max_age)
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+            response.headers['Vary'] = 'Accept-Encoding'
+            response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+            return response
+        return serve
+
+    def build(self, report = print):
+        '''Write fingerprinted and compressed files and a new manifest;
+        returns the number of source files.'''
+        app = current_app._get_current_object()
+        config = app.config
+        out = config['FLASKY_STATIC_BUILD_DIR']
+        manifest = {}
+        for endpoint, folder in self.sources(app):
+            files = manifest[endpoint] = {}
+            for root, dirs, names in os.walk(folder):
+                dirs.sort()
+                for name in sorted(names):
+                    source = os.path.join(root, name)
+                    with open(source, 'rb') as f:
+                        data = f.read()
+                    filename = os.path.relpath(source, folder).replace(os.sep, '/')
+                    base, ext = posixpath.splitext(filename)
+                    fingerprinted = '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], ext)
+                    target = os.path.join(out, endpoint, *fingerprinted.split('/'))
+                    write(target, data)
+                    variants = []
+                    if ext.lower() in COMPRESSIBLE and len(data) >= config['FLASKY_STATIC_COMPRESS_MIN_SIZE']:
+                        if brotli is not None:
+                            variants.append(('br', brotli.compress(data, quality = 11)))
+                        variants.append(('gzip', gzipped(data)))
+                    encodings = []
+                    for encoding, compressed in variants:
+                        if len(compressed) < len(data):
+                            write(target + dict(ENCODINGS)[encoding], compressed)
+                            encodings.append(encoding)
+                    files[filename] = {'path': fingerprinted, 'encodings': encodings}
+            report('%s: %d files' % (endpoint, len(files)))
+        write(os.path.join(out, 'manifest.json'), json.dumps(manifest, indent = 1, sort_keys = True).encode('utf-8'))
+        self.load(app)
+        return sum(len(files) for files in manifest.values())
+
+
+assets = StaticAssets()
@@ -4,9 +4,9 @@ from flask_login import login_user, logout_user, login_required, \
 from . import auth
 from .. import db
 from ..models import User
+from ..decorators import primary_required
 from ..email import send_email
 from .forms import LoginForm, RegistrationForm, ChangePasswordForm, ResetPasswordForm, ResetPasswordRequestForm, ChangeEmailForm
-import hashlib
 
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
@@ -16,7 +16,7 @@ def login():
         if user is not None and user.verify_password(form.password.data):
             if user.disabled:
                 flash('你的账户已经被禁用,请联系管理员解禁.')
-                return render_template('auth/login.html' form = form)
+                return render_template('auth/login.html', form = form)
             login_user(user, form.remember_me.data)
             next = request.args.get('next')
             if next is None or not next.startswith('/'):
@@ -41,7 +41,6 @@ def register():
         user = User(email=form.email.data,
                     username=form.username.data,
                     password=form.password.data)
-        user.avatar_hash = hashlib.md5(user.email.encode('utf-8')).hexdigest()
         db.session.add(user)
         db.session.commit()
         token = user.generate_confirmation_token()
@@ -53,6 +52,7 @@ def register():
 
 @auth.route('/confirm/<token>')
 @login_required
+@primary_required
 def confirm(token):
     if current_user.confirmed:
         return redirect(url_for('main.index'))
@@ -151,6 +151,7 @@ def change_email_request():
 
 @auth.route('/change-email/<token>')
 @login_required
+@primary_required
 def change_email(token):
     if current_user.change_email(token):
         db.session.commit()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import hashlib
+import io
+import os
+import struct
+import zlib
+from flask import current_app
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# part of every cached path and ETag: bump it when the drawing changes
+VERSION = 1
+BACKGROUND = (240, 240, 240)
+
+
+def png(width, height, rows):
+    '''Encode 8-bit RGB ``rows`` (bytes of ``3 * width``) as a PNG.'''
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + row for row in rows)
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+                     chunk(b'IDAT', zlib.compress(raw, 9)),
+                     chunk(b'IEND', b'')])
+
+
+def identicon(hash, size):
+    '''A symmetric 5x5 pattern in a colour taken from ``hash``, as a PNG.
+
+    The first 15 bits pick the cells of the left three columns, which are
+    mirrored to the right; the last bytes give the colour.
+    '''
+    digest = bytearray(bytes.fromhex(hash))
+    bits = int.from_bytes(bytes(digest[:2]), 'big')
+    cells = [[bits >> (row * 3 + min(col, 4 - col)) & 1 for col in range(5)] for row in range(5)]
+    color = bytes([digest[-3] // 2 + 64, digest[-2] // 2 + 64, digest[-1] // 2 + 64])
+    background = bytes(BACKGROUND)
+    width = max(1, size // 6)
+    pad = (size - 5 * width) // 2
+
+    def cell(position):
+        return (position - pad) // width if pad <= position < pad + 5 * width else None
+
+    columns = [cell(x) for x in range(size)]
+    blank = background * size
+    lines = [b''.join(color if col is not None and cells[row][col] else background for col in columns)
+             for row in range(5)]
+    return png(size, size, [blank if cell(y) is None else lines[cell(y)] for y in range(size)])
+
+
+def uploads_enabled():
+    return Image is not None and current_app.config['FLASKY_AVATAR_UPLOADS']
+
+
+def upload_path(hash):
+    return os.path.join(current_app.config['FLASKY_AVATAR_DIR'], 'uploads', hash[:2], hash + '.png')
+
+
+def cache_path(hash, size):
+    return os.path.join(current_app.config['FLASKY_AVATAR_DIR'], 'v%d' % VERSION, hash[:2], hash, '%d.png' % size)
+
+
+def write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok = True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def resize(path, size):
+    image = Image.open(path).convert('RGB')
+    image = image.resize((size, size), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, 'PNG', optimize = True)
+    return out.getvalue()
+
+
+def belongs_to_user(hash):
+    from .models import User
+    return User.query.filter_by(avatar_hash = hash).first() is not None
+
+
+def avatar(hash, size):
+    '''PNG bytes of the avatar ``hash`` at ``size`` pixels, from the disk
+    cache when it was rendered before.
+
+    ``hash`` names an uploaded image if one is stored under it, and seeds
+    an identicon otherwise. Paths are derived from the hash alone, so
+    entries never go stale and any worker can fill them. Only uploads and
+    users' own hashes are written to disk; identicons for any other hash
+    are drawn on every request, so random URLs cannot fill the cache.
+    '''
+    path = cache_path(hash, size)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        pass
+    upload = upload_path(hash)
+    if Image is not None and os.path.exists(upload):
+        data = resize(upload, size)
+    else:
+        data = identicon(hash, size)
+        if not belongs_to_user(hash):
+            return data
+    write(path, data)
+    return data
+
+
+def save_upload(stream):
+    '''Store an uploaded image as a square PNG and return its content hash.
+
+    Raises ValueError if Pillow cannot read it.
+    '''
+    try:
+        image = Image.open(stream)
+        image.load()
+    except Exception:
+        raise ValueError('not an image')
+    image = image.convert('RGB')
+    side = min(image.size)
+    left, top = (image.size[0] - side) // 2, (image.size[1] - side) // 2
+    image = image.crop((left, top, left + side, top + side))
+    limit = max(current_app.config['FLASKY_AVATAR_SIZES'])
+    if side > limit:
+        image = image.resize((limit, limit), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, 'PNG', optimize = True)
+    data = out.getvalue()
+    hash = hashlib.md5(data).hexdigest()
+    path = upload_path(hash)
+    if not os.path.exists(path):
+        write(path, data)
+    return hash
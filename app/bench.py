@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import json
+import math
+import platform
+import time
+import tracemalloc
+from base64 import b64encode
+from sqlalchemy import event
+from . import create_app, db, timeline, search
+from .fake import Generator
+from .models import Role, User, Post, Comment, Follow, UserCounters
+
+
+class Endpoint(object):
+    '''One request to measure. ``auth`` is None for an anonymous request,
+    ``'session'`` for a logged-in browser, ``'token'`` or ``'password'`` for
+    the API.'''
+
+    def __init__(self, name, url, method = 'GET', auth = None, json = None, status = 200, cookies = None):
+        self.name = name
+        self.url = url
+        self.method = method
+        self.auth = auth
+        self.json = json
+        self.status = status
+        self.cookies = cookies or {}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p * len(values))) - 1)]
+
+
+class Bench(object):
+    '''Seeds a reproducible dataset into a scratch database and measures the
+    hot endpoints through the test client.
+
+    For each endpoint it records p50/p99 latency over ``requests`` runs after
+    ``warmup`` runs, the SQL statements of one request and the peak Python
+    memory allocated while serving one request, traced separately so
+    tracemalloc does not slow down the timed runs. The database is dropped
+    and recreated, so never point it at real data.
+    '''
+
+    def __init__(self, database = 'sqlite://', users = 500, posts = 5000, comments = 10000,
+                 requests = 50, warmup = 5, seed = 1, report = print):
+        self.database = database
+        self.sizes = {'users': users, 'posts': posts, 'comments': comments}
+        self.requests = requests
+        self.warmup = warmup
+        self.seed = seed
+        self.report = report
+        self.statements = 0
+
+    def setup(self):
+        self.app = create_app('bench')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = self.database
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        event.listen(db.engine, 'before_cursor_execute', self.count_statement)
+
+    def teardown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count_statement)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_statement(self, *args):
+        self.statements += 1
+
+    def seed_data(self):
+        started = time.time()
+        Role.insert_roles()
+        Generator(seed = self.seed, report = lambda message: None).run(**self.sizes)
+        self.email, self.password = self.app.config['FLASKY_ADMIN'], 'bench'
+        admin = User(email = self.email, username = 'bench', password = self.password, confirmed = True)
+        db.session.add(admin)
+        db.session.flush()
+        popular = [id for (id, ) in db.session.query(UserCounters.user_id)
+                   .filter(UserCounters.user_id != admin.id)
+                   .order_by(UserCounters.followers.desc(), UserCounters.user_id).limit(50)]
+        db.session.add_all([Follow(follower = admin, followed_id = id) for id in popular])
+        db.session.commit()
+        timeline.rebuild(admin)
+        db.session.commit()
+        search.reindex(report = lambda message: None)
+        self.admin_id = admin.id
+        self.star_id, self.star_name = db.session.query(User.id, User.username).filter_by(id = popular[0]).one()
+        self.post_id = db.session.query(Post.id).order_by(Post.comment_count.desc(), Post.id).first()[0]
+        self.comment_id = db.session.query(db.func.min(Comment.id)).filter_by(post_id = self.post_id).scalar()
+        self.token = admin.generate_auth_token(3600).decode('ascii')
+        self.report('seeded %(users)d users, %(posts)d posts, %(comments)d comments' % self.sizes
+                    + ' in %.1fs' % (time.time() - started))
+
+    def endpoints(self):
+        star, name, post, comment = self.star_id, self.star_name, self.post_id, self.comment_id
+        api = '/api/v1.0'
+        return [
+            Endpoint('main.index', '/'),
+            Endpoint('main.index followed', '/', auth = 'session', cookies = {'show_followed': '1'}),
+            Endpoint('main.post', '/post/%d' % post),
+            Endpoint('main.user', '/user/%s' % name),
+            Endpoint('main.followers', '/followers/%s' % name),
+            Endpoint('main.moderate_comments', '/moderate/comments', auth = 'session'),
+            Endpoint('main.search', '/search?q=the'),
+            Endpoint('api.get_token', api + '/token', auth = 'password'),
+            Endpoint('api.get_posts', api + '/posts/', auth = 'token'),
+            Endpoint('api.get_posts page', api + '/posts/?page=2', auth = 'token'),
+            Endpoint('api.get_post', api + '/posts/%d' % post, auth = 'token'),
+            Endpoint('api.get_user', api + '/users/%d' % star, auth = 'token'),
+            Endpoint('api.get_user_posts', api + '/users/%d/posts' % star, auth = 'token'),
+            Endpoint('api.get_user_followed_posts', api + '/users/%d/timeline/' % self.admin_id, auth = 'token'),
+            Endpoint('api.get_comments', api + '/comments/', auth = 'token'),
+            Endpoint('api.get_comment', api + '/comments/%d' % comment, auth = 'token'),
+            Endpoint('api.get_post_comments', api + '/posts/%d/comments' % post, auth = 'token'),
+            Endpoint('api.search', api + '/search?q=the', auth = 'token'),
+            # writes last, so they do not change what the reads above see
+            Endpoint('api.new_post', api + '/posts/', 'POST', 'token', {'body': 'bench post'}, 201),
+            Endpoint('api.edit_post', api + '/posts/%d' % post, 'PUT', 'token', {'body': 'bench edit'}),
+            Endpoint('api.new_post_comment', api + '/posts/%d/comment' % post, 'POST', 'token',
+                     {'body': 'bench comment'}, 201),
+            ]
+
+    def clients(self):
+        anonymous = self.app.test_client()
+        browser = self.app.test_client(use_cookies = True)
+        response = browser.post('/auth/login', data = {'email': self.email, 'password': self.password})
+        if response.status_code != 302:
+            raise RuntimeError('bench login failed')
+        return anonymous, browser
+
+    def call(self, endpoint, clients):
+        anonymous, browser = clients
+        client = browser if endpoint.auth == 'session' else anonymous
+        headers = {}
+        if endpoint.auth in ('token', 'password'):
+            credentials = (self.token + ':') if endpoint.auth == 'token' else (self.email + ':' + self.password)
+            headers['Authorization'] = 'Basic ' + b64encode(credentials.encode('utf-8')).decode('ascii')
+        for name, value in endpoint.cookies.items():
+            client.set_cookie('localhost', name, value)
+        try:
+            return client.open(endpoint.url, method = endpoint.method, headers = headers,
+                               data = json.dumps(endpoint.json) if endpoint.json is not None else None,
+                               content_type = 'application/json' if endpoint.json is not None else None)
+        finally:
+            for name in endpoint.cookies:
+                client.delete_cookie('localhost', name)
+
+    def measure(self, endpoint, clients):
+        for i in range(self.warmup):
+            self.call(endpoint, clients)
+        timings = []
+        for i in range(self.requests):
+            started = time.perf_counter()
+            response = self.call(endpoint, clients)
+            timings.append(time.perf_counter() - started)
+        self.statements = 0
+        tracemalloc.start()
+        try:
+            self.call(endpoint, clients)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {
+            'method': endpoint.method,
+            'url': endpoint.url,
+            'status': response.status_code,
+            'expected_status': endpoint.status,
+            'p50_ms': percentile(timings, 0.5) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+            'mean_ms': sum(timings) / len(timings) * 1000,
+            'queries': self.statements,
+            'peak_kb': peak / 1024.0
+            }
+
+    def run(self):
+        self.setup()
+        try:
+            self.seed_data()
+            clients = self.clients()
+            results = {}
+            for endpoint in self.endpoints():
+                results[endpoint.name] = result = self.measure(endpoint, clients)
+                self.report('%-32s %4d  p50 %8.2fms  p99 %8.2fms  %4d queries  %8.0fKB' % (
+                    endpoint.name, result['status'], result['p50_ms'], result['p99_ms'],
+                    result['queries'], result['peak_kb']))
+            return {
+                'meta': dict(self.sizes, requests = self.requests, seed = self.seed,
+                             database = db.engine.dialect.name, python = platform.python_version()),
+                'endpoints': results
+                }
+        finally:
+            self.teardown()
+
+
+def compare(results, baseline, threshold = 0.25, min_ms = 1.0, memory_threshold = 0.5, min_kb = 64):
+    '''Regressions of ``results`` against ``baseline``, as messages.
+
+    A wrong status or any extra SQL statement is a regression. p50 latency
+    and peak memory regress when they grow by more than the relative
+    threshold and by more than ``min_ms`` / ``min_kb``, which keeps timer
+    noise on fast endpoints out. p99 is reported but not gated.
+    '''
+    problems = []
+    for name, result in sorted(results['endpoints'].items()):
+        if result['status'] != result['expected_status']:
+            problems.append('%s: status %d, expected %d' % (name, result['status'], result['expected_status']))
+        old = baseline.get('endpoints', {}).get(name)
+        if old is None:
+            continue
+        if result['queries'] > old['queries']:
+            problems.append('%s: %d queries, baseline %d' % (name, result['queries'], old['queries']))
+        if result['p50_ms'] > old['p50_ms'] * (1 + threshold) and result['p50_ms'] - old['p50_ms'] > min_ms:
+            problems.append('%s: p50 %.2fms, baseline %.2fms' % (name, result['p50_ms'], old['p50_ms']))
+        if result['peak_kb'] > old['peak_kb'] * (1 + memory_threshold) and result['peak_kb'] - old['peak_kb'] > min_kb:
+            problems.append('%s: peak memory %.0fKB, baseline %.0fKB' % (name, result['peak_kb'], old['peak_kb']))
+    return problems
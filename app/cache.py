@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    '''Thread-safe LRU mapping whose entries also expire after a TTL.
+
+    With a ``config_prefix`` the size and default TTL are read from
+    ``<prefix>_SIZE`` and ``<prefix>_TTL`` in ``init_app``.
+    '''
+
+    def __init__(self, config_prefix = None, maxsize = 1024, ttl = 300):
+        self.config_prefix = config_prefix
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        if self.config_prefix:
+            app.config.setdefault(self.config_prefix + '_SIZE', self.maxsize)
+            app.config.setdefault(self.config_prefix + '_TTL', self.ttl)
+            self.maxsize = app.config[self.config_prefix + '_SIZE']
+            self.ttl = app.config[self.config_prefix + '_TTL']
+        self.clear()
+
+    def get(self, key, default = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl = None, expires = None):
+        '''Store ``value`` for ``ttl`` seconds, or until the ``expires``
+        epoch time if that comes first.'''
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        if expires is not None:
+            expires_at = min(expires_at, expires)
+        if self.maxsize <= 0 or expires_at <= time.time():
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires_at, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self.lock:
+            keys = [key for key, (_, value) in self.entries.items() if predicate(key, value)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+            }
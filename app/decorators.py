@@ -2,7 +2,7 @@
 # coding=utf-8
 
 from functools import wraps
-from flask import abort
+from flask import abort, g
 from flask_login import current_user
 from .models import Permission
 
@@ -19,3 +19,11 @@ def permission_required(permission):
 def admin_required(f):
     return permission_required(Permission.ADMIN)(f)
 
+
+def primary_required(f):
+    '''Read from the primary database, for GET views that write.'''
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_primary = True
+        return f(*args, **kwargs)
+    return decorated_function
@@ -1,12 +1,156 @@
-from threading import Thread
+import atexit
+import smtplib
+import threading
+import time
+from collections import deque
+from queue import Queue, Full, Empty
 from flask import current_app, render_template
 from flask_mail import Message
 from . import mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+def is_transient(error):
+    '''4xx replies, dropped connections and socket errors are worth a retry.'''
+    if isinstance(error, smtplib.SMTPConnectError):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError)
+
+
+class EmailQueue(object):
+    '''Bounded queue drained by a fixed pool of sender threads.
+
+    Each worker takes up to FLASKY_MAIL_BATCH_SIZE messages at a time and
+    sends them over one SMTP connection. Transient failures are retried with
+    backoff; when the queue is full, callers wait up to
+    FLASKY_MAIL_ENQUEUE_TIMEOUT seconds. With FLASKY_MAIL_WORKERS = 0 messages
+    are sent in the calling thread.
+    '''
+
+    def __init__(self, app = None):
+        self.app = None
+        self.queue = None
+        self.workers = []
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen = 1000)
+        self.sent = self.failed = self.retried = self.dropped = 0
+        atexit.register(self.drain)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_MAIL_WORKERS', 2)
+        app.config.setdefault('FLASKY_MAIL_QUEUE_SIZE', 1000)
+        app.config.setdefault('FLASKY_MAIL_BATCH_SIZE', 20)
+        app.config.setdefault('FLASKY_MAIL_RETRIES', 3)
+        app.config.setdefault('FLASKY_MAIL_RETRY_DELAY', 1)
+        app.config.setdefault('FLASKY_MAIL_ENQUEUE_TIMEOUT', 5)
+        with self.lock:
+            self.app = app
+            if self.queue is None:
+                self.queue = Queue(app.config['FLASKY_MAIL_QUEUE_SIZE'])
+
+    def send(self, msg):
+        '''Queue ``msg``; returns False if it had to be dropped.'''
+        job = (msg, time.time())
+        if self.app.config['FLASKY_MAIL_WORKERS'] <= 0:
+            self.send_batch([job])
+            return True
+        self.start()
+        try:
+            self.queue.put(job, timeout = self.app.config['FLASKY_MAIL_ENQUEUE_TIMEOUT'])
+        except Full:
+            self.dropped += 1
+            self.app.logger.error('Mail queue full, dropped message to %s', msg.recipients)
+            return False
+        return True
+
+    def start(self):
+        with self.lock:
+            self.workers = [t for t in self.workers if t.is_alive()]
+            for i in range(len(self.workers), self.app.config['FLASKY_MAIL_WORKERS']):
+                thread = threading.Thread(target = self.run, name = 'mail-sender-%d' % i)
+                thread.daemon = True
+                thread.start()
+                self.workers.append(thread)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.app.config['FLASKY_MAIL_BATCH_SIZE']:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    self.send_batch(batch)
+            except Exception:
+                self.app.logger.exception('Mail worker failed')
+            finally:
+                for job in batch:
+                    self.queue.task_done()
+
+    def send_batch(self, batch):
+        pending = list(batch)
+        attempts = 0
+        while pending:
+            try:
+                with mail.connect() as conn:
+                    while pending:
+                        msg, queued_at = pending[0]
+                        try:
+                            conn.send(msg)
+                        except Exception as e:
+                            if is_transient(e):
+                                raise
+                            self.failed += 1
+                            current_app.logger.error('Sending mail to %s failed: %s', msg.recipients, e)
+                        else:
+                            self.sent += 1
+                            self.latencies.append(time.time() - queued_at)
+                        pending.pop(0)
+            except Exception as e:
+                if not pending:
+                    # only closing the connection failed
+                    continue
+                attempts += 1
+                if not is_transient(e) or attempts > current_app.config['FLASKY_MAIL_RETRIES']:
+                    self.failed += len(pending)
+                    current_app.logger.error('Giving up on %d messages: %s', len(pending), e)
+                    return
+                self.retried += 1
+                time.sleep(current_app.config['FLASKY_MAIL_RETRY_DELAY'] * 2 ** (attempts - 1))
+
+    def drain(self, timeout = 10):
+        '''Wait up to ``timeout`` seconds for queued messages to go out.'''
+        deadline = time.time() + timeout
+        while self.queue is not None and self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+        return self.queue is None or not self.queue.unfinished_tasks
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+        return {
+            'depth': self.queue.qsize() if self.queue is not None else 0,
+            'workers': len(self.workers),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95)
+            }
+
+
+email_queue = EmailQueue()
 
 
 def send_email(to, subject, template, **kwargs):
@@ -15,6 +159,4 @@ def send_email(to, subject, template, **kwargs):
                   sender=app.config['FLASKY_MAIL_SENDER'], recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    return email_queue.send(msg)
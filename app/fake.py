@@ -1,8 +1,18 @@
+import hashlib
+import random
+import time
+from array import array
+from bisect import bisect
+from datetime import datetime
+from itertools import accumulate, islice
 from random import randint
+from flask import current_app
 from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
 from faker import Faker
 from . import db
-from .models import User, Post
+from .models import User, Role, Post, Comment, Follow, UserCounters
+from .rendering import render, POST_POLICY, COMMENT_POLICY
 
 
 def users(count=100):
@@ -27,11 +37,168 @@ def users(count=100):
 
 def posts(count=100):
     fake = Faker()
-    user_count = User.query.count()
+    user_ids = [id for (id, ) in db.session.query(User.id)]
     for i in range(count):
-        u = User.query.offset(randint(0, user_count - 1)).first()
         p = Post(body=fake.text(),
                  timestamp=fake.past_date(),
-                 author=u)
+                 author_id=user_ids[randint(0, len(user_ids) - 1)])
         db.session.add(p)
     db.session.commit()
+
+
+class Generator(object):
+    '''Bulk synthetic data for load testing.
+
+    Rows are written with core executemany INSERTs in chunks, using ids
+    allocated up front past the current maximum, so nothing is read back.
+    Follower counts and posting activity follow a Pareto distribution with
+    shape ``alpha`` (smaller means more skewed), and posts arrive in bursts
+    around ``posts / burst_size`` random moments of the last ``days`` days.
+    Counters, comment counts and celebrity flags are tallied while
+    generating, so no repair pass over the tables is needed.
+    '''
+
+    def __init__(self, alpha = 1.2, days = 365, burst_size = 50, burst_width = 3600,
+                 chunk_size = 5000, seed = None, report = print):
+        self.rng = random.Random(seed)
+        self.fake = Faker()
+        self.fake.seed(self.rng.randrange(2 ** 32))
+        self.alpha = alpha
+        self.span = days * 86400
+        self.burst_size = burst_size
+        self.burst_width = burst_width
+        self.chunk_size = chunk_size
+        self.report = report
+        self.now = time.time()
+
+    def next_id(self, model):
+        return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+    def insert(self, table, rows):
+        rows = iter(rows)
+        total = 0
+        started = time.time()
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            total += len(chunk)
+            self.report('%s: %d rows, %.0f rows/s' % (
+                table.name, total, total / max(time.time() - started, 1e-6)))
+        return total
+
+    def pool(self, make, size = 500):
+        return [make() for i in range(size)]
+
+    def past(self, seconds):
+        return datetime.utcfromtimestamp(self.now - seconds)
+
+    def zeros(self, count):
+        return array('l', bytes(array('l').itemsize * count))
+
+    def plan(self, users, posts, comments):
+        '''Draw who follows whom and who posts what before writing anything.'''
+        rng = self.rng
+        self.first_user = self.next_id(User)
+        self.first_post = self.next_id(Post)
+        # everyone follows themselves, as User.__init__ does
+        self.followers = array('l', (min(int(rng.paretovariate(self.alpha)), users - 1) + 1
+                                     for i in range(users)))
+        activity = list(accumulate(rng.paretovariate(self.alpha) for i in range(users)))
+        self.authors = array('l', (bisect(activity, rng.random() * activity[-1])
+                                   for i in range(posts))) if users else array('l')
+        self.commented = array('l', (rng.randrange(posts) for i in range(comments))) if posts else array('l')
+        bursts = [rng.random() * self.span for i in range(max(1, posts // self.burst_size))]
+        self.post_ages = array('d', (max(0, rng.choice(bursts) - rng.expovariate(1.0 / self.burst_width))
+                                     for i in range(posts)))
+        self.following = self.zeros(users)
+        self.posts_by = self.zeros(users)
+        self.comments_by = self.zeros(users)
+        self.comment_counts = self.zeros(posts)
+        for index in self.authors:
+            self.posts_by[index] += 1
+        for index in self.commented:
+            self.comment_counts[index] += 1
+
+    def users(self):
+        names = self.pool(self.fake.name)
+        cities = self.pool(self.fake.city)
+        about = self.pool(self.fake.sentence)
+        password_hash = generate_password_hash('password')
+        role_id = Role.query.filter_by(default = True).first().id
+        limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+
+        def rows():
+            for index, followers in enumerate(self.followers):
+                id = self.first_user + index
+                email = 'user%d@example.com' % id
+                yield {'id': id, 'email': email, 'username': 'user%d' % id,
+                       'role_id': role_id, 'password_hash': password_hash,
+                       'confirmed': True, 'name': self.rng.choice(names),
+                       'location': self.rng.choice(cities),
+                       'about_me': self.rng.choice(about),
+                       'member_since': self.past(self.span * (1 + self.rng.random())),
+                       'last_seen': self.past(self.span * self.rng.random()),
+                       'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest(),
+                       'disabled': False, 'celebrity': followers > limit}
+        return self.insert(User.__table__, rows())
+
+    def follows(self):
+        users = len(self.followers)
+
+        def rows():
+            for index, count in enumerate(self.followers):
+                others = [i for i in self.rng.sample(range(users), count) if i != index][:count - 1]
+                for follower in [index] + others:
+                    self.following[follower] += 1
+                    yield {'follower_id': self.first_user + follower,
+                           'followed_id': self.first_user + index,
+                           'timestamp': self.past(self.span * self.rng.random())}
+        return self.insert(Follow.__table__, rows())
+
+    def posts(self):
+        bodies = [(body, render(body, POST_POLICY))
+                  for body in self.pool(lambda: self.fake.text(max_nb_chars = 400))]
+
+        def rows():
+            for index, author in enumerate(self.authors):
+                body, body_html = self.rng.choice(bodies)
+                yield {'id': self.first_post + index, 'body': body, 'body_html': body_html,
+                       'timestamp': self.past(self.post_ages[index]),
+                       'author_id': self.first_user + author, 'disabled': False,
+                       'comment_count': self.comment_counts[index]}
+        return self.insert(Post.__table__, rows())
+
+    def comments(self):
+        bodies = [(body, render(body, COMMENT_POLICY)) for body in self.pool(self.fake.sentence)]
+        users = len(self.followers)
+
+        def rows():
+            for index in self.commented:
+                author = self.rng.randrange(users)
+                self.comments_by[author] += 1
+                body, body_html = self.rng.choice(bodies)
+                ago = max(0, self.post_ages[index] - self.rng.expovariate(1.0 / self.burst_width))
+                yield {'body': body, 'body_html': body_html, 'timestamp': self.past(ago),
+                       'disabled': False, 'post_id': self.first_post + index,
+                       'author_id': self.first_user + author}
+        return self.insert(Comment.__table__, rows())
+
+    def counters(self):
+        return self.insert(UserCounters.__table__, (
+            {'user_id': self.first_user + index, 'followers': followers,
+             'following': self.following[index], 'posts': self.posts_by[index],
+             'comments': self.comments_by[index]}
+            for index, followers in enumerate(self.followers)))
+
+    def run(self, users = 1000, posts = 10000, comments = 20000):
+        if not users:
+            return
+        self.plan(users, posts, comments)
+        self.users()
+        self.follows()
+        self.posts()
+        self.comments()
+        self.counters()
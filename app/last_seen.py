@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import atexit
+import threading
+import time
+
+
+class LastSeenBuffer(object):
+    '''Write-behind buffer for ``users.last_seen``.
+
+    Pings are coalesced per user in memory and written with one executemany
+    UPDATE every FLASKY_LAST_SEEN_FLUSH_INTERVAL seconds and at exit. An
+    interval of 0 writes through immediately.
+    '''
+
+    def __init__(self, app = None):
+        self.app = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_LAST_SEEN_THRESHOLD', 60)
+        app.config.setdefault('FLASKY_LAST_SEEN_FLUSH_INTERVAL', 10)
+        app.config.setdefault('FLASKY_LAST_SEEN_BATCH_SIZE', 500)
+        if self.app is not None and self.app is not app:
+            self.flush()
+        self.app = app
+
+    def record(self, user_id, last_seen):
+        with self.lock:
+            if last_seen > self.pending.get(user_id, last_seen.min):
+                self.pending[user_id] = last_seen
+        if self.app.config['FLASKY_LAST_SEEN_FLUSH_INTERVAL'] <= 0:
+            self.flush()
+        elif self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target = self.run, name = 'last-seen-flusher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.app.config['FLASKY_LAST_SEEN_FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Flushing last_seen updates failed')
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending or self.app is None:
+            return 0
+        from . import db
+        from .models import User
+        users = User.__table__
+        stmt = users.update().where(users.c.id == db.bindparam('_id')) \
+                .values(last_seen = db.bindparam('_last_seen'))
+        rows = [{'_id': id, '_last_seen': last_seen} for id, last_seen in pending.items()]
+        batch = self.app.config['FLASKY_LAST_SEEN_BATCH_SIZE']
+        try:
+            # no app context here: popping one would tear down db.session
+            # of a request running on this thread
+            engine = db.get_engine(self.app)
+            for i in range(0, len(rows), batch):
+                engine.execute(stmt, rows[i:i + batch])
+        except Exception:
+            # keep what we could not write, unless a newer ping superseded it
+            with self.lock:
+                for id, last_seen in pending.items():
+                    if last_seen > self.pending.get(id, last_seen.min):
+                        self.pending[id] = last_seen
+            raise
+        return len(rows)
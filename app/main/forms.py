@@ -1,5 +1,6 @@
 from flask import request, make_response, url_for, current_app
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from flask_pagedown.fields import PageDownField
 from flask_ckeditor import CKEditorField
 from wtforms import StringField, SubmitField, BooleanField, SelectField, TextAreaField
@@ -17,6 +18,7 @@ class EditProfileForm(FlaskForm):
     name = StringField('你的名字', validators = [Length(0, 64)])
     location = StringField('地址', validators = [Length(0, 64)])
     about_me = StringField('自我介绍', validators = [Length(0, 1000)])
+    avatar = FileField('头像', validators = [FileAllowed(['png', 'jpg', 'jpeg', 'gif'], '只能上传图片')])
     submit = SubmitField('保存')
 
 class EditProfileAdminForm(FlaskForm):
@@ -98,6 +100,9 @@ class PostForm(FlaskForm):
     body = CKEditorField('有什么想说的', validators = [DataRequired()])
     submit = SubmitField('发表')
 
+class QueryResetForm(FlaskForm):
+    submit = SubmitField('清空')
+
 class CommentForm(FlaskForm):
     body = StringField('', validators = [DataRequired()])
     submit = SubmitField('评论')
@@ -1,20 +1,19 @@
-from flask import render_template, redirect, url_for, abort, flash, request, current_app, make_response
+import re
+from flask import render_template, redirect, url_for, abort, flash, request, current_app, make_response, jsonify
 from flask_login import login_required, current_user
-from flask_sqlalchemy import get_debug_queries
 from . import main
-from .forms import EditProfileForm, EditProfileAdminForm, PostForm, CommentForm
-from .. import db
-from ..models import Role, User, Post, Permission, Comment, Follow
-from ..decorators import admin_required, permission_required
-
-@main.after_app_request
-def after_request(response):
-    for query in get_debug_queries():
-        if query.duration >=current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
-            current_app.logger.warning('Slow query: %s\nParameters: %s\nDuration: %fs\nContext %s\n' % (query.statement, query.parameters, query.duration, query.context))
-    return response
+from .forms import EditProfileForm, EditProfileAdminForm, PostForm, CommentForm, QueryResetForm
+from .. import db, timeline, page_cache, query_profiler, avatars
+from .. import search as search_index
+from ..models import Role, User, Post, Permission, Comment, Follow, PurgeJob
+from ..decorators import admin_required, permission_required, primary_required
+from ..pagination import keyset_paginate, counted_paginate
+from ..purge import request_purge
+
+AVATAR_HASH_RE = re.compile('^[0-9a-f]{32}$')
 
 @main.route('/', methods = ['GET', 'POST'])
+@page_cache.cached
 def index():
     show_followed = False
     if current_user.is_authenticated:
@@ -23,20 +22,31 @@ def index():
         query = current_user.followed_posts
     else:
         query = Post.query
+    query = query.filter(Post.visible()).options(db.joinedload('author'))
     form = PostForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
         post = Post(body = form.body.data, author = current_user._get_current_object())
         db.session.add(post)
+        db.session.flush()
+        timeline.push_post(post)
         db.session.commit()
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type = int)
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-            page, per_page = current_app.config['FLASKY_POSTS_PER_PAGE'], error_out = False
-            )
+    per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type = int)
+        pagination = query.order_by(Post.timestamp.desc()).paginate(
+                page, per_page = per_page, error_out = False
+                )
+    elif show_followed:
+        pagination = timeline.timeline_paginate(current_user, request.args.get('cursor'), per_page = per_page, error_out = False)
+    else:
+        pagination = keyset_paginate(query, Post, request.args.get('cursor'), per_page = per_page, error_out = False)
     posts = pagination.items
+    page_cache.tag('index')
     return render_template('index.html', form = form, posts = posts, show_followed = show_followed, pagination = pagination)
 
 @main.route('/user/<username>')
+@page_cache.cached
 def user(username):
     user = User.query.filter_by(username = username).first()
     if user is None:
@@ -45,14 +55,25 @@ def user(username):
         user.role = Role.query.filter_by('Administrator').first()
         db.session.add(user)
         db.session.commit()
-    posts = user.posts.order_by(Post.timestamp.desc()).all()
-    return render_template('user.html', user = user, posts = posts)
+    posts = user.posts.filter(Post.visible()).order_by(Post.timestamp.desc()).all()
+    page_cache.tag('user:%s' % user.id)
+    recommended = user.recommended(current_app.config['FLASKY_RECOMMEND_SIDEBAR']) \
+            if user == current_user else []
+    return render_template('user.html', user = user, posts = posts, recommended = recommended)
 
 @main.route('/edit-profile', methods = ['GET', 'POST'])
 @login_required
 def edit_profile():
     form = EditProfileForm()
+    if not avatars.uploads_enabled():
+        del form.avatar
     if form.validate_on_submit():
+        if 'avatar' in form and form.avatar.data:
+            try:
+                current_user.avatar_upload = avatars.save_upload(form.avatar.data)
+            except ValueError:
+                flash('无法识别上传的头像图片')
+                return render_template('edit_profile.html', form = form)
         current_user.name = form.name.data
         current_user.location = form.location.data
         current_user.about_me = form.about_me.data
@@ -65,6 +86,20 @@ def edit_profile():
     form.about_me.data = current_user.about_me
     return render_template('edit_profile.html', form = form)
 
+@main.route('/avatar/<hash>/<int:size>')
+def avatar(hash, size):
+    if not AVATAR_HASH_RE.match(hash) or size not in current_app.config['FLASKY_AVATAR_SIZES']:
+        abort(404)
+    # the bytes for a hash and size never change, so the ETag needs no I/O
+    etag = '%d-%s-%d' % (avatars.VERSION, hash, size)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status = 304)
+    else:
+        response = current_app.response_class(avatars.avatar(hash, size), mimetype = 'image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % current_app.config['FLASKY_AVATAR_MAX_AGE']
+    return response
+
 @main.route('/edit-profile/<int:id>', methods = ['GET', 'POST'])
 @login_required
 @admin_required
@@ -95,6 +130,7 @@ def edit_profile_admin(id):
 @main.route('/user/enable/<int:id>')
 @login_required
 @admin_required
+@primary_required
 def user_enable(id):
     user = User.query.get_or_404(id)
     user.disabled = False
@@ -106,6 +142,7 @@ def user_enable(id):
 @main.route('/user/disable/<int:id>')
 @login_required
 @admin_required
+@primary_required
 def user_disable(id):
     user = User.query.get_or_404(id)
     user.disabled = True
@@ -118,57 +155,62 @@ def user_disable(id):
 @main.route('/user/delete/<int:id>')
 @login_required
 @admin_required
+@primary_required
 def user_delete(id):
     user = User.query.get_or_404(id)
-    posts = Post.query.filter_by(author_id = user.id).all()
-    for post in posts:
-        db.session.delete(post)
-    db.session.commit()
-    comments = Comment.query.filter_by(author_id = user.id).all()
-    for comment in comments:
-        db.session.delete(comment)
-    db.session.commit()
-    followers = Follow.query.filter_by(follower_id = user.id).all()
-    for follower in followers:
-        db.session.delete(follower)
-    db.session.commit()
-    followeds = Follow.query.filter_by(followed_id = user.id).all()
-    for followed in followeds:
-        db.session.delete(followed)
-    db.session.commit()
-    db.session.delete(user)
-    db.session.commit()
-    flash('User name: %s, id %s, eamil: %s deleted!' % (user.id, user.username, user.email))
-    return redirect(url_for('.index'))
+    request_purge('user', user, current_user)
+    flash('用户 %s (id %s, 邮箱 %s) 已被禁用, 正在后台删除' % (user.username, user.id, user.email))
+    return redirect(url_for('.purge_jobs'))
 
 @main.route('/user/delete_posts/<int:id>')
 @login_required
+@primary_required
 def user_delete_posts(id):
     user = User.query.get_or_404(id)
     if current_user.username != user.username and not current_user.can(Permission.ADMIN):
         abort(403)
-    posts = Post.query.filter_by(author_id = user.id).all()
-    for post in posts:
-        comments = Comment.query.filter_by(post_id = post.id).all()
-        for comment in comments:
-            db.session.delete(comment)
-        db.session.delete(post)
-        db.session.commit()
+    request_purge('posts', user, current_user)
     flash('所有Blog已经被删除')
-    return render_template('user.html', user = user)
+    return redirect(url_for('.user', username = user.username))
 
 @main.route('/user/delete_comments/<int:id>')
 @login_required
+@primary_required
 def user_delete_comments(id):
     user = User.query.get_or_404(id)
     if current_user.username != user.username and not current_user.can(Permission.ADMIN):
         abort(403)
-    comments = Comment.query.filter_by(author_id = user.id).all()
-    for comment in comments:
-        db.session.delete(comment)
-    db.session.commit()
+    request_purge('comments', user, current_user)
     flash('所有评论已经删除')
-    return render_template('user.html', user = user)
+    return redirect(url_for('.user', username = user.username))
+
+@main.route('/admin/purges')
+@login_required
+@admin_required
+def purge_jobs():
+    jobs = PurgeJob.query.order_by(PurgeJob.id.desc()).limit(50).all()
+    return render_template('purges.html', jobs = jobs)
+
+@main.route('/admin/queries')
+@login_required
+@admin_required
+def query_profile():
+    return render_template('queries.html', report = query_profiler.report(), form = QueryResetForm())
+
+@main.route('/admin/queries.json')
+@login_required
+@admin_required
+def query_profile_json():
+    return jsonify(query_profiler.report(limit = request.args.get('limit', 100, type = int)))
+
+@main.route('/admin/queries/reset', methods = ['POST'])
+@login_required
+@admin_required
+def query_profile_reset():
+    if QueryResetForm().validate_on_submit():
+        query_profiler.reset()
+        flash('查询统计已清空')
+    return redirect(url_for('.query_profile'))
 
 
 @main.route('/edit/<int:id>', methods = ['GET', 'POST'])
@@ -203,9 +245,12 @@ def followers(username):
         flash('没有这个用户')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type = int)
-    pagination = user.followers.paginate(page, per_page = current_app.config['FLASKY_FOLLOWERS_PER_PAGE'], error_out = False)
+    pagination = counted_paginate(user.followers, page, current_app.config['FLASKY_FOLLOWERS_PER_PAGE'], user.counts.followers)
     follows = [{'user': item.follower, 'timestamp': item.timestamp} for item in pagination.items]
-    return render_template('followers.html', user = user, title = 'Followers of ', endpoint = '.followers', pagination = pagination, follows = follows)
+    following = current_user.following_state([item['user'] for item in follows]) \
+            if current_user.can(Permission.FOLLOW) else {}
+    return render_template('followers.html', user = user, title = 'Followers of ', endpoint = '.followers', pagination = pagination, follows = follows,
+                           following = following)
 
 @main.route('/followed-by/<username>')
 def followed_by(username):
@@ -214,13 +259,17 @@ def followed_by(username):
         flash('没有这个用户')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type = int)
-    pagination = user.followed.paginate(page, per_page = current_app.config['FLASKY_FOLLOWERS_PER_PAGE'], error_out = False)
+    pagination = counted_paginate(user.followed, page, current_app.config['FLASKY_FOLLOWERS_PER_PAGE'], user.counts.following)
     follows = [{'user': item.followed, 'timestamp': item.timestamp} for item in pagination.items]
-    return render_template('followers.html', user = user, title = 'Followed by', endpoint = '.followed_by', pagination = pagination, follows = follows)
+    following = current_user.following_state([item['user'] for item in follows]) \
+            if current_user.can(Permission.FOLLOW) else {}
+    return render_template('followers.html', user = user, title = 'Followed by', endpoint = '.followed_by', pagination = pagination, follows = follows,
+                           following = following)
 
 @main.route('/follow/<username>')
 @login_required
 @permission_required(Permission.FOLLOW)
+@primary_required
 def follow(username):
     #uesr = User.query.filter_by(username = username).first()
     u = User.query.filter_by(username = username).first()
@@ -231,6 +280,7 @@ def follow(username):
         flash('你已经关注这个用户')
         return redirect(url_for('.user', username = username))
     current_user.follow(u)
+    timeline.backfill(current_user, u)
     db.session.commit()
     flash('你正在关注这个用户: %s' % username)
     return redirect(url_for('.user', username = username))
@@ -238,6 +288,7 @@ def follow(username):
 @main.route('/unfollow/<username>')
 @login_required
 @permission_required(Permission.FOLLOW)
+@primary_required
 def unfollow(username):
     user = User.query.filter_by(username = username).first()
     if user is None:
@@ -247,6 +298,7 @@ def unfollow(username):
         flash('你没有关关注这个用户')
         return redirect(url_for('.user', username = username))
     current_user.unfollow(user)
+    timeline.remove_author(current_user, user)
     db.session.commit()
     flash('你不在关注这个用户: %s' % username)
     return redirect(url_for('.user', username = username))
@@ -266,8 +318,11 @@ def show_followed():
     return resp
 
 @main.route('/post/<int:id>', methods = ['GET', 'POST'])
+@page_cache.cached
 def post(id):
     post = Post.query.get_or_404(id)
+    if post.deleted:
+        abort(404)
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body = form.body.data, post = post, author = current_user._get_current_object())
@@ -277,23 +332,34 @@ def post(id):
         return redirect(url_for('.post', id = post.id, page = -1))
     page = request.args.get('page', 1, type = int)
     if page == -1:
-        page = (post.comments.count() - 1) / current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+        page = max((post.comment_count or 0) - 1, 0) // current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
+    pagination = post.comments.filter(Comment.visible()).options(db.joinedload('author')).order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
     comments = pagination.items
+    page_cache.tag('post:%s' % post.id)
     return render_template('post.html', posts = [post], form = form, comments = comments, pagination = pagination)
 
+@main.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    results = None
+    if q:
+        results = search_index.search(q, request.args.get('cursor'),
+                                      per_page = current_app.config['FLASKY_SEARCH_PER_PAGE'])
+    return render_template('search.html', q = q, results = results)
+
 @main.route('/moderate/comments')
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate_comments():
     page = request.args.get('page', 1, type = int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+    pagination = Comment.query.filter(Comment.visible()).options(db.joinedload('author')).order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
     comments = pagination.items
     return render_template('moderate.html', comments = comments, pagination = pagination, page = page)
 
 @main.route('/moderate/comments/enable/<int:id>')
 @login_required
 @permission_required(Permission.MODERATE)
+@primary_required
 def moderate_comment_enable(id):
     comment = Comment.query.get_or_404(id)
     comment.disabled = False
@@ -304,6 +370,7 @@ def moderate_comment_enable(id):
 @main.route('/moderate/comments/disable/<int:id>')
 @login_required
 @permission_required(Permission.MODERATE)
+@primary_required
 def moderate_comment_disable(id):
     comment = Comment.query.get_or_404(id)
     comment.disabled = True
@@ -314,6 +381,7 @@ def moderate_comment_disable(id):
 @main.route('/moderate/comments/delete/<int:id>')
 @login_required
 @permission_required(Permission.MODERATE)
+@primary_required
 def moderate_comment_delete(id):
     comment = Comment.query.get_or_404(id)
     db.session.delete(comment)
@@ -323,6 +391,7 @@ def moderate_comment_delete(id):
 
 @main.route('/post/enable/<int:id>')
 @login_required
+@primary_required
 def post_enable(id):
     post = Post.query.get_or_404(id)
     if current_user != post.author and not current_user.can(Permission.ADMIN):
@@ -334,6 +403,7 @@ def post_enable(id):
 
 @main.route('/post/disable/<int:id>')
 @login_required
+@primary_required
 def post_disable(id):
     post = Post.query.get_or_404(id)
     if current_user != post.author and not current_user.can(Permission.ADMIN):
@@ -345,6 +415,7 @@ def post_disable(id):
 
 @main.route('/post/delete/<int:id>')
 @login_required
+@primary_required
 def post_delete(id):
     post = Post.query.get_or_404(id)
     comments = Comment.query.filter_by(post_id = post.id).all()
@@ -360,6 +431,7 @@ def post_delete(id):
 
 @main.route('/comment/enable/<int:id>')
 @login_required
+@primary_required
 def comment_enable(id):
     comment = Comment.query.get_or_404(id)
     post = Post.query.get_or_404(comment.post_id)
@@ -371,13 +443,14 @@ def comment_enable(id):
     db.session.commit()
     page = request.args.get('page', 1, type = int)
     if page == -1:
-        page = (post.comments.count() - 1) / current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+        page = max((post.comment_count or 0) - 1, 0) // current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
+    pagination = post.comments.filter(Comment.visible()).options(db.joinedload('author')).order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
     comments = pagination.items
     return render_template('post.html', posts = [post], form = form, comments = comments, pagination = pagination)
 
 @main.route('/comment/disable/<int:id>')
 @login_required
+@primary_required
 def comment_disable(id):
     comment = Comment.query.get_or_404(id)
     post = Post.query.get_or_404(comment.post_id)
@@ -389,14 +462,15 @@ def comment_disable(id):
     db.session.commit()
     page = request.args.get('page', 1, type = int)
     if page == -1:
-        page = (post.comments.count() - 1) / current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+        page = max((post.comment_count or 0) - 1, 0) // current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
+    pagination = post.comments.filter(Comment.visible()).options(db.joinedload('author')).order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
     comments = pagination.items
     return render_template('post.html', posts = [post], form = form, comments = comments, pagination = pagination)
 
 
 @main.route('/comment/delete/<int:id>')
 @login_required
+@primary_required
 def comment_delete(id):
     comment = Comment.query.get_or_404(id)
     post = Post.query.get_or_404(comment.post_id)
@@ -408,7 +482,7 @@ def comment_delete(id):
     flash('评论已经删除')
     page = request.args.get('page', 1, type = int)
     if page == -1:
-        page = (post.comments.count() - 1) / current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
+        page = max((post.comment_count or 0) - 1, 0) // current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
+    pagination = post.comments.filter(Comment.visible()).options(db.joinedload('author')).order_by(Comment.timestamp.desc()).paginate(page, per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out = False)
     comments = pagination.items
     return render_template('post.html', posts = [post], form = form, comments = comments, pagination = pagination)
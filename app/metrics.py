@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import atexit
+import binascii
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import request, current_app, abort, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Shard(object):
+    '''One thread's counters. Only that thread writes to it, so recording
+    takes no lock; readers copy the dicts.'''
+
+    def __init__(self):
+        self.requests = {}
+        self.latency = {}
+        self.db = {}
+        self.in_flight = 0
+
+
+def empty_snapshot():
+    return {'requests': {}, 'latency': {}, 'db': {}, 'in_flight': 0, 'caches': {}, 'email': {}, 'pools': {}}
+
+
+def merge(total, snapshot):
+    for key, count in snapshot['requests'].items():
+        total['requests'][key] = total['requests'].get(key, 0) + count
+    for name in ('latency', 'db'):
+        for key, values in snapshot[name].items():
+            current = total[name].get(key)
+            total[name][key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+    total['in_flight'] += snapshot['in_flight']
+    for group in ('caches', 'pools'):
+        for name, stats in snapshot.get(group, {}).items():
+            current = total[group].setdefault(name, {})
+            for key, value in stats.items():
+                current[key] = current.get(key, 0) + (value or 0)
+    for key, value in snapshot['email'].items():
+        if key in ('depth', 'workers', 'sent', 'failed', 'retried', 'dropped'):
+            total['email'][key] = total['email'].get(key, 0) + (value or 0)
+    return total
+
+
+COUNTERS = {'caches': ('hits', 'misses', 'evictions'),
+            'pools': ('checkouts', 'wait_seconds'),
+            'email': ('sent', 'failed', 'retried', 'dropped')}
+
+
+def counters_only(snapshot):
+    '''``snapshot`` without its gauges, for workers that have exited.'''
+    kept = dict(empty_snapshot(), requests = snapshot['requests'], latency = snapshot['latency'],
+                db = snapshot['db'])
+    for group in ('caches', 'pools'):
+        kept[group] = dict((name, dict((key, stats[key]) for key in COUNTERS[group] if key in stats))
+                           for name, stats in snapshot.get(group, {}).items())
+    kept['email'] = dict((key, value) for key, value in snapshot['email'].items() if key in COUNTERS['email'])
+    return kept
+
+
+def labels(**values):
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in sorted(values.items()))
+
+
+def exposition(snapshot, buckets):
+    '''Render a snapshot in the Prometheus text format.'''
+    lines = []
+    def metric(name, kind, help):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    metric('flasky_http_requests_total', 'counter', 'Requests by endpoint, method and status.')
+    for key, count in sorted(snapshot['requests'].items()):
+        endpoint, method, status = key.split(' ')
+        lines.append('flasky_http_requests_total%s %d' % (labels(endpoint = endpoint, method = method, status = status), count))
+
+    metric('flasky_http_request_duration_seconds', 'histogram', 'Request latency by endpoint.')
+    for endpoint, values in sorted(snapshot['latency'].items()):
+        cumulative = 0
+        for bound, count in zip(list(buckets) + ['+Inf'], values):
+            cumulative += count
+            lines.append('flasky_http_request_duration_seconds_bucket%s %d' % (labels(endpoint = endpoint, le = bound), cumulative))
+        lines.append('flasky_http_request_duration_seconds_sum%s %f' % (labels(endpoint = endpoint), values[-1]))
+        lines.append('flasky_http_request_duration_seconds_count%s %d' % (labels(endpoint = endpoint), cumulative))
+
+    metric('flasky_db_duration_seconds_total', 'counter', 'Time spent in SQL statements by endpoint.')
+    for endpoint, (seconds, queries) in sorted(snapshot['db'].items()):
+        lines.append('flasky_db_duration_seconds_total%s %f' % (labels(endpoint = endpoint), seconds))
+    metric('flasky_db_queries_total', 'counter', 'SQL statements by endpoint.')
+    for endpoint, (seconds, queries) in sorted(snapshot['db'].items()):
+        lines.append('flasky_db_queries_total%s %d' % (labels(endpoint = endpoint), queries))
+
+    metric('flasky_http_requests_in_flight', 'gauge', 'Requests being handled.')
+    lines.append('flasky_http_requests_in_flight %d' % snapshot['in_flight'])
+
+    for key, kind in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'), ('entries', 'gauge')):
+        name = 'flasky_cache_%s%s' % (key, '_total' if kind == 'counter' else '')
+        metric(name, kind, 'Cache %s.' % key)
+        for cache, stats in sorted(snapshot['caches'].items()):
+            lines.append('%s%s %d' % (name, labels(cache = cache), stats.get(key, 0)))
+
+    for key in ('sent', 'failed', 'retried', 'dropped'):
+        metric('flasky_mail_%s_total' % key, 'counter', 'Mail messages %s.' % key)
+        lines.append('flasky_mail_%s_total %d' % (key, snapshot['email'].get(key, 0)))
+    metric('flasky_mail_queue_depth', 'gauge', 'Mail messages waiting to be sent.')
+    lines.append('flasky_mail_queue_depth %d' % snapshot['email'].get('depth', 0))
+
+    metric('flasky_db_pool_checkouts_total', 'counter', 'Connections checked out of the pool by database.')
+    for engine, stats in sorted(snapshot['pools'].items()):
+        lines.append('flasky_db_pool_checkouts_total%s %d' % (labels(engine = engine), stats.get('checkouts', 0)))
+    metric('flasky_db_pool_checkout_wait_seconds_total', 'counter', 'Time spent waiting for pool checkouts by database.')
+    for engine, stats in sorted(snapshot['pools'].items()):
+        lines.append('flasky_db_pool_checkout_wait_seconds_total%s %f' % (labels(engine = engine), stats.get('wait_seconds', 0)))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics(object):
+    '''Request latency histograms, status counts, in-flight requests and DB
+    time per endpoint, served in the Prometheus text format at
+    FLASKY_METRICS_PATH.
+
+    With FLASKY_METRICS_DIR set, every process writes its totals to
+    ``<dir>/metrics-<pid>-<random>.json`` at most every
+    FLASKY_METRICS_FLUSH_INTERVAL seconds and at exit, and the route adds up
+    all the files, so any worker can answer for the whole deployment. The
+    counters of exited workers are folded into ``metrics-archive.json`` and
+    their files removed, so the directory stays as large as the pool.
+    '''
+
+    def __init__(self, app = None):
+        self.app = None
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.written = 0
+        self.process = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_METRICS_PATH', '/metrics')
+        app.config.setdefault('FLASKY_METRICS_BUCKETS', BUCKETS)
+        app.config.setdefault('FLASKY_METRICS_DIR', None)
+        app.config.setdefault('FLASKY_METRICS_FLUSH_INTERVAL', 10)
+        app.config.setdefault('FLASKY_METRICS_TOKEN', None)
+        if self.app is None:
+            atexit.register(self.write)
+        self.app = app
+        self.buckets = tuple(app.config['FLASKY_METRICS_BUCKETS'])
+        app.before_request(self.start)
+        app.after_request(self.after_request)
+        app.teardown_request(self.finish)
+        app.add_url_rule(app.config['FLASKY_METRICS_PATH'], 'metrics', self.view)
+        if not event.contains(Engine, 'before_cursor_execute', self.before_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_execute)
+        with self.lock:
+            self.shards = []
+        self.local = threading.local()
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def start(self):
+        self.shard().in_flight += 1
+        self.local.started = time.time()
+        self.local.status = 0
+        self.local.db = [0.0, 0]
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self.local, 'db', None) is not None:
+            self.local.query_started = time.time()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db[0] += time.time() - self.local.query_started
+            db[1] += 1
+
+    def finish(self, exc = None):
+        started = getattr(self.local, 'started', None)
+        if started is None:
+            return
+        duration = time.time() - started
+        db, self.local.db, self.local.started = self.local.db, None, None
+        shard = self.shard()
+        shard.in_flight -= 1
+        endpoint = request.endpoint or 'unmatched'
+        status = 500 if exc is not None else self.local.status
+        key = '%s %s %s' % (endpoint, request.method, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+        latency = shard.latency.get(endpoint)
+        if latency is None:
+            latency = shard.latency[endpoint] = [0] * (len(self.buckets) + 1) + [0.0]
+        latency[bisect_left(self.buckets, duration)] += 1
+        latency[-1] += duration
+        totals = shard.db.get(endpoint)
+        if totals is None:
+            totals = shard.db[endpoint] = [0.0, 0]
+        totals[0] += db[0]
+        totals[1] += db[1]
+        if current_app.config['FLASKY_METRICS_DIR'] and \
+                time.time() - self.written >= current_app.config['FLASKY_METRICS_FLUSH_INTERVAL']:
+            self.write()
+
+    def after_request(self, response):
+        self.local.status = response.status_code
+        return response
+
+    def snapshot(self):
+        '''This process's totals, in a JSON-friendly form.'''
+        total = empty_snapshot()
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            # dict() copies in one step, safe against the owner thread
+            merge(total, dict(empty_snapshot(), requests = dict(shard.requests),
+                              latency = dict(shard.latency), db = dict(shard.db),
+                              in_flight = shard.in_flight))
+        from . import db, render_cache, token_cache, user_cache, page_cache
+        from .email import email_queue
+        for name, cache in (('render', render_cache), ('token', token_cache),
+                            ('user', user_cache), ('page', page_cache)):
+            total['caches'][name] = cache.stats()
+        total['email'] = email_queue.stats()
+        total['pools'] = db.pool_stats()
+        return total
+
+    def write(self):
+        directory = self.app.config['FLASKY_METRICS_DIR'] if self.app is not None else None
+        if not directory or not self.write_lock.acquire(False):
+            return
+        try:
+            self.written = time.time()
+            path = os.path.join(directory, self.file_name())
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        finally:
+            self.write_lock.release()
+
+    def file_name(self):
+        '''``metrics-<pid>-<random>.json``: the suffix keeps a worker that
+        reuses an exited one's pid from overwriting its totals, and is drawn
+        again after a fork.'''
+        pid = os.getpid()
+        if self.process is None or self.process[0] != pid:
+            self.process = (pid, binascii.hexlify(os.urandom(4)).decode('ascii'))
+        return 'metrics-%d-%s.json' % self.process
+
+    def collect(self):
+        '''Totals for the deployment: every worker's file with
+        FLASKY_METRICS_DIR, else this process.'''
+        directory = current_app.config['FLASKY_METRICS_DIR']
+        if not directory:
+            return self.snapshot()
+        self.write()
+        total = merge(empty_snapshot(), self.archive(directory))
+        for path in worker_files(directory):
+            snapshot = read_snapshot(path)
+            if snapshot is not None:
+                merge(total, snapshot)
+        return total
+
+    def archive(self, directory):
+        '''Fold the counters of exited workers into the archive, under a
+        lock shared by all processes, and return the archive.'''
+        with open(os.path.join(directory, 'metrics-archive.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = os.path.join(directory, ARCHIVE)
+            archive = read_snapshot(path) or dict(empty_snapshot(), folded = [])
+            # names already counted whose removal may have been interrupted
+            folded = [name for name in archive['folded'] if os.path.exists(os.path.join(directory, name))]
+            dead = [worker for worker in worker_files(directory)
+                    if os.path.basename(worker) not in folded and not pid_alive(worker_pid(worker))]
+            for worker in dead:
+                snapshot = read_snapshot(worker)
+                if snapshot is not None:
+                    merge(archive, counters_only(snapshot))
+            if dead or folded != archive['folded']:
+                archive['folded'] = folded + [os.path.basename(worker) for worker in dead]
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(archive, f)
+                os.replace(path + '.tmp', path)
+                for name in archive['folded']:
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
+        return archive
+
+    def view(self):
+        token = current_app.config['FLASKY_METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != 'Bearer ' + token:
+            abort(403)
+        return Response(exposition(self.collect(), self.buckets),
+                        mimetype = 'text/plain; version=0.0.4')
+
+
+ARCHIVE = 'metrics-archive.json'
+
+
+def worker_files(directory):
+    return glob.glob(os.path.join(directory, 'metrics-*-*.json'))
+
+
+def worker_pid(path):
+    return int(os.path.basename(path)[8:-5].split('-')[0])
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+metrics = Metrics()
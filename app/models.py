@@ -1,13 +1,20 @@
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import current_app, request, url_for
+from flask import current_app, request, url_for, g, has_app_context
 from flask_login import UserMixin, AnonymousUserMixin
-from . import db, login_manager
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from . import db, login_manager, last_seen_buffer, token_cache, user_cache, page_cache
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from datetime import datetime
-from markdown import markdown
-import hashlib, bleach
+from datetime import datetime, timedelta
+import hashlib
 from . import db, login_manager
 from app.exceptions import ValidationError
+from .rendering import render, POST_POLICY, COMMENT_POLICY
+
+
+# microseconds, so two writes in the same second still change the API's ETags
+PreciseDateTime = db.DateTime().with_variant(mysql.DATETIME(fsp = 6), 'mysql')
 
 
 class Permission:
@@ -18,12 +25,191 @@ class Permission:
     ADMIN = 16
 
 
+def snapshot(obj):
+    '''Plain dict of ``obj``'s column values, safe to keep across sessions.'''
+    return dict((attr.key, getattr(obj, attr.key)) for attr in obj.__mapper__.column_attrs)
+
+
+def follow_state():
+    '''(follower id, followed id) -> bool, remembered for the request.'''
+    return g.setdefault('follow_state', {}) if has_app_context() else {}
+
+
+def detached(cls, values, **related):
+    '''Rebuild a detached ``cls`` from a snapshot without a SELECT.'''
+    obj = cls.__mapper__.class_manager.new_instance()
+    for key, value in list(values.items()) + list(related.items()):
+        set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    return obj
+
+
 class Follow(db.Model):
     __tablename__ = 'follows'
     follower_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key = True)
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key = True)
     timestamp = db.Column(db.DateTime, default = datetime.utcnow)
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        UserCounters.change(connection, target.follower_id, following = 1)
+        UserCounters.change(connection, target.followed_id, followers = 1)
+        follow_state()[(target.follower_id, target.followed_id)] = True
+        RecommendationQueue.mark(connection, [target.follower_id])
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        UserCounters.change(connection, target.follower_id, following = -1)
+        UserCounters.change(connection, target.followed_id, followers = -1)
+        follow_state()[(target.follower_id, target.followed_id)] = False
+        RecommendationQueue.mark(connection, [target.follower_id])
+
+    @staticmethod
+    def on_rollback(session):
+        if has_app_context():
+            g.pop('follow_state', None)
+
+    def page_tags(self):
+        return ['user:%s' % self.follower_id, 'user:%s' % self.followed_id]
+
+db.event.listen(Follow, 'after_insert', Follow.on_insert)
+db.event.listen(Follow, 'after_delete', Follow.on_delete)
+db.event.listen(db.session, 'after_rollback', Follow.on_rollback)
+
+
+class UserCounters(db.Model):
+    __tablename__ = 'user_counters'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key = True)
+    posts = db.Column(db.Integer, default = 0)
+    followers = db.Column(db.Integer, default = 0)
+    following = db.Column(db.Integer, default = 0)
+    comments = db.Column(db.Integer, default = 0)
+
+    @staticmethod
+    def change(connection, user_id, **deltas):
+        if user_id is None:
+            return
+        values = dict((name, db.func.coalesce(getattr(UserCounters, name), 0) + delta)
+                      for name, delta in deltas.items())
+        connection.execute(UserCounters.__table__.update()
+                .where(UserCounters.user_id == user_id).values(**values))
+
+    @staticmethod
+    def compute(user):
+        return UserCounters(
+                user_id = user.id,
+                posts = user.posts.count(),
+                followers = user.followers.count(),
+                following = user.followed.count(),
+                comments = user.comments.count()
+                )
+
+    @staticmethod
+    def repair(user_ids = None):
+        missing = db.session.query(User.id).outerjoin(UserCounters, UserCounters.user_id == User.id) \
+                .filter(UserCounters.user_id == None)
+        if user_ids is not None:
+            missing = missing.filter(User.id.in_(user_ids))
+        missing = [{'user_id': id} for (id, ) in missing]
+        if missing:
+            db.session.execute(UserCounters.__table__.insert(), missing)
+        def counted(key):
+            return db.select([db.func.count()]).where(key == UserCounters.user_id).as_scalar()
+        stmt = UserCounters.__table__.update().values(
+                posts = counted(Post.author_id),
+                followers = counted(Follow.followed_id),
+                following = counted(Follow.follower_id),
+                comments = counted(Comment.author_id)
+                )
+        if user_ids is not None:
+            stmt = stmt.where(UserCounters.user_id.in_(user_ids))
+        return db.session.execute(stmt).rowcount
+
+
+class TimelineEntry(db.Model):
+    __tablename__ = 'timelines'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key = True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key = True, index = True)
+    author_id = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime)
+    __table_args__ = (
+            db.Index('ix_timelines_user_timestamp', 'user_id', 'timestamp', 'post_id'),
+            db.Index('ix_timelines_user_author', 'user_id', 'author_id'),
+            )
+
+
+class Recommendation(db.Model):
+    '''An account ``user_id`` may want to follow, computed offline by
+    ``app.recommend``.'''
+    __tablename__ = 'recommendations'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key = True)
+    rank = db.Column(db.Integer, primary_key = True, autoincrement = False)
+    candidate_id = db.Column(db.Integer, db.ForeignKey('users.id'), index = True)
+    score = db.Column(db.Float)
+
+
+class RecommendationQueue(db.Model):
+    '''Users whose follows changed since recommendations were last computed.'''
+    __tablename__ = 'recommendation_queue'
+    id = db.Column(db.Integer, primary_key = True)
+    user_id = db.Column(db.Integer)
+
+    @staticmethod
+    def mark(connection, user_ids):
+        rows = [{'user_id': id} for id in user_ids if id is not None]
+        if rows:
+            connection.execute(RecommendationQueue.__table__.insert(), rows)
+
+
+class SearchDocument(db.Model):
+    '''Tokenized text of a post or comment, as indexed by ``app.search``.'''
+    __tablename__ = 'search_documents'
+    doc_type = db.Column(db.String(16), primary_key = True)
+    doc_id = db.Column(db.Integer, primary_key = True)
+    terms = db.Column(db.Text)
+    length = db.Column(db.Integer)
+
+
+class SearchPosting(db.Model):
+    '''Inverted index rows for the builtin search backend.'''
+    __tablename__ = 'search_postings'
+    term = db.Column(db.String(64), primary_key = True)
+    doc_type = db.Column(db.String(16), primary_key = True)
+    doc_id = db.Column(db.Integer, primary_key = True)
+    tf = db.Column(db.Integer)
+    __table_args__ = (db.Index('ix_search_postings_doc', 'doc_type', 'doc_id'),)
+
+
+class TableVersion(db.Model):
+    '''Bumped whenever rows are hard-deleted from ``name``, which moves
+    neither the max id nor the newest ``updated_at`` the API validates
+    lists with.'''
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String(32), primary_key = True)
+    version = db.Column(db.Integer, default = 0)
+    updated_at = db.Column(PreciseDateTime)
+
+    @staticmethod
+    def bump(connection, name):
+        now = datetime.utcnow()
+        table = TableVersion.__table__
+        bumped = connection.execute(table.update().where(table.c.name == name).values(
+                version = db.func.coalesce(table.c.version, 0) + 1, updated_at = now)).rowcount
+        if not bumped:
+            connection.execute(table.insert(), name = name, version = 1, updated_at = now)
+
+    @staticmethod
+    def get(name):
+        row = db.session.query(TableVersion.version, TableVersion.updated_at) \
+                .filter(TableVersion.name == name).first()
+        return tuple(row) if row is not None else (0, None)
+
+    @staticmethod
+    def on_create(target, connection, **kw):
+        connection.execute(target.insert(), [{'name': name, 'version': 0} for name in ('posts', 'comments')])
+
+db.event.listen(TableVersion.__table__, 'after_create', TableVersion.on_create)
+
 
 class Role(db.Model):
     __tablename__ = 'roles'
@@ -75,11 +261,21 @@ class Role(db.Model):
         return self.permissions & perm == perm
 
 
+    @staticmethod
+    def on_update(mapper, connection, target):
+        # cached identities carry a copy of their role
+        token_cache.clear()
+        user_cache.clear()
+
     def __repr__(self):
         return '<Role %r>' % self.name
     __str__ = __repr__
 
 
+db.event.listen(Role, 'after_update', Role.on_update)
+db.event.listen(Role, 'after_delete', Role.on_update)
+
+
 class Post(db.Model):
     __tablename__ = 'posts'
     id = db.Column(db.Integer, primary_key = True)
@@ -89,6 +285,10 @@ class Post(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     comments = db.relationship('Comment', backref = 'post', lazy = 'dynamic')
     disabled = db.Column(db.Boolean, default = False)
+    deleted = db.Column(db.Boolean, default = False)
+    comment_count = db.Column(db.Integer, default = 0)
+    updated_at = db.Column(PreciseDateTime, index = True, default = datetime.utcnow, onupdate = datetime.utcnow)
+    __table_args__ = (db.Index('ix_posts_author_timestamp', 'author_id', 'timestamp'),)
 
     @staticmethod
     def generate_fake(count = 100):
@@ -113,18 +313,33 @@ class Post(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p', 'img']
-        attrs = {
-            '*': ['class', 'style'],
-            'a': ['href', 'rel'],
-            'img': ['alt', 'src'],
-        }
-        styles = ['height', 'width']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, attributes=attrs, styles=styles, strip=True))
+        target.body_html = render(value, POST_POLICY)
+
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        UserCounters.change(connection, target.author_id, posts = 1)
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        connection.execute(TimelineEntry.__table__.delete().where(TimelineEntry.post_id == target.id))
+        UserCounters.change(connection, target.author_id, posts = -1)
+        TableVersion.bump(connection, 'posts')
+
+    @staticmethod
+    def visible():
+        '''Filter out posts hidden by a pending purge; NULL counts as visible.'''
+        return db.or_(Post.deleted == None, Post.deleted == False)
+
+    @staticmethod
+    def repair_comment_counts(post_ids = None):
+        counts = db.select([db.func.count(Comment.id)]).where(Comment.post_id == Post.id).as_scalar()
+        stmt = Post.__table__.update().values(comment_count = counts)
+        if post_ids is not None:
+            stmt = stmt.where(Post.id.in_(post_ids))
+        return db.session.execute(stmt).rowcount
+
+    def page_tags(self):
+        return ['index', 'post:%s' % self.id, 'user:%s' % self.author_id]
 
     def to_json(self):
         json_post = {
@@ -134,7 +349,7 @@ class Post(db.Model):
                 'timestamp': self.timestamp,
                 'author': url_for('api.get_user', id = self.author_id, _external = True),
                 'comments': url_for('api.get_post_comments', id = self.id, _external = True),
-                'comment_count': self.comments.count()
+                'comment_count': self.comment_count or 0
                 }
         return json_post
 
@@ -146,6 +361,8 @@ class Post(db.Model):
         return Post(body = body)
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post, 'after_insert', Post.on_insert)
+db.event.listen(Post, 'before_delete', Post.on_delete)
 
 
 class Comment(db.Model):
@@ -156,13 +373,44 @@ class Comment(db.Model):
     timestamp = db.Column(db.DateTime, index = True, default = datetime.utcnow)
     disable = db.Column(db.Boolean)
     disabled = db.Column(db.Boolean)
+    deleted = db.Column(db.Boolean, default = False)
+    updated_at = db.Column(PreciseDateTime, index = True, default = datetime.utcnow, onupdate = datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong']
-        target.body_html = bleach.linkify(bleach.clean(markdown(value, output_format = 'html'), tags = allowed_tags, strip = True))
+        target.body_html = render(value, COMMENT_POLICY)
+
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        Comment.change_comment_count(connection, target.post_id, 1)
+        UserCounters.change(connection, target.author_id, comments = 1)
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        Comment.change_comment_count(connection, target.post_id, -1)
+        UserCounters.change(connection, target.author_id, comments = -1)
+        TableVersion.bump(connection, 'comments')
+
+    @staticmethod
+    def visible():
+        return db.or_(Comment.deleted == None, Comment.deleted == False)
+
+    @staticmethod
+    def change_comment_count(connection, post_id, delta):
+        if post_id is None:
+            return
+        connection.execute(Post.__table__.update()
+                .where(Post.id == post_id)
+                .values(comment_count = db.func.coalesce(Post.comment_count, 0) + delta))
+
+    def page_tags(self):
+        # the post's comment count shows on the index and its author's page
+        tags = ['index', 'post:%s' % self.post_id]
+        if self.post is not None:
+            tags.append('user:%s' % self.post.author_id)
+        return tags
 
     def to_json(self):
         json_comment = {
@@ -183,6 +431,8 @@ class Comment(db.Model):
         return Comment(body = body)
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_insert)
+db.event.listen(Comment, 'after_delete', Comment.on_delete)
 
 
 
@@ -200,16 +450,85 @@ class User(UserMixin, db.Model):
     about_me = db.Column(db.String(1000))
     member_since = db.Column(db.DateTime(), default = datetime.utcnow)
     last_seen = db.Column(db.DateTime(), default = datetime.utcnow)
-    avatar_hash = db.Column(db.String(32))
+    avatar_hash = db.Column(db.String(32), index = True)
+    avatar_upload = db.Column(db.String(32))
     posts = db.relationship('Post', backref = 'author', lazy = 'dynamic')
     followed = db.relationship('Follow', foreign_keys = [Follow.follower_id], backref = db.backref('follower', lazy = 'joined'), lazy = 'dynamic', cascade = 'all, delete-orphan')
     followers = db.relationship('Follow', foreign_keys = [Follow.followed_id], backref = db.backref('followed', lazy = 'joined'), lazy = 'dynamic', cascade = 'all, delete-orphan')
     comments = db.relationship('Comment', backref = 'author', lazy = 'dynamic')
+    counters = db.relationship('UserCounters', uselist = False, passive_deletes = 'all')
     disabled = db.Column(db.Boolean, default = False)
+    celebrity = db.Column(db.Boolean, default = False, server_default = db.false(), index = True)
+    last_write_at = db.Column(db.DateTime)
+
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        connection.execute(UserCounters.__table__.insert(),
+                           user_id = target.id, posts = 0, followers = 0, following = 0, comments = 0)
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        connection.execute(UserCounters.__table__.delete().where(UserCounters.user_id == target.id))
+        connection.execute(Recommendation.__table__.delete().where(db.or_(
+                Recommendation.user_id == target.id, Recommendation.candidate_id == target.id)))
+
+    @staticmethod
+    def on_update(mapper, connection, target):
+        # drop now, and again after commit in case another request cached
+        # the old row in between
+        User.uncache(target.id)
+        db.object_session(target).info.setdefault('uncache_users', set()).add(target.id)
+
+    @staticmethod
+    def on_commit(session):
+        for id in session.info.pop('uncache_users', ()):
+            User.uncache(id)
+
+    def page_tags(self):
+        return ['user:%s' % self.id]
+
+    @staticmethod
+    def uncache(id):
+        user_cache.delete(id)
+        token_cache.delete_where(lambda token, cached: cached['user']['id'] == id)
+
+    def snapshot(self):
+        return {'user': snapshot(self),
+                'role': snapshot(self.role) if self.role is not None else None}
+
+    @staticmethod
+    def from_snapshot(cached):
+        role = detached(Role, cached['role']) if cached['role'] is not None else None
+        return db.session.merge(detached(User, cached['user'], role = role), load = False)
+
+    @property
+    def counts(self):
+        return self.counters or UserCounters.compute(self)
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
+        now = datetime.utcnow()
+        if self.last_seen is not None and \
+                (now - self.last_seen).total_seconds() < current_app.config['FLASKY_LAST_SEEN_THRESHOLD']:
+            return
+        # update the loaded value without dirtying the row; the buffer
+        # writes it later together with other users' pings
+        set_committed_value(self, 'last_seen', now)
+        if self.id is not None:
+            last_seen_buffer.record(self.id, now)
+
+    def record_write(self):
+        '''Remember that this API client just wrote, for ``wrote_recently``.'''
+        db.session.execute(User.__table__.update().where(User.id == self.id)
+                           .values(last_write_at = datetime.utcnow()))
+        db.session.commit()
+
+    def wrote_recently(self):
+        '''Whether this user wrote within FLASKY_DB_STICKY_SECONDS, read from
+        the primary since a lagging replica would not know yet.'''
+        with db.using_primary():
+            last = db.session.query(User.last_write_at).filter(User.id == self.id).scalar()
+        seconds = current_app.config['FLASKY_DB_STICKY_SECONDS']
+        return last is not None and last > datetime.utcnow() - timedelta(seconds = seconds)
 
     def gravatar(self, size = 100, default = 'identicon', rating = 'g'):
         if request.is_secure:
@@ -221,6 +540,18 @@ class User(UserMixin, db.Model):
                 url = url, hash = hash, size = size,default = default, rating = rating
                 )
 
+    def avatar(self, size = 40):
+        '''URL of the locally served avatar: the uploaded image if there is
+        one, else an identicon.'''
+        if self.avatar_upload:
+            hash = self.avatar_upload
+        else:
+            if self.avatar_hash is None and self.email is not None:
+                # remember it without dirtying the row
+                set_committed_value(self, 'avatar_hash', hashlib.md5(self.email.encode('utf-8')).hexdigest())
+            hash = self.avatar_hash
+        return url_for('main.avatar', hash = hash, size = size)
+
     def follow(self, user):
         if not self.is_following(user):
             f = Follow(follower = self, followed = user)
@@ -232,16 +563,40 @@ class User(UserMixin, db.Model):
             db.session.delete(f)
 
     def is_following(self, user):
-        print('is is_following user:', user)
         if user.id is None:
             return False
-        return self.followed.filter_by(followed_id = user.id).first() is not None
+        return self.following_state([user])[user.id]
+
+    def following_state(self, users):
+        '''Map each of ``users``' ids to whether this user follows them.
+
+        Answers are remembered for the rest of the request, and the ids not
+        looked up yet are fetched with one query.
+        '''
+        ids = set(user.id for user in users if user.id is not None)
+        state = follow_state()
+        missing = [id for id in ids if (self.id, id) not in state]
+        if missing and self.id is not None:
+            found = set(id for (id, ) in db.session.query(Follow.followed_id)
+                        .filter(Follow.follower_id == self.id, Follow.followed_id.in_(missing)))
+            for id in missing:
+                state[(self.id, id)] = id in found
+        return dict((id, state.get((self.id, id), False)) for id in ids)
 
     def is_followed_by(self, user):
         if user.id is None:
             return False
         return self.followers.filter_by(follower_id = user.id).first() is not None
 
+    def recommended(self, limit = 5):
+        '''Stored recommendations, minus accounts followed since they were
+        computed.'''
+        return User.query.join(Recommendation, Recommendation.candidate_id == User.id) \
+                .outerjoin(Follow, db.and_(Follow.follower_id == self.id, Follow.followed_id == User.id)) \
+                .filter(Recommendation.user_id == self.id, Follow.follower_id == None,
+                        db.or_(User.disabled == None, User.disabled == False)) \
+                .order_by(Recommendation.rank).limit(limit).all()
+
     @property
     def followed_posts(self):
         return Post.query.join(Follow, Follow.followed_id == Post.author_id).filter(Follow.follower_id == self.id)
@@ -328,7 +683,11 @@ class User(UserMixin, db.Model):
     __str__ = __repr__
 
     def can(self, perm):
-        return self.role is not None and self.role.has_permission(perm)
+        role = self.role
+        if role is None and self.id is None and self.role_id is None:
+            # not flushed yet, so not given a role yet
+            role = self.initial_role(User.initial_roles())
+        return role is not None and role.has_permission(perm)
 
     def is_administrator(self):
         return self.can(Permission.ADMIN)
@@ -339,12 +698,18 @@ class User(UserMixin, db.Model):
 
     @staticmethod
     def verify_auth_token(token):
+        cached = token_cache.get(token)
+        if cached is not None:
+            return User.from_snapshot(cached)
         s = Serializer(current_app.config['SECRET_KEY'])
         try:
-            data = s.loads(token)
+            data, header = s.loads(token, return_header = True)
         except:
             return None
-        return User.query.get(data['id'])
+        user = User.query.options(db.joinedload('role')).get(data['id'])
+        if user is not None and not user.disabled:
+            token_cache.set(token, user.snapshot(), expires = header['exp'])
+        return user
 
     def to_json(self):
         json_user = {
@@ -354,7 +719,7 @@ class User(UserMixin, db.Model):
                 'last_seen': self.last_seen,
                 'posts': url_for('api.get_user_posts', id = self.id, _external = True),
                 'followed_posts': url_for('api.get_user_followed_posts', id = self.id, _external = True),
-                'post_count': self.posts.count()
+                'post_count': self.counts.posts
                 }
         return json_user
 
@@ -362,14 +727,38 @@ class User(UserMixin, db.Model):
         super(User, self).__init__(**kwargs)
         if self.email is not None and self.avatar_hash is None:
             self.avatar_hash = hashlib.md5(self.email.encode('utf-8')).hexdigest()
-            db.session.add(self)
-            db.session.commit()
-        if self.role is None:
-            if self.email == current_app.config['FLASKY_ADMIN']:
-                self.role = Role.query.filter_by(name = 'Administrator').first()
-            if self.role is None:
-                self.role = Role.query.filter_by(default = True).first()
-        self.follow(self)
+
+    @staticmethod
+    def initial_roles():
+        return db.session.query(Role).filter(
+                db.or_(Role.default == True, Role.name == 'Administrator')).all()
+
+    def initial_role(self, roles):
+        if self.email == current_app.config['FLASKY_ADMIN']:
+            for role in roles:
+                if role.name == 'Administrator':
+                    return role
+        for role in roles:
+            if role.default:
+                return role
+
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        '''Give new users their role and self-follow, with one role query per flush.'''
+        users = [obj for obj in session.new if isinstance(obj, User)]
+        if not users:
+            return
+        follows = set(obj.follower for obj in session.new
+                      if isinstance(obj, Follow) and obj.follower is obj.followed)
+        roles = None
+        for user in users:
+            if user.role is None and user.role_id is None:
+                if roles is None:
+                    with session.no_autoflush:
+                        roles = User.initial_roles()
+                user.role = user.initial_role(roles)
+            if user not in follows:
+                session.add(Follow(follower = user, followed = user))
 
     @staticmethod
     def generate_fake(count = 100):
@@ -388,6 +777,17 @@ class User(UserMixin, db.Model):
                 db.session.rollback()
 
 
+db.event.listen(User, 'after_insert', User.on_insert)
+db.event.listen(User, 'before_delete', User.on_delete)
+db.event.listen(User, 'after_update', User.on_update)
+db.event.listen(User, 'after_delete', User.on_update)
+db.event.listen(db.session, 'after_commit', User.on_commit)
+db.event.listen(db.session, 'before_flush', User.before_flush)
+db.event.listen(db.session, 'after_flush', page_cache.on_flush)
+db.event.listen(db.session, 'after_commit', page_cache.on_commit)
+db.event.listen(db.session, 'after_rollback', page_cache.on_rollback)
+
+
 class AnonymousUser(AnonymousUserMixin):
     def can(self, permissions):
         return False
@@ -398,6 +798,28 @@ class AnonymousUser(AnonymousUserMixin):
 
 login_manager.anonymous_user = AnonymousUser
 
+class PurgeJob(db.Model):
+    '''Deletion of a user, or of all their posts or comments, run in the
+    background by ``app.purge``.'''
+    __tablename__ = 'purge_jobs'
+    KINDS = ('user', 'posts', 'comments')
+    id = db.Column(db.Integer, primary_key = True)
+    kind = db.Column(db.String(16))
+    user_id = db.Column(db.Integer, index = True)
+    username = db.Column(db.String(64))
+    requested_by_id = db.Column(db.Integer)
+    state = db.Column(db.String(16), default = 'pending', index = True)
+    stage = db.Column(db.String(32))
+    deleted = db.Column(db.Integer, default = 0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default = datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<PurgeJob %r %s of %r>' % (self.id, self.kind, self.username)
+
+
 class Alembic(db.Model):
     __tablename__ = 'alembic_version'
 
@@ -415,4 +837,11 @@ class Alembic(db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return User.from_snapshot(cached)
+    user = User.query.options(db.joinedload('role')).get(user_id)
+    if user is not None:
+        user_cache.set(user_id, user.snapshot())
+    return user
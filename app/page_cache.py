@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from functools import wraps
+from itertools import chain
+from flask import current_app, request, session, g, make_response
+from flask_login import current_user
+from .cache import TTLCache
+
+
+class PageCache(TTLCache):
+    '''Whole rendered pages for anonymous GET requests.
+
+    Entries are keyed by endpoint, view and query arguments and
+    FLASKY_PAGE_CACHE_VERSION, and carry the tags the view registered with
+    ``tag()``. Models name the tags a change touches in ``page_tags()``;
+    those are evicted once the session commits. A TTL of 0 turns the cache
+    off.
+    '''
+
+    def __init__(self, maxsize = 500, ttl = 30, max_bytes = 256 * 1024):
+        TTLCache.__init__(self, 'FLASKY_PAGE_CACHE', maxsize, ttl)
+        self.max_bytes = max_bytes
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_PAGE_CACHE_MAX_BYTES', self.max_bytes)
+        app.config.setdefault('FLASKY_PAGE_CACHE_VERSION', 1)
+        TTLCache.init_app(self, app)
+        self.max_bytes = app.config['FLASKY_PAGE_CACHE_MAX_BYTES']
+
+    def cacheable(self):
+        return (self.ttl > 0 and request.method == 'GET'
+                and '_flashes' not in session and not current_user.is_authenticated)
+
+    def key(self):
+        return (current_app.config['FLASKY_PAGE_CACHE_VERSION'], request.endpoint,
+                tuple(sorted((request.view_args or {}).items())),
+                tuple(sorted(request.args.items(multi = True))))
+
+    def tag(self, *tags):
+        '''Mark the page being rendered as depending on ``tags``.'''
+        if 'page_cache_tags' in g:
+            g.page_cache_tags.update(tags)
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.cacheable():
+                return view(*args, **kwargs)
+            key = self.key()
+            entry = self.get(key)
+            if entry is not None:
+                body, status, headers, tags = entry
+                return current_app.response_class(body, status = status, headers = headers)
+            g.page_cache_tags = set()
+            response = make_response(view(*args, **kwargs))
+            tags = frozenset(g.pop('page_cache_tags'))
+            if (response.status_code == 200 and not response.direct_passthrough
+                    and not session.modified and 'Set-Cookie' not in response.headers):
+                body = response.get_data()
+                if len(body) <= self.max_bytes:
+                    self.set(key, (body, response.status_code, list(response.headers), tags))
+            return response
+        return wrapper
+
+    def evict(self, *tags):
+        tags = frozenset(tags)
+        return self.delete_where(lambda key, entry: not tags.isdisjoint(entry[3]))
+
+    def on_flush(self, session, flush_context):
+        # new/dirty/deleted still hold what was just flushed
+        tags = session.info.setdefault('page_tags', set())
+        for obj in chain(session.new, session.dirty, session.deleted):
+            if hasattr(obj, 'page_tags'):
+                tags.update(obj.page_tags())
+
+    def on_commit(self, session):
+        tags = session.info.pop('page_tags', None)
+        if tags:
+            self.evict(*tags)
+
+    def on_rollback(self, session):
+        session.info.pop('page_tags', None)
+
+
+page_cache = PageCache()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import base64
+from datetime import datetime
+from flask import abort, url_for
+from flask_sqlalchemy import Pagination
+from sqlalchemy import and_, or_
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(direction, timestamp, id):
+    raw = '%s|%s|%d' % (direction, timestamp.strftime(TIMESTAMP_FORMAT), id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        direction, timestamp, id = raw.split('|')
+        if direction not in ('next', 'prev'):
+            return None
+        return direction, datetime.strptime(timestamp, TIMESTAMP_FORMAT), int(id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        return None
+
+
+class KeysetPagination(object):
+    is_keyset = True
+
+    def __init__(self, items, per_page, next_cursor, prev_cursor):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def parse_cursor(cursor, error_out = True):
+    if not cursor:
+        return None
+    start = decode_cursor(cursor)
+    if start is None and error_out:
+        abort(404)
+    return start
+
+
+def keyset_filter(query, start, timestamp_column, id_column):
+    direction = start[0] if start else 'next'
+    if start is not None:
+        timestamp, id = start[1], start[2]
+        if direction == 'next':
+            query = query.filter(or_(timestamp_column < timestamp,
+                                     and_(timestamp_column == timestamp, id_column < id)))
+        else:
+            query = query.filter(or_(timestamp_column > timestamp,
+                                     and_(timestamp_column == timestamp, id_column > id)))
+    if direction == 'next':
+        return query.order_by(timestamp_column.desc(), id_column.desc())
+    return query.order_by(timestamp_column.asc(), id_column.asc())
+
+
+def keyset_page(items, start, per_page):
+    '''Build a page from up to ``per_page + 1`` rows fetched in cursor order.'''
+    direction = start[0] if start else 'next'
+    more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+    # Coming from a cursor means there is at least one row on the side we
+    # came from, so that link is offered without an extra query.
+    has_next = more if direction == 'next' else start is not None
+    has_prev = start is not None if direction == 'next' else more
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = encode_cursor('next', items[-1].timestamp, items[-1].id)
+    if items and has_prev:
+        prev_cursor = encode_cursor('prev', items[0].timestamp, items[0].id)
+    return KeysetPagination(items, per_page, next_cursor, prev_cursor)
+
+
+def keyset_paginate(query, model, cursor = None, per_page = 20, error_out = True):
+    '''Paginate ``query`` newest first on ``(model.timestamp, model.id)``.
+
+    Unlike ``Query.paginate`` this never issues OFFSET or COUNT(*): each page
+    is a range scan starting right after the row the cursor points at.
+    '''
+    start = parse_cursor(cursor, error_out)
+    items = keyset_filter(query, start, model.timestamp, model.id).limit(per_page + 1).all()
+    return keyset_page(items, start, per_page)
+
+
+def cursor_links(pagination, endpoint, **kwargs):
+    prev = next = None
+    if pagination.has_prev:
+        prev = url_for(endpoint, cursor = pagination.prev_cursor, **kwargs)
+    if pagination.has_next:
+        next = url_for(endpoint, cursor = pagination.next_cursor, **kwargs)
+    return {
+        'prev': prev,
+        'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor
+        }
+
+
+def counted_paginate(query, page, per_page, total):
+    '''Like ``Query.paginate`` but with a known ``total`` instead of COUNT(*).'''
+    page = max(page, 1)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    return Pagination(query, page, per_page, total, items)
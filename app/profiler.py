@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from flask import current_app, request
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s|:\w+|\?")
+LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+SPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    '''``statement`` with literals and placeholders replaced by ``?`` and
+    IN lists of any length collapsed, so equivalent queries group together.'''
+    statement = LITERAL_RE.sub('?', SPACE_RE.sub(' ', statement).strip())
+    return LIST_RE.sub('(...)', statement)
+
+
+class QueryStats(object):
+    def __init__(self, samples):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.durations = deque(maxlen = samples)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.durations.append(duration)
+
+    @property
+    def p95(self):
+        durations = sorted(self.durations)
+        return durations[int(len(durations) * 0.95)] if durations else 0.0
+
+
+class QueryProfiler(object):
+    '''Times the SQL of a FLASKY_QUERY_SAMPLE_RATE fraction of requests.
+
+    Statements are grouped per endpoint and fingerprint with count, total,
+    max and p95 time, the p95 taken over the last FLASKY_QUERY_PROFILE_SAMPLES
+    runs. Sampled statements slower than FLASKY_SLOW_DB_QUERY_TIME are also
+    logged. Requests that are not sampled only pay for one thread-local
+    lookup per statement.
+    '''
+
+    def __init__(self, app = None):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.requests = self.dropped = 0
+        self.fingerprints = {}
+        self.started = datetime.utcnow()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_QUERY_SAMPLE_RATE', 0.01)
+        app.config.setdefault('FLASKY_QUERY_PROFILE_KEYS', 2000)
+        app.config.setdefault('FLASKY_QUERY_PROFILE_SAMPLES', 200)
+        app.config.setdefault('FLASKY_SLOW_DB_QUERY_TIME', 0.5)
+        app.before_request(self.start)
+        app.teardown_request(self.finish)
+        if not event.contains(Engine, 'before_cursor_execute', self.before_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_execute)
+        self.reset()
+
+    def start(self):
+        rate = current_app.config['FLASKY_QUERY_SAMPLE_RATE']
+        self.local.queries = [] if rate > 0 and random.random() < rate else None
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self.local, 'queries', None) is not None:
+            self.local.start = time.time()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        queries = getattr(self.local, 'queries', None)
+        if queries is not None:
+            queries.append((statement, time.time() - self.local.start))
+
+    def finish(self, exc = None):
+        queries, self.local.queries = getattr(self.local, 'queries', None), None
+        if queries is None:
+            return
+        endpoint = request.endpoint or request.path
+        config = current_app.config
+        slow = config['FLASKY_SLOW_DB_QUERY_TIME']
+        for statement, duration in queries:
+            if duration >= slow:
+                current_app.logger.warning('Slow query: %s\nDuration: %fs\nEndpoint: %s\n' % (statement, duration, endpoint))
+        max_keys = config['FLASKY_QUERY_PROFILE_KEYS']
+        samples = config['FLASKY_QUERY_PROFILE_SAMPLES']
+        with self.lock:
+            self.requests += 1
+            for statement, duration in queries:
+                sql = self.fingerprints.get(statement)
+                if sql is None:
+                    sql = fingerprint(statement)
+                    if len(self.fingerprints) < max_keys:
+                        self.fingerprints[statement] = sql
+                key = (endpoint, sql)
+                stats = self.stats.get(key)
+                if stats is None:
+                    if len(self.stats) >= max_keys:
+                        self.dropped += 1
+                        continue
+                    stats = self.stats[key] = QueryStats(samples)
+                stats.add(duration)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.fingerprints = {}
+            self.requests = self.dropped = 0
+            self.started = datetime.utcnow()
+
+    def report(self, limit = 100):
+        '''Aggregates sorted by total time, slowest first.'''
+        with self.lock:
+            rows = [{
+                'endpoint': endpoint,
+                'fingerprint': sql,
+                'count': stats.count,
+                'total': stats.total,
+                'mean': stats.total / stats.count,
+                'max': stats.max,
+                'p95': stats.p95
+                } for (endpoint, sql), stats in self.stats.items()]
+            summary = {
+                'sample_rate': current_app.config['FLASKY_QUERY_SAMPLE_RATE'],
+                'sampled_requests': self.requests,
+                'dropped': self.dropped,
+                'since': self.started
+                }
+        rows.sort(key = lambda row: row['total'], reverse = True)
+        summary['queries'] = rows[:limit]
+        return summary
+
+
+query_profiler = QueryProfiler()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import threading
+import traceback
+from datetime import datetime
+from flask import current_app
+from . import db, page_cache
+from .models import User, Post, Comment, Follow, TimelineEntry, UserCounters, PurgeJob, \
+        Recommendation, RecommendationQueue, TableVersion
+from .search import remove_documents
+
+users = User.__table__
+posts = Post.__table__
+comments = Comment.__table__
+follows = Follow.__table__
+timelines = TimelineEntry.__table__
+counters = UserCounters.__table__
+recommendations = Recommendation.__table__
+
+
+def request_purge(kind, user, requested_by):
+    '''Hide the user's content right away and queue the actual deletion.
+
+    Hiding is one UPDATE per table on the author's index, bounded by the
+    request time so the worker never deletes anything written later.
+    '''
+    requested_at = datetime.utcnow()
+    if kind in ('user', 'posts'):
+        db.session.execute(posts.update().where(db.and_(
+                posts.c.author_id == user.id, posts.c.timestamp <= requested_at)).values(deleted = True))
+    if kind in ('user', 'comments'):
+        db.session.execute(comments.update().where(db.and_(
+                comments.c.author_id == user.id, comments.c.timestamp <= requested_at)).values(deleted = True))
+    if kind == 'user':
+        user.disabled = True
+        db.session.add(user)
+    job = PurgeJob(kind = kind, user_id = user.id, username = user.username,
+                   requested_by_id = requested_by.id, created_at = requested_at)
+    db.session.add(job)
+    db.session.commit()
+    # the bulk updates above bypass the page cache's model hooks
+    page_cache.clear()
+    purge_worker.wake()
+    return job
+
+
+def id_chunks(column, condition):
+    '''Yield up to FLASKY_PURGE_CHUNK_SIZE matching values at a time. The
+    caller deletes each chunk before asking for the next one.'''
+    size = current_app.config['FLASKY_PURGE_CHUNK_SIZE']
+    while True:
+        ids = [id for (id, ) in db.session.execute(
+                db.select([column]).where(condition).limit(size))]
+        if not ids:
+            return
+        yield ids
+
+
+def progress(job, stage, deleted):
+    job.stage = stage
+    job.deleted += deleted
+    db.session.commit()
+
+
+def purge_posts(job, condition):
+    for ids in id_chunks(posts.c.id, condition):
+        for comment_ids in id_chunks(comments.c.id, comments.c.post_id.in_(ids)):
+            authors = [id for (id, ) in db.session.execute(
+                    db.select([comments.c.author_id]).where(comments.c.id.in_(comment_ids)).distinct())]
+            deleted = db.session.execute(comments.delete().where(comments.c.id.in_(comment_ids))).rowcount
+            TableVersion.bump(db.session.connection(), 'comments')
+            remove_documents(db.session.connection(), 'comment', comment_ids)
+            UserCounters.repair(authors)
+            progress(job, 'comments on posts', deleted)
+        db.session.execute(timelines.delete().where(timelines.c.post_id.in_(ids)))
+        deleted = db.session.execute(posts.delete().where(posts.c.id.in_(ids))).rowcount
+        TableVersion.bump(db.session.connection(), 'posts')
+        remove_documents(db.session.connection(), 'post', ids)
+        progress(job, 'posts', deleted)
+
+
+def purge_comments(job, condition):
+    for ids in id_chunks(comments.c.id, condition):
+        post_ids = [id for (id, ) in db.session.execute(
+                db.select([comments.c.post_id]).where(comments.c.id.in_(ids)).distinct())]
+        deleted = db.session.execute(comments.delete().where(comments.c.id.in_(ids))).rowcount
+        TableVersion.bump(db.session.connection(), 'comments')
+        remove_documents(db.session.connection(), 'comment', ids)
+        Post.repair_comment_counts(post_ids)
+        progress(job, 'comments', deleted)
+
+
+def purge_follows(job, column, other):
+    for ids in id_chunks(other, column == job.user_id):
+        deleted = db.session.execute(follows.delete().where(
+                db.and_(column == job.user_id, other.in_(ids)))).rowcount
+        UserCounters.repair([id for id in ids if id != job.user_id])
+        RecommendationQueue.mark(db.session.connection(), [id for id in ids if id != job.user_id])
+        progress(job, 'follows', deleted)
+
+
+def run_job(job):
+    user_id = job.user_id
+    if job.kind == 'comments':
+        purge_comments(job, db.and_(comments.c.author_id == user_id, comments.c.deleted == True))
+    elif job.kind == 'posts':
+        purge_posts(job, db.and_(posts.c.author_id == user_id, posts.c.deleted == True))
+    else:
+        purge_posts(job, posts.c.author_id == user_id)
+        purge_comments(job, comments.c.author_id == user_id)
+        purge_follows(job, follows.c.follower_id, follows.c.followed_id)
+        purge_follows(job, follows.c.followed_id, follows.c.follower_id)
+        for ids in id_chunks(timelines.c.post_id, timelines.c.user_id == user_id):
+            db.session.execute(timelines.delete().where(
+                    db.and_(timelines.c.user_id == user_id, timelines.c.post_id.in_(ids))))
+            progress(job, 'timeline', 0)
+        db.session.execute(counters.delete().where(counters.c.user_id == user_id))
+        db.session.execute(recommendations.delete().where(db.or_(
+                recommendations.c.user_id == user_id, recommendations.c.candidate_id == user_id)))
+        deleted = db.session.execute(users.delete().where(users.c.id == user_id)).rowcount
+        User.uncache(user_id)
+        progress(job, 'user', deleted)
+        return
+    UserCounters.repair([user_id])
+
+
+def claim():
+    '''Take the oldest pending job, safely against other workers.'''
+    for job in PurgeJob.query.filter_by(state = 'pending').order_by(PurgeJob.id).limit(10):
+        claimed = db.session.execute(PurgeJob.__table__.update()
+                .where(db.and_(PurgeJob.id == job.id, PurgeJob.state == 'pending'))
+                .values(state = 'running', started_at = datetime.utcnow())).rowcount
+        db.session.commit()
+        if claimed:
+            return job
+    return None
+
+
+def run_pending():
+    done = 0
+    while True:
+        job = claim()
+        if job is None:
+            return done
+        try:
+            run_job(job)
+        except Exception:
+            db.session.rollback()
+            job.state = 'failed'
+            job.error = traceback.format_exc()
+            current_app.logger.exception('Purge job %d failed', job.id)
+        else:
+            job.state = 'done'
+            job.stage = None
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        done += 1
+
+
+class PurgeWorker(object):
+    '''Background thread that runs queued purge jobs.
+
+    It wakes when a job is requested and every FLASKY_PURGE_INTERVAL seconds
+    otherwise, so jobs left over from a restart get picked up. An interval of
+    0 runs jobs in the requesting thread instead.
+    '''
+
+    def __init__(self, app = None):
+        self.app = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_PURGE_INTERVAL', 30)
+        app.config.setdefault('FLASKY_PURGE_CHUNK_SIZE', 1000)
+        self.app = app
+
+    def wake(self):
+        if self.app.config['FLASKY_PURGE_INTERVAL'] <= 0:
+            run_pending()
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target = self.run, name = 'purge-worker')
+                self.thread.daemon = True
+                self.thread.start()
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.clear()
+            try:
+                with self.app.app_context():
+                    run_pending()
+            except Exception:
+                self.app.logger.exception('Purge worker failed')
+            self.event.wait(self.app.config['FLASKY_PURGE_INTERVAL'])
+
+
+purge_worker = PurgeWorker()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import heapq
+from array import array
+from collections import Counter
+from flask import current_app
+from . import db
+from .models import User, Follow, Recommendation, RecommendationQueue
+
+users = User.__table__
+follows = Follow.__table__
+recommendations = Recommendation.__table__
+queue = RecommendationQueue.__table__
+
+
+class FollowGraph(object):
+    '''The follow graph in compressed sparse row form.
+
+    Users are numbered in id order; the accounts user ``i`` follows are
+    ``indices[indptr[i]:indptr[i + 1]]``. Both are ``array('l')``, so a few
+    million follows take tens of megabytes rather than a dict of sets.
+    Self-follows are left out.
+    '''
+
+    def __init__(self, ids, indptr, indices, index = None):
+        self.ids = ids
+        self.indptr = indptr
+        self.indices = indices
+        self.index = index if index is not None else dict((id, i) for i, id in enumerate(ids))
+
+    @classmethod
+    def load(cls, chunk_size = 100000):
+        ids = array('l', (id for (id, ) in db.session.execute(db.select([users.c.id]).order_by(users.c.id))))
+        index = dict((id, i) for i, id in enumerate(ids))
+        indptr = array('l', [0])
+        indices = array('l')
+        last = (0, 0)
+        while True:
+            rows = db.session.execute(db.select([follows.c.follower_id, follows.c.followed_id])
+                    .where(db.or_(follows.c.follower_id > last[0],
+                                  db.and_(follows.c.follower_id == last[0], follows.c.followed_id > last[1])))
+                    .order_by(follows.c.follower_id, follows.c.followed_id).limit(chunk_size)).fetchall()
+            if not rows:
+                break
+            for follower_id, followed_id in rows:
+                i, j = index.get(follower_id), index.get(followed_id)
+                if i is None or j is None or i == j:
+                    continue
+                # rows arrive by follower, so row i starts where the edges end
+                while len(indptr) <= i:
+                    indptr.append(len(indices))
+                indices.append(j)
+            last = tuple(rows[-1])
+        while len(indptr) <= len(ids):
+            indptr.append(len(indices))
+        return cls(ids, indptr, indices, index)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def neighbours(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def degree(self, i):
+        return self.indptr[i + 1] - self.indptr[i]
+
+    def transpose(self):
+        '''The graph of followers, by counting sort.'''
+        n = len(self.ids)
+        indptr = array('l', [0]) * (n + 1)
+        for j in self.indices:
+            indptr[j + 1] += 1
+        for i in range(n):
+            indptr[i + 1] += indptr[i]
+        indices = array('l', [0]) * len(self.indices)
+        fill = array('l', indptr)
+        for i in range(n):
+            for j in self.neighbours(i):
+                indices[fill[j]] = i
+                fill[j] += 1
+        return FollowGraph(self.ids, indptr, indices, self.index)
+
+    def recommend(self, i, limit, max_degree, followers):
+        '''Top ``limit`` accounts followed by the accounts ``i`` follows, as
+        (index, score) pairs.
+
+        The score is the number of two-hop paths; ties go to the account with
+        more followers. Accounts following more than ``max_degree`` others
+        say little about any one of them and would dominate the cost, so
+        their follows are not counted.
+        '''
+        followed = self.neighbours(i)
+        scores = Counter()
+        for v in followed:
+            if self.degree(v) <= max_degree:
+                scores.update(self.neighbours(v))
+        scores.pop(i, None)
+        for v in followed:
+            scores.pop(v, None)
+        best = heapq.nlargest(limit, scores, key = lambda w: (scores[w], followers.degree(w), -w))
+        return [(w, scores[w]) for w in best]
+
+
+def write(graph, reverse, chunk):
+    config = current_app.config
+    rows = []
+    for i in chunk:
+        for rank, (w, score) in enumerate(graph.recommend(i, config['FLASKY_RECOMMEND_COUNT'],
+                                                          config['FLASKY_RECOMMEND_MAX_DEGREE'], reverse)):
+            rows.append({'user_id': graph.ids[i], 'rank': rank, 'candidate_id': graph.ids[w], 'score': score})
+    db.session.execute(recommendations.delete().where(
+            recommendations.c.user_id.in_([graph.ids[i] for i in chunk])))
+    if rows:
+        db.session.execute(recommendations.insert(), rows)
+
+
+def refresh(full = False, chunk_size = 1000, report = print):
+    '''Recompute stored recommendations and return how many users were done.
+
+    Without ``full`` only users in the queue and their followers are
+    recomputed: a changed follow alters the two-hop neighbourhood of the
+    follower and of everyone following them, and nobody else's.
+    '''
+    last = db.session.query(db.func.max(RecommendationQueue.id)).scalar() or 0
+    if not full:
+        dirty = [id for (id, ) in db.session.query(RecommendationQueue.user_id)
+                 .filter(RecommendationQueue.id <= last).distinct()]
+        if not dirty:
+            return 0
+    graph = FollowGraph.load()
+    reverse = graph.transpose()
+    report('loaded %d users, %d follows' % (len(graph), len(graph.indices)))
+    if full:
+        todo = range(len(graph))
+    else:
+        todo = set()
+        for id in dirty:
+            i = graph.index.get(id)
+            if i is not None:
+                todo.add(i)
+                todo.update(reverse.neighbours(i))
+        todo = sorted(todo)
+    for start in range(0, len(todo), chunk_size):
+        write(graph, reverse, todo[start:start + chunk_size])
+        db.session.commit()
+        report('recommendations: %d/%d users' % (min(start + chunk_size, len(todo)), len(todo)))
+    db.session.execute(queue.delete().where(queue.c.id <= last))
+    db.session.commit()
+    return len(todo)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import hashlib
+import threading
+from collections import OrderedDict
+from markdown import Markdown
+from bleach.sanitizer import Cleaner, ALLOWED_ATTRIBUTES
+from bleach.linkifier import Linker
+
+
+class Policy(object):
+    '''An allow-list for rendered bodies.
+
+    Bump ``version`` whenever the lists change so cached renders made under
+    the old rules stop matching.
+    '''
+
+    def __init__(self, name, version, tags, attributes = ALLOWED_ATTRIBUTES, styles = ()):
+        self.name = name
+        self.version = version
+        self.key = '%s:%d' % (name, version)
+        self.tags = list(tags)
+        self.attributes = attributes
+        self.styles = list(styles)
+
+
+POST_POLICY = Policy('post', 1,
+        tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                'h1', 'h2', 'h3', 'p', 'img'],
+        attributes = {
+            '*': ['class', 'style'],
+            'a': ['href', 'rel'],
+            'img': ['alt', 'src'],
+            },
+        styles = ['height', 'width'])
+
+COMMENT_POLICY = Policy('comment', 1,
+        tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong'])
+
+POLICIES = dict((policy.name, policy) for policy in (POST_POLICY, COMMENT_POLICY))
+
+
+class RenderCache(object):
+    '''LRU of rendered HTML keyed by a hash of the policy and the source.
+
+    Eviction is by the total size of the cached HTML, FLASKY_RENDER_CACHE_SIZE
+    bytes.
+    '''
+
+    def __init__(self, max_bytes = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_RENDER_CACHE_SIZE', self.max_bytes)
+        self.max_bytes = app.config['FLASKY_RENDER_CACHE_SIZE']
+        self.clear()
+
+    @staticmethod
+    def key(policy, text):
+        return hashlib.sha1((policy.key + '\0' + text).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def set(self, key, html):
+        size = len(html)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = html
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last = False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+            }
+
+
+render_cache = RenderCache()
+
+# Markdown, Cleaner and Linker instances keep parser state between calls, so
+# each thread gets its own set, built once.
+_local = threading.local()
+
+
+def _renderers(policy):
+    renderers = getattr(_local, 'renderers', None)
+    if renderers is None:
+        renderers = _local.renderers = {}
+    if policy.key not in renderers:
+        renderers[policy.key] = (
+                Markdown(output_format = 'html'),
+                Cleaner(tags = policy.tags, attributes = policy.attributes,
+                        styles = policy.styles, strip = True),
+                Linker())
+    return renderers[policy.key]
+
+
+def render_uncached(text, policy):
+    md, cleaner, linker = _renderers(policy)
+    return linker.linkify(cleaner.clean(md.reset().convert(text)))
+
+
+def render(text, policy):
+    if text is None:
+        return None
+    key = render_cache.key(policy, text)
+    html = render_cache.get(key)
+    if html is None:
+        html = render_uncached(text, policy)
+        render_cache.set(key, html)
+    return html
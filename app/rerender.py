@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import json
+import os
+import time
+from multiprocessing import Pool, cpu_count
+from . import db
+from .models import Post, Comment
+from .rendering import POLICIES, render
+
+TABLES = {
+    'posts': (Post.__table__, 'post'),
+    'comments': (Comment.__table__, 'comment'),
+}
+
+
+def render_rows(job):
+    '''Pool worker: return ``(id, body, body_html)`` for rows whose output
+    changed, ``body`` being the text it was rendered from.'''
+    policy_name, rows = job
+    policy = POLICIES[policy_name]
+    changed = []
+    for id, body, body_html in rows:
+        html = render(body, policy)
+        if html != body_html:
+            changed.append((id, body, html))
+    return changed
+
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(tmp, path)
+
+
+def fetch_chunk(table, after_id, chunk_size):
+    return db.session.execute(
+            db.select([table.c.id, table.c.body, table.c.body_html])
+            .where(table.c.id > after_id)
+            .order_by(table.c.id)
+            .limit(chunk_size)).fetchall()
+
+
+def rerender_table(name, chunk_size = 1000, workers = None, start_id = 0,
+                   dry_run = False, checkpoint_path = None, checkpoint = None, report = print):
+    '''Re-render ``body_html`` for every row of ``name`` in id order.
+
+    Each chunk is split across a process pool while the next chunk is being
+    read, and changed rows are written back with one executemany UPDATE per
+    chunk. The UPDATE also matches the body that was rendered, so a row
+    edited in the meantime keeps the HTML its edit produced. The last
+    committed id is stored in ``checkpoint_path`` so an interrupted run can
+    resume. A dry run writes and commits nothing.
+    '''
+    table, policy_name = TABLES[name]
+    workers = workers or cpu_count()
+    checkpoint = checkpoint if checkpoint is not None else {}
+    stmt = table.update().where(db.and_(table.c.id == db.bindparam('_id'),
+                                        table.c.body == db.bindparam('_body'))) \
+            .values(body_html = db.bindparam('_body_html'))
+    scanned = updated = 0
+    started = time.time()
+    pool = Pool(workers)
+    try:
+        rows = fetch_chunk(table, start_id, chunk_size)
+        while rows:
+            slice_size = max(1, len(rows) // workers + 1)
+            jobs = [(policy_name, [tuple(row) for row in rows[i:i + slice_size]])
+                    for i in range(0, len(rows), slice_size)]
+            pending = pool.map_async(render_rows, jobs)
+            last_id = rows[-1][0]
+            next_rows = fetch_chunk(table, last_id, chunk_size)
+            changed = [item for result in pending.get() for item in result]
+            if dry_run:
+                updated += len(changed)
+            else:
+                if changed:
+                    updated += db.session.execute(stmt, [{'_id': id, '_body': body, '_body_html': html}
+                                                         for id, body, html in changed]).rowcount
+                db.session.commit()
+                if checkpoint_path:
+                    checkpoint[name] = last_id
+                    save_checkpoint(checkpoint_path, checkpoint)
+            scanned += len(rows)
+            elapsed = max(time.time() - started, 1e-6)
+            report('%s: up to id %d, %d scanned, %d %s, %.0f rows/s' % (
+                name, last_id, scanned, updated,
+                'would change' if dry_run else 'updated', scanned / elapsed))
+            rows = next_rows
+    finally:
+        pool.close()
+        pool.join()
+    return scanned, updated
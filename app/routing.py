@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, session as http_session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+
+
+class RoutingSession(SignallingSession):
+    '''Reads from a replica when ``db.reads_from_replica()`` says so.
+
+    Flushes and core INSERT/UPDATE/DELETE go to the primary, and once the
+    session has written, so do its reads until the transaction ends.
+    '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper = None, clause = None):
+        if mapper is not None and mapper.mapped_table.info.get('bind_key') is not None:
+            return SignallingSession.get_bind(self, mapper, clause)
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif not self.info.get('wrote') and self.db.reads_from_replica():
+            if 'replica' not in self.info:
+                self.info['replica'] = self.db.replica(self.app)
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class PoolStats(object):
+    def __init__(self):
+        self.checkouts = 0
+        self.wait = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, wait):
+        with self.lock:
+            self.checkouts += 1
+            self.wait += wait
+
+
+class TimedPool(object):
+    '''Mixed in front of an engine's pool class to time checkouts.'''
+
+    stats = None
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            return super(TimedPool, self)._do_get()
+        finally:
+            self.stats.add(time.time() - started)
+
+
+def ping(dbapi_connection, connection_record, connection_proxy):
+    # DisconnectionError makes the pool retry with a fresh connection
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''Flask-SQLAlchemy with read replicas and instrumented pools.
+
+    The URIs in FLASKY_DB_REPLICAS become the ``replica_<n>`` binds. Reads
+    made while handling GET and HEAD requests go to one of them, picked
+    round-robin per session; everything else goes to the primary. After a
+    request commits a write, its client reads from the primary for
+    FLASKY_DB_STICKY_SECONDS, tracked in the session cookie, or for API
+    users in ``users.last_write_at`` on the primary, so it sees its own
+    writes despite replication lag whichever worker serves the next
+    request. Views that write in a GET use ``primary_required``;
+    ``using_primary()`` and ``using_replica()`` force either side for a
+    block of code.
+
+    Pools are sized by the SQLALCHEMY_POOL_* settings where the pool class
+    takes them, test connections on checkout when FLASKY_DB_PRE_PING is
+    set, and count checkouts and the time spent waiting for them per
+    database in ``pool_stats()``.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.routing = threading.local()
+        self.pools = {}
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def create_session(self, options):
+        maker = orm.sessionmaker(class_ = RoutingSession, db = self, **options)
+        event.listen(maker, 'after_commit', self.on_commit)
+        event.listen(maker, 'after_rollback', self.on_rollback)
+        return maker
+
+    def init_app(self, app):
+        app.config.setdefault('FLASKY_DB_REPLICAS', [])
+        app.config.setdefault('FLASKY_DB_STICKY_SECONDS', 10)
+        app.config.setdefault('FLASKY_DB_PRE_PING', False)
+        replicas = ['replica_%d' % i for i in range(len(app.config['FLASKY_DB_REPLICAS']))]
+        if replicas:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.update(zip(replicas, app.config['FLASKY_DB_REPLICAS']))
+            app.config['SQLALCHEMY_BINDS'] = binds
+        SQLAlchemy.init_app(self, app)
+        state = app.extensions['sqlalchemy']
+        state.replicas = replicas
+        state.next_replica = itertools.count()
+        app.before_request(self.check_sticky)
+        app.after_request(self.set_sticky)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        pool_class = options.get('poolclass') or info.get_dialect().get_pool_class(info)
+        if not issubclass(pool_class, QueuePool):
+            # NullPool and friends refuse the sizing arguments
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(key, None)
+        stats = self.pools.setdefault('%s/%s' % (info.host or '', info.database or ''), PoolStats())
+        options['poolclass'] = type('Timed' + pool_class.__name__, (TimedPool, pool_class), {'stats': stats})
+        if app.config['FLASKY_DB_PRE_PING']:
+            event.listen(options['poolclass'], 'checkout', ping)
+
+    def replica(self, app):
+        state = app.extensions['sqlalchemy']
+        if not state.replicas:
+            return None
+        bind = state.replicas[next(state.next_replica) % len(state.replicas)]
+        return self.get_engine(app, bind = bind)
+
+    def reads_from_replica(self):
+        target = getattr(self.routing, 'target', None)
+        if target is not None:
+            return target == 'replica'
+        return (has_request_context() and request.method in ('GET', 'HEAD')
+                and not g.get('db_primary', False))
+
+    @contextmanager
+    def using(self, target):
+        previous = getattr(self.routing, 'target', None)
+        self.routing.target = target
+        try:
+            yield
+        finally:
+            self.routing.target = previous
+
+    def using_primary(self):
+        return self.using('primary')
+
+    def using_replica(self):
+        return self.using('replica')
+
+    def check_sticky(self):
+        # set both flags: g outlives the request under a pushed app context
+        g.db_primary = http_session.get('_db_primary_until', 0) > time.time()
+        g.db_wrote = False
+
+    def set_sticky(self, response):
+        if g.get('db_wrote', False):
+            seconds = self.get_app().config['FLASKY_DB_STICKY_SECONDS']
+            http_session['_db_primary_until'] = time.time() + seconds
+        return response
+
+    def on_commit(self, session):
+        session.info.pop('replica', None)
+        if session.info.pop('wrote', False) and has_request_context():
+            g.db_wrote = g.db_primary = True
+
+    def on_rollback(self, session):
+        session.info.pop('replica', None)
+        session.info.pop('wrote', None)
+
+    def pool_stats(self):
+        '''Checkouts and seconds spent waiting for them, per database.'''
+        return dict((name, {'checkouts': stats.checkouts, 'wait_seconds': stats.wait})
+                    for name, stats in list(self.pools.items()))
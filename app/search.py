@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import base64
+import math
+import re
+from collections import Counter
+from flask import current_app
+from sqlalchemy import DDL
+from . import db
+from .models import Post, Comment, SearchDocument, SearchPosting
+
+documents = SearchDocument.__table__
+postings = SearchPosting.__table__
+MODELS = {'post': Post, 'comment': Comment}
+CREATE_FTS = 'CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(terms)'
+CREATE_FULLTEXT = 'ALTER TABLE search_documents ADD FULLTEXT INDEX ft_search_documents_terms (terms)'
+
+TAG_RE = re.compile(r'<[^>]*>')
+WORD_RE = re.compile(u'[0-9a-z]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+
+
+def is_cjk(word):
+    return word[0] > u'\u3000'
+
+
+def tokenize(text):
+    '''Lower-cased words, with runs of CJK characters split into bigrams
+    since they are not separated by spaces.'''
+    for word in WORD_RE.findall(TAG_RE.sub(' ', text or '').lower()):
+        if is_cjk(word) and len(word) > 1:
+            for i in range(len(word) - 1):
+                yield word[i:i + 2]
+        elif len(word) <= 64:
+            yield word
+
+
+def doc_type(obj):
+    return 'post' if isinstance(obj, Post) else 'comment'
+
+
+class BuiltinBackend(object):
+    '''Inverted index in ``search_postings``, ranked by TF-IDF over the
+    documents' lengths. Works on any database.'''
+
+    def setup(self, connection):
+        pass
+
+    def clear(self, connection):
+        connection.execute(postings.delete())
+
+    def add(self, connection, docs):
+        rows = [{'term': term, 'doc_type': type, 'doc_id': id, 'tf': tf}
+                for type, id, terms in docs for term, tf in Counter(terms).items()]
+        if rows:
+            connection.execute(postings.insert(), rows)
+
+    def remove(self, connection, doc_type, ids):
+        connection.execute(postings.delete().where(db.and_(
+            postings.c.doc_type == doc_type, postings.c.doc_id.in_(ids))))
+
+    def scored(self, terms):
+        total = db.session.query(db.func.count()).select_from(documents).scalar() or 1
+        df = dict(db.session.query(SearchPosting.term, db.func.count())
+                  .filter(SearchPosting.term.in_(terms)).group_by(SearchPosting.term))
+        if not df:
+            return None
+        weight = db.case([(postings.c.term == term, math.log(1.0 + total / count))
+                          for term, count in df.items()], else_ = 0)
+        score = db.type_coerce(db.func.sum(postings.c.tf * weight) / db.func.max(documents.c.length), db.Float)
+        return db.select([postings.c.doc_type, postings.c.doc_id, score.label('score')]) \
+                .select_from(postings.join(documents, db.and_(
+                    documents.c.doc_type == postings.c.doc_type,
+                    documents.c.doc_id == postings.c.doc_id))) \
+                .where(postings.c.term.in_(list(df))) \
+                .group_by(postings.c.doc_type, postings.c.doc_id)
+
+
+class SQLiteBackend(BuiltinBackend):
+    '''SQLite FTS5 table ranked with bm25(). Its rowid encodes the document,
+    twice the id plus one for comments.'''
+
+    def rowid(self, doc_type, id):
+        return id * 2 + (doc_type == 'comment')
+
+    def setup(self, connection):
+        connection.execute(CREATE_FTS)
+
+    def clear(self, connection):
+        connection.execute('DELETE FROM search_fts')
+
+    def add(self, connection, docs):
+        if docs:
+            connection.execute(db.text('INSERT INTO search_fts (rowid, terms) VALUES (:rowid, :terms)'),
+                               [{'rowid': self.rowid(type, id), 'terms': ' '.join(terms)}
+                                for type, id, terms in docs])
+
+    def remove(self, connection, doc_type, ids):
+        connection.execute(db.text('DELETE FROM search_fts WHERE rowid = :rowid'),
+                           [{'rowid': self.rowid(doc_type, id)} for id in ids])
+
+    def scored(self, terms):
+        match = ' OR '.join('"%s"' % term for term in set(terms))
+        return db.text("SELECT CASE rowid % 2 WHEN 1 THEN 'comment' ELSE 'post' END AS doc_type, "
+                      "rowid / 2 AS doc_id, -bm25(search_fts) AS score "
+                      "FROM search_fts WHERE search_fts MATCH :match") \
+                .bindparams(match = match) \
+                .columns(doc_type = db.String, doc_id = db.Integer, score = db.Float)
+
+
+class MySQLBackend(BuiltinBackend):
+    '''InnoDB FULLTEXT index on ``search_documents.terms``. CJK bigrams need
+    innodb_ft_min_token_size = 2 on the server.'''
+
+    def setup(self, connection):
+        exists = connection.execute("SHOW INDEX FROM search_documents "
+                                    "WHERE Key_name = 'ft_search_documents_terms'").first()
+        if exists is None:
+            connection.execute(CREATE_FULLTEXT)
+
+    def clear(self, connection):
+        pass
+
+    def add(self, connection, docs):
+        pass
+
+    def remove(self, connection, doc_type, ids):
+        pass
+
+    def scored(self, terms):
+        # boolean mode without operators matches any of the words
+        score = db.type_coerce(documents.c.terms.match(' '.join(set(terms))), db.Float)
+        return db.select([documents.c.doc_type, documents.c.doc_id, score.label('score')]) \
+                .where(score)
+
+
+# created along with search_documents, so a fresh database can be searched
+# before its first reindex; reindex still adds them to older databases
+db.event.listen(documents, 'after_create', DDL(CREATE_FTS).execute_if(dialect = 'sqlite'))
+db.event.listen(documents, 'before_drop', DDL('DROP TABLE IF EXISTS search_fts').execute_if(dialect = 'sqlite'))
+db.event.listen(documents, 'after_create', DDL(CREATE_FULLTEXT).execute_if(dialect = 'mysql'))
+
+
+BACKENDS = {
+    'builtin': BuiltinBackend,
+    'sqlite': SQLiteBackend,
+    'mysql': MySQLBackend,
+}
+
+
+def backend():
+    name = current_app.config.get('FLASKY_SEARCH_BACKEND')
+    return BACKENDS[name]() if name else None
+
+
+def index_documents(connection, objs):
+    '''Write ``search_documents`` and the backend index for flushed rows.'''
+    search = backend()
+    if search is None:
+        return
+    docs = [(doc_type(obj), obj.id, list(tokenize(obj.body))) for obj in objs]
+    for type in MODELS:
+        remove_documents(connection, type, [id for t, id, terms in docs if t == type], search)
+    write_documents(connection, docs, search)
+
+
+def write_documents(connection, docs, search):
+    connection.execute(documents.insert(), [
+        {'doc_type': type, 'doc_id': id, 'terms': ' '.join(terms), 'length': max(len(terms), 1)}
+        for type, id, terms in docs])
+    search.add(connection, docs)
+
+
+def remove_documents(connection, doc_type, ids, search = None):
+    search = search or backend()
+    if search is None or not ids:
+        return
+    connection.execute(documents.delete().where(db.and_(
+        documents.c.doc_type == doc_type, documents.c.doc_id.in_(ids))))
+    search.remove(connection, doc_type, ids)
+
+
+def on_changed_body(target, value, oldvalue, initiator):
+    target._search_dirty = True
+
+
+def after_flush(session, flush_context):
+    changed = [obj for obj in session.new.union(session.dirty)
+               if isinstance(obj, (Post, Comment)) and obj.__dict__.pop('_search_dirty', False)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, (Post, Comment))]
+    if not changed and not deleted:
+        return
+    connection = session.connection()
+    for type in MODELS:
+        remove_documents(connection, type, [obj.id for obj in deleted if doc_type(obj) == type])
+    if changed:
+        index_documents(connection, changed)
+
+db.event.listen(Post.body, 'set', on_changed_body)
+db.event.listen(Comment.body, 'set', on_changed_body)
+db.event.listen(db.session, 'after_flush', after_flush)
+
+
+def encode_cursor(score, doc_type, doc_id):
+    return base64.urlsafe_b64encode(('%r|%s|%d' % (float(score), doc_type, doc_id)).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        score, doc_type, doc_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return float(score), doc_type, int(doc_id)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+class SearchResults(object):
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def search(query, cursor = None, per_page = 20):
+    '''Rank posts and comments matching any word of ``query``.
+
+    Results are ordered by (score desc, type, id) and the cursor is the last
+    row of the previous page. ``items`` holds ``(score, obj)`` pairs; deleted
+    and disabled rows are filtered out in the query, before the limit.
+    '''
+    terms = list(tokenize(query))
+    search = backend()
+    scored = search.scored(terms) if terms and search is not None else None
+    if scored is None:
+        return SearchResults([], None)
+    scored = scored.alias('scored')
+    posts, comments = Post.__table__, Comment.__table__
+    def visible(table, type):
+        return db.and_(scored.c.doc_type == type, table.c.id == scored.c.doc_id,
+                       db.or_(table.c.deleted == None, table.c.deleted == False),
+                       db.or_(table.c.disabled == None, table.c.disabled == False))
+    stmt = db.select([scored.c.doc_type, scored.c.doc_id, scored.c.score]) \
+            .select_from(scored.outerjoin(posts, visible(posts, 'post'))
+                         .outerjoin(comments, visible(comments, 'comment'))) \
+            .where(db.or_(posts.c.id != None, comments.c.id != None))
+    start = decode_cursor(cursor) if cursor else None
+    if start is not None:
+        score, type, id = start
+        stmt = stmt.where(db.or_(
+            scored.c.score < score,
+            db.and_(scored.c.score == score, db.or_(
+                scored.c.doc_type > type,
+                db.and_(scored.c.doc_type == type, scored.c.doc_id > id)))))
+    rows = db.session.execute(stmt.order_by(scored.c.score.desc(), scored.c.doc_type, scored.c.doc_id)
+                              .limit(per_page + 1)).fetchall()
+    rows, more = rows[:per_page], len(rows) > per_page
+    next_cursor = encode_cursor(rows[-1].score, rows[-1].doc_type, rows[-1].doc_id) if more else None
+    loaded = {}
+    for type, model in MODELS.items():
+        ids = [id for t, id, score in rows if t == type]
+        if ids:
+            for obj in model.query.options(db.joinedload('author')).filter(model.id.in_(ids)):
+                loaded[type, obj.id] = obj
+    items = []
+    for type, id, score in rows:
+        obj = loaded.get((type, id))
+        if obj is not None:
+            items.append((score, obj))
+    return SearchResults(items, next_cursor)
+
+
+def reindex(chunk_size = 1000, report = print):
+    '''Rebuild the whole index from the posts and comments tables.'''
+    search = backend()
+    connection = db.session.connection()
+    search.setup(connection)
+    search.clear(connection)
+    connection.execute(documents.delete())
+    db.session.commit()
+    total = 0
+    for type, model in MODELS.items():
+        table = model.__table__
+        last_id = 0
+        while True:
+            rows = db.session.execute(db.select([table.c.id, table.c.body])
+                                      .where(table.c.id > last_id)
+                                      .order_by(table.c.id).limit(chunk_size)).fetchall()
+            if not rows:
+                break
+            write_documents(db.session.connection(),
+                            [(type, id, list(tokenize(body))) for id, body in rows], search)
+            db.session.commit()
+            last_id = rows[-1][0]
+            total += len(rows)
+            report('%s: indexed up to id %d' % (type, last_id))
+    return total
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from flask import current_app
+from . import db
+from .models import User, Post, Follow, TimelineEntry
+from .pagination import parse_cursor, keyset_filter, keyset_page
+
+timelines = TimelineEntry.__table__
+TIMELINE_COLUMNS = ['user_id', 'post_id', 'author_id', 'timestamp']
+
+
+def push_post(post):
+    '''Copy a freshly flushed post into the timeline of every follower.
+
+    Authors with more followers than FLASKY_TIMELINE_FANOUT_LIMIT are marked
+    as celebrities instead; their posts are pulled in when a timeline is read.
+    The insert is the only write; timelines that grow past
+    FLASKY_TIMELINE_LENGTH are cut back by ``trim_overflowing``.
+    '''
+    author = post.author
+    if not author.celebrity and author.counts.followers > current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']:
+        author.celebrity = True
+        db.session.add(author)
+    if author.celebrity:
+        return
+    followers = db.select([Follow.follower_id, db.literal(post.id), db.literal(author.id),
+                           db.literal(post.timestamp)]).where(Follow.followed_id == author.id)
+    db.session.execute(timelines.insert().from_select(TIMELINE_COLUMNS, followers))
+
+
+def backfill(follower, followed):
+    if followed.celebrity or follower.id == followed.id:
+        return
+    posts = db.select([db.literal(follower.id), Post.id, Post.author_id, Post.timestamp]) \
+            .where(Post.author_id == followed.id) \
+            .order_by(Post.timestamp.desc()) \
+            .limit(current_app.config['FLASKY_TIMELINE_LENGTH'])
+    db.session.execute(timelines.insert().from_select(TIMELINE_COLUMNS, posts))
+    trim(follower.id)
+
+
+def remove_author(follower, followed):
+    db.session.execute(timelines.delete().where(db.and_(
+        TimelineEntry.user_id == follower.id, TimelineEntry.author_id == followed.id)))
+
+
+def trim(user_id):
+    cutoff = db.session.query(TimelineEntry.timestamp, TimelineEntry.post_id) \
+            .filter(TimelineEntry.user_id == user_id) \
+            .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()) \
+            .offset(current_app.config['FLASKY_TIMELINE_LENGTH']).first()
+    if cutoff is None:
+        return
+    db.session.execute(timelines.delete().where(db.and_(
+        TimelineEntry.user_id == user_id,
+        db.or_(TimelineEntry.timestamp < cutoff.timestamp,
+               db.and_(TimelineEntry.timestamp == cutoff.timestamp,
+                       TimelineEntry.post_id <= cutoff.post_id)))))
+
+
+def trim_overflowing(batch = 100, report = print):
+    '''Trim every timeline longer than FLASKY_TIMELINE_LENGTH, committing
+    every ``batch`` users; run periodically with ``manage.py trim_timelines``.
+    Reads tolerate longer timelines, so lagging behind is harmless.'''
+    user_ids = [id for (id, ) in db.session.query(TimelineEntry.user_id)
+                .group_by(TimelineEntry.user_id)
+                .having(db.func.count() > current_app.config['FLASKY_TIMELINE_LENGTH'])]
+    for i, user_id in enumerate(user_ids, 1):
+        trim(user_id)
+        if i % batch == 0:
+            db.session.commit()
+            report('timelines trimmed: %d' % i)
+    db.session.commit()
+    return len(user_ids)
+
+
+def rebuild(user):
+    db.session.execute(timelines.delete().where(TimelineEntry.user_id == user.id))
+    posts = db.select([db.literal(user.id), Post.id, Post.author_id, Post.timestamp]) \
+            .select_from(Post.__table__.join(Follow.__table__, Follow.followed_id == Post.author_id)
+                         .join(User.__table__, User.id == Post.author_id)) \
+            .where(db.and_(Follow.follower_id == user.id, db.or_(User.celebrity == None, User.celebrity == False))) \
+            .order_by(Post.timestamp.desc()) \
+            .limit(current_app.config['FLASKY_TIMELINE_LENGTH'])
+    db.session.execute(timelines.insert().from_select(TIMELINE_COLUMNS, posts))
+
+
+def timeline_paginate(user, cursor = None, per_page = 20, error_out = True):
+    '''Page through ``user``'s followed posts from the materialized timeline.
+
+    Rows pushed at write time are merged with the latest posts of followed
+    celebrities, each side being an index range scan of ``per_page + 1`` rows.
+    Reading past the end of a full (trimmed) timeline falls back to the
+    ``followed_posts`` join.
+    '''
+    start = parse_cursor(cursor, error_out)
+    limit = per_page + 1
+    pushed = Post.query.options(db.joinedload('author')) \
+            .join(TimelineEntry, TimelineEntry.post_id == Post.id) \
+            .filter(TimelineEntry.user_id == user.id, Post.visible())
+    items = keyset_filter(pushed, start, TimelineEntry.timestamp, TimelineEntry.post_id).limit(limit).all()
+    if len(items) < limit and is_full(user):
+        followed = user.followed_posts.filter(Post.visible()).options(db.joinedload('author'))
+        items = keyset_filter(followed, start, Post.timestamp, Post.id).limit(limit).all()
+        return keyset_page(items, start, per_page)
+    celebrities = db.session.query(Follow.followed_id).join(User, User.id == Follow.followed_id) \
+            .filter(Follow.follower_id == user.id, User.celebrity == True).subquery()
+    pulled = Post.query.options(db.joinedload('author')).filter(Post.author_id.in_(celebrities), Post.visible())
+    items.extend(post for post in keyset_filter(pulled, start, Post.timestamp, Post.id).limit(limit)
+                 if post not in items)
+    items.sort(key = lambda post: (post.timestamp, post.id), reverse = start is None or start[0] == 'next')
+    return keyset_page(items[:limit], start, per_page)
+
+
+def is_full(user):
+    length = current_app.config['FLASKY_TIMELINE_LENGTH']
+    return db.session.query(TimelineEntry.post_id).filter(TimelineEntry.user_id == user.id) \
+            .limit(length).from_self().count() >= length
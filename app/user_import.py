@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import csv
+import json
+import time
+from itertools import islice
+from . import db
+from .models import User
+
+FIELDS = ('email', 'username', 'password', 'password_hash', 'confirmed',
+          'name', 'location', 'about_me')
+
+
+def read_rows(path, format = None):
+    '''Yield one dict per account from a CSV file with a header row or from
+    newline-delimited JSON; ``format`` defaults to the file extension.'''
+    format = format or ('csv' if path.endswith('.csv') else 'ndjson')
+    with open(path, encoding = 'utf-8') as f:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def to_user(row):
+    fields = dict((key, row[key]) for key in FIELDS if row.get(key) not in (None, ''))
+    if 'email' not in fields or 'username' not in fields:
+        raise ValueError('email and username are required')
+    if isinstance(fields.get('confirmed'), str):
+        fields['confirmed'] = fields['confirmed'].lower() in ('1', 'true', 'yes', 'on')
+    if 'password' not in fields and 'password_hash' not in fields:
+        raise ValueError('password or password_hash is required')
+    return User(**fields)
+
+
+def import_users(rows, batch_size = 1000, report = print):
+    '''Create accounts ``batch_size`` per transaction.
+
+    Rows whose email or username already exists, in the database or earlier
+    in the input, are skipped. Returns ``(created, skipped)``.
+    '''
+    rows = iter(rows)
+    created = skipped = 0
+    seen = set()
+    started = time.time()
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        users = []
+        for row in batch:
+            try:
+                user = to_user(row)
+            except ValueError as e:
+                report('skipped %r: %s' % (row.get('email'), e))
+                skipped += 1
+                continue
+            keys = ('email', user.email.lower()), ('username', user.username.lower())
+            if seen.intersection(keys):
+                skipped += 1
+                continue
+            seen.update(keys)
+            users.append(user)
+        taken = set()
+        if users:
+            existing = db.session.query(User.email, User.username).filter(db.or_(
+                    User.email.in_([u.email for u in users]),
+                    User.username.in_([u.username for u in users])))
+            for email, username in existing:
+                taken.update((('email', email.lower()), ('username', username.lower())))
+        fresh = [u for u in users
+                 if ('email', u.email.lower()) not in taken and ('username', u.username.lower()) not in taken]
+        skipped += len(users) - len(fresh)
+        db.session.add_all(fresh)
+        db.session.commit()
+        created += len(fresh)
+        report('%d created, %d skipped, %.0f users/s' % (
+            created, skipped, created / max(time.time() - started, 1e-6)))
+    return created, skipped
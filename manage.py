@@ -90,6 +90,145 @@ def deploy():
     User.add_self_follow()
 
 
+@manager.command
+def rebuild_timelines(batch = 100):
+    from app import timeline
+    user_ids = [id for (id, ) in db.session.query(User.id).order_by(User.id)]
+    for i, user_id in enumerate(user_ids, 1):
+        timeline.rebuild(User.query.get(user_id))
+        if i % int(batch) == 0:
+            db.session.commit()
+            print('timelines rebuilt:', i)
+    db.session.commit()
+    print('timelines rebuilt:', len(user_ids))
+
+@manager.command
+def trim_timelines(batch = 100):
+    from app import timeline
+    print('timelines trimmed:', timeline.trim_overflowing(batch = int(batch)))
+
+@manager.command
+def repair_comment_counts(chunk = 10000):
+    chunk = int(chunk)
+    last_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+    for start in range(0, last_id, chunk):
+        ids = [id for (id, ) in db.session.query(Post.id).filter(Post.id > start, Post.id <= start + chunk)]
+        if ids:
+            Post.repair_comment_counts(ids)
+        db.session.commit()
+        print('comment counts repaired up to post id:', min(start + chunk, last_id))
+
+@manager.command
+def repair_counters(chunk = 10000):
+    from app.models import UserCounters
+    chunk = int(chunk)
+    last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+    for start in range(0, last_id, chunk):
+        ids = [id for (id, ) in db.session.query(User.id).filter(User.id > start, User.id <= start + chunk)]
+        if ids:
+            UserCounters.repair(ids)
+        db.session.commit()
+        print('user counters repaired up to user id:', min(start + chunk, last_id))
+
+@manager.option('-t', '--table', dest = 'table', default = 'all', help = 'posts, comments or all')
+@manager.option('-c', '--chunk-size', dest = 'chunk_size', type = int, default = 1000)
+@manager.option('-w', '--workers', dest = 'workers', type = int, default = 0, help = 'defaults to the CPU count')
+@manager.option('--checkpoint', dest = 'checkpoint', default = 'rerender-checkpoint.json')
+@manager.option('--resume', dest = 'resume', action = 'store_true', default = False)
+@manager.option('--dry-run', dest = 'dry_run', action = 'store_true', default = False)
+def rerender(table, chunk_size, workers, checkpoint, resume, dry_run):
+    from app.rerender import TABLES, rerender_table, load_checkpoint
+    names = sorted(TABLES) if table == 'all' else [table]
+    progress = load_checkpoint(checkpoint) if resume else {}
+    for name in names:
+        scanned, updated = rerender_table(name, chunk_size = chunk_size, workers = workers,
+                                          start_id = progress.get(name, 0), dry_run = dry_run,
+                                          checkpoint_path = checkpoint, checkpoint = progress)
+        print('%s done: %d rows scanned, %d %s' % (name, scanned, updated, 'would change' if dry_run else 'updated'))
+
+@manager.command
+def build_static():
+    from app.assets import assets
+    print('static files built:', assets.build())
+
+@manager.command
+def reindex(chunk = 1000):
+    from app.search import reindex
+    print('documents indexed:', reindex(chunk_size = int(chunk)))
+
+@manager.option('--full', dest = 'full', action = 'store_true', default = False,
+                help = 'recompute every user instead of the queued ones')
+@manager.option('-c', '--chunk-size', dest = 'chunk_size', type = int, default = 1000)
+def recommend(full, chunk_size):
+    from app.recommend import refresh
+    print('users recomputed:', refresh(full = full, chunk_size = chunk_size))
+
+@manager.option('--retry', dest = 'retry', action = 'store_true', default = False,
+                help = 'requeue failed and interrupted jobs; only while no worker is running')
+def purge(retry):
+    from app.models import PurgeJob
+    from app.purge import run_pending
+    if retry:
+        PurgeJob.query.filter(PurgeJob.state.in_(['failed', 'running'])) \
+                .update({'state': 'pending', 'error': None}, synchronize_session = False)
+        db.session.commit()
+    print('purge jobs run:', run_pending())
+
+@manager.option('path', help = 'CSV with a header row, or newline-delimited JSON')
+@manager.option('-f', '--format', dest = 'format', default = None, help = 'csv or ndjson, defaults to the file extension')
+@manager.option('-b', '--batch-size', dest = 'batch_size', type = int, default = 1000)
+def import_users(path, format, batch_size):
+    from app import user_import
+    created, skipped = user_import.import_users(user_import.read_rows(path, format),
+                                                batch_size = batch_size)
+    print('done: %d users created, %d skipped' % (created, skipped))
+
+@manager.option('-u', '--users', dest = 'users', type = int, default = 1000)
+@manager.option('-p', '--posts', dest = 'posts', type = int, default = 10000)
+@manager.option('-c', '--comments', dest = 'comments', type = int, default = 20000)
+@manager.option('-a', '--alpha', dest = 'alpha', type = float, default = 1.2, help = 'Pareto shape of follower counts and posting activity')
+@manager.option('--days', dest = 'days', type = int, default = 365)
+@manager.option('--chunk-size', dest = 'chunk_size', type = int, default = 5000)
+@manager.option('--seed', dest = 'seed', type = int, default = None)
+@manager.option('--no-timelines', dest = 'timelines', action = 'store_false', default = True)
+def fake(users, posts, comments, alpha, days, chunk_size, seed, timelines):
+    from app.fake import Generator
+    generator = Generator(alpha = alpha, days = days, chunk_size = chunk_size, seed = seed)
+    generator.run(users = users, posts = posts, comments = comments)
+    if timelines:
+        rebuild_timelines()
+
+@manager.option('-u', '--users', dest = 'users', type = int, default = 500)
+@manager.option('-p', '--posts', dest = 'posts', type = int, default = 5000)
+@manager.option('-c', '--comments', dest = 'comments', type = int, default = 10000)
+@manager.option('-n', '--requests', dest = 'requests', type = int, default = 50, help = 'timed requests per endpoint')
+@manager.option('--warmup', dest = 'warmup', type = int, default = 5)
+@manager.option('--seed', dest = 'seed', type = int, default = 1)
+@manager.option('--database', dest = 'database', default = 'sqlite://', help = 'scratch database, dropped and recreated')
+@manager.option('--baseline', dest = 'baseline', default = 'bench.json')
+@manager.option('--save', dest = 'save', action = 'store_true', default = False, help = 'write the results as the new baseline')
+@manager.option('--threshold', dest = 'threshold', type = float, default = 0.25, help = 'allowed relative p50 growth')
+@manager.option('--memory-threshold', dest = 'memory_threshold', type = float, default = 0.5)
+def bench(users, posts, comments, requests, warmup, seed, database, baseline, save, threshold, memory_threshold):
+    import json, sys
+    from app.bench import Bench, compare
+    results = Bench(database = database, users = users, posts = posts, comments = comments,
+                    requests = requests, warmup = warmup, seed = seed).run()
+    problems = []
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            problems = compare(results, json.load(f), threshold = threshold, memory_threshold = memory_threshold)
+    else:
+        problems = compare(results, {})
+    for problem in problems:
+        print('REGRESSION', problem)
+    if save:
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+        print('baseline written to', baseline)
+    if problems:
+        sys.exit(1)
+
 @manager.command
 def test(coverage = False):
     if coverage and not os.environ.get('FLASK_COVERAGE'):
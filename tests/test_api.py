@@ -1,6 +1,7 @@
 import unittest
 import json
 import re
+import time
 from base64 import b64encode
 from app import create_app, db
 from app.models import User, Role, Post, Comment
@@ -262,3 +263,71 @@ class APITestCase(unittest.TestCase):
         json_response = json.loads(response.get_data(as_text=True))
         self.assertIsNotNone(json_response.get('comments'))
         self.assertEqual(json_response.get('count', 0), 2)
+
+    def test_conditional_get(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True, role=r)
+        post = Post(body='body of the post', author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        for url in ('/api/v1.0/posts/', '/api/v1.0/posts/{}'.format(post.id),
+                    '/api/v1.0/users/{}/posts'.format(u.id),
+                    '/api/v1.0/posts/{}/comments'.format(post.id)):
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+            self.assertEqual(response.headers['ETag'], etag)
+
+        url = '/api/v1.0/posts/{}'.format(post.id)
+        response = self.client.get(url, headers=headers)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        response = self.client.get(url, headers=dict(headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status_code, 304)
+
+        # a new comment changes the post's comment count
+        db.session.add(Comment(body='a comment', author=u, post=post))
+        db.session.commit()
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['comment_count'], 1)
+
+        response = self.client.get('/api/v1.0/users/{}'.format(u.id), headers=headers)
+        etag = response.headers['ETag']
+        u.username = 'johnny'
+        db.session.commit()
+        response = self.client.get('/api/v1.0/users/{}'.format(u.id),
+                                   headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_get_after_delete(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True, role=r)
+        post = Post(body='body of the post', author=u)
+        old = Comment(body='old comment', author=u, post=post)
+        db.session.add_all([u, post, old])
+        db.session.commit()
+        db.session.add(Comment(body='new comment', author=u, post=post))
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        url = '/api/v1.0/posts/{}/comments'.format(post.id)
+        response = self.client.get(url, headers=headers)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        # removing an older comment moves neither max(id) nor max(updated_at)
+        time.sleep(1)
+        db.session.delete(old)
+        db.session.commit()
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, headers=dict(headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,81 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from flask import url_for
+from app import create_app, assets
+
+
+class StaticAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app('testing')
+        self.app.config['FLASKY_STATIC_BUILD_DIR'] = self.directory
+        self.app.config['FLASKY_STATIC_BLUEPRINTS'] = ()
+        assets.load(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        with open(os.path.join(self.app.static_folder, 'styles.css'), 'rb') as f:
+            self.css = f.read()
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def url(self, filename):
+        with self.app.test_request_context():
+            return url_for('static', filename=filename)
+
+    def test_unbuilt_files_are_served_as_before(self):
+        self.assertEqual(self.url('styles.css'), '/static/styles.css')
+        response = self.client.get('/static/styles.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+
+    def test_build_and_serve(self):
+        self.assertEqual(assets.build(report=lambda message: None), 2)
+        with open(os.path.join(self.directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertIn('gzip', manifest['static']['styles.css']['encodings'])
+        url = self.url('styles.css')
+        self.assertRegex(url, r'^/static/styles\.[0-9a-f]{12}\.css$')
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        self.assertEqual(gzip.decompress(response.get_data()), self.css)
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(), self.css)
+        response = self.client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # the original name still works for anything that hard-codes it
+        self.assertEqual(self.client.get('/static/styles.css').status_code, 200)
+        self.assertEqual(self.client.get('/static/styles.0123456789ab.css').status_code, 404)
+
+    def test_rebuild_is_stable(self):
+        assets.build(report=lambda message: None)
+        first = self.url('styles.css')
+        assets.build(report=lambda message: None)
+        self.assertEqual(self.url('styles.css'), first)
+
+    def test_manifest_is_per_app(self):
+        assets.build(report=lambda message: None)
+        other = create_app('testing')
+        other.config['FLASKY_STATIC_BUILD_DIR'] = tempfile.mkdtemp()
+        try:
+            assets.load(other)
+            self.assertRegex(self.url('styles.css'), r'^/static/styles\.[0-9a-f]{12}\.css$')
+            with other.test_request_context():
+                self.assertEqual(url_for('static', filename='styles.css'), '/static/styles.css')
+        finally:
+            shutil.rmtree(other.config['FLASKY_STATIC_BUILD_DIR'])
@@ -0,0 +1,97 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from app import create_app, db, avatars
+from app.models import User, Role
+
+
+class AvatarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app('testing')
+        self.app.config['FLASKY_AVATAR_DIR'] = self.directory
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def decode(self, data):
+        self.assertEqual(data[:8], b'\x89PNG\r\n\x1a\n')
+        width, height = struct.unpack('>II', data[16:24])
+        idat = data.index(b'IDAT')
+        length = struct.unpack('>I', data[idat - 4:idat])[0]
+        raw = zlib.decompress(data[idat + 4:idat + 4 + length])
+        stride = width * 3 + 1
+        return width, height, [raw[y * stride + 1:(y + 1) * stride] for y in range(height)]
+
+    def test_identicon(self):
+        hash = self.user.avatar_hash
+        data = avatars.identicon(hash, 36)
+        self.assertEqual(data, avatars.identicon(hash, 36))
+        self.assertNotEqual(data, avatars.identicon('0' * 32, 36))
+        width, height, rows = self.decode(data)
+        self.assertEqual((width, height), (36, 36))
+        for row in rows:
+            pixels = [row[x:x + 3] for x in range(0, len(row), 3)]
+            self.assertEqual(pixels, pixels[::-1])
+        self.assertEqual(self.decode(avatars.identicon(hash, 18))[:2], (18, 18))
+
+    def test_avatar_url(self):
+        with self.app.test_request_context():
+            self.assertEqual(self.user.avatar(32), '/avatar/%s/32' % self.user.avatar_hash)
+            self.user.avatar_upload = 'f' * 32
+            self.assertEqual(self.user.avatar(32), '/avatar/%s/32' % ('f' * 32))
+
+    def test_route(self):
+        url = '/avatar/%s/40' % self.user.avatar_hash
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=', response.headers['Cache-Control'])
+        self.assertTrue(os.path.exists(avatars.cache_path(self.user.avatar_hash, 40)))
+        etag = response.headers['ETag']
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.client.get('/avatar/%s/41' % self.user.avatar_hash).status_code, 404)
+        self.assertEqual(self.client.get('/avatar/../../etc/40').status_code, 404)
+        self.assertEqual(self.client.get('/avatar/%s/40' % ('g' * 32)).status_code, 404)
+
+    def test_unknown_hashes_are_not_cached(self):
+        hash = 'a' * 32
+        response = self.client.get('/avatar/%s/40' % hash)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), avatars.identicon(hash, 40))
+        self.assertFalse(os.path.exists(avatars.cache_path(hash, 40)))
+
+    def test_upload(self):
+        if avatars.Image is None:
+            self.skipTest('needs Pillow')
+        image = io.BytesIO()
+        avatars.Image.new('RGB', (300, 200), (255, 0, 0)).save(image, 'PNG')
+        image.seek(0)
+        self.client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        response = self.client.post('/edit-profile', data={
+            'name': '', 'location': '', 'about_me': '', 'avatar': (image, 'me.png')})
+        self.assertEqual(response.status_code, 302)
+        user = User.query.filter_by(username='john').first()
+        self.assertIsNotNone(user.avatar_upload)
+        response = self.client.get('/avatar/%s/32' % user.avatar_upload)
+        width, height, rows = self.decode(response.get_data())
+        self.assertEqual((width, height), (32, 32))
+        self.assertEqual(rows[16][:3], b'\xff\x00\x00')
@@ -0,0 +1,24 @@
+import copy
+import unittest
+from app.bench import Bench, compare
+
+
+class BenchTestCase(unittest.TestCase):
+    def test_bench(self):
+        results = Bench(users=20, posts=100, comments=200, requests=2, warmup=1,
+                        report=lambda message: None).run()
+        endpoints = results['endpoints']
+        self.assertIn('main.index followed', endpoints)
+        self.assertIn('api.get_post_comments', endpoints)
+        for name, result in endpoints.items():
+            self.assertEqual(result['status'], result['expected_status'], name)
+            self.assertGreater(result['queries'], 0, name)
+        self.assertEqual(compare(results, results), [])
+
+        slower = copy.deepcopy(results)
+        index = slower['endpoints']['main.index']
+        index['queries'] += 1
+        index['p50_ms'] = index['p50_ms'] * 2 + 10
+        problems = compare(slower, results)
+        self.assertEqual(len(problems), 2)
+        self.assertTrue(all(problem.startswith('main.index:') for problem in problems))
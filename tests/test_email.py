@@ -0,0 +1,54 @@
+import smtplib
+import unittest
+from flask_mail import Message
+from app import create_app, mail
+from app.email import email_queue, is_transient
+from .smtp_sink import SMTPSink
+
+
+class EmailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sink = SMTPSink()
+        self.app = create_app('testing')
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=self.sink.port,
+                               MAIL_USE_SSL=False, MAIL_SUPPRESS_SEND=False,
+                               MAIL_USERNAME=None, MAIL_PASSWORD=None,
+                               FLASKY_MAIL_WORKERS=1, FLASKY_MAIL_BATCH_SIZE=10,
+                               FLASKY_MAIL_RETRY_DELAY=0)
+        mail.init_app(self.app)
+        email_queue.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        email_queue.drain()
+        self.app_context.pop()
+        self.sink.stop()
+
+    def message(self, i):
+        return Message('hello %d' % i, sender='flasky@example.com',
+                       recipients=['user%d@example.com' % i], body='hi')
+
+    def test_batches_share_a_connection(self):
+        sent = email_queue.sent
+        for i in range(5):
+            self.assertTrue(email_queue.send(self.message(i)))
+        self.assertTrue(email_queue.drain())
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertLess(self.sink.connections, 5)
+        self.assertEqual(email_queue.sent, sent + 5)
+        self.assertEqual(email_queue.stats()['depth'], 0)
+
+    def test_transient_failures_are_retried(self):
+        retried = email_queue.retried
+        self.sink.failures = 2
+        email_queue.send(self.message(1))
+        self.assertTrue(email_queue.drain())
+        self.assertEqual(len(self.sink.messages), 1)
+        self.assertEqual(email_queue.retried, retried + 2)
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_transient(smtplib.SMTPDataError(451, 'busy')))
+        self.assertFalse(is_transient(smtplib.SMTPDataError(550, 'no')))
+        self.assertFalse(is_transient(smtplib.SMTPRecipientsRefused({})))
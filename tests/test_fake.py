@@ -0,0 +1,37 @@
+import unittest
+from app import create_app, db
+from app.fake import Generator
+from app.models import User, Role, Post, Comment, Follow, UserCounters
+
+
+class FakeDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def counters(self):
+        return [(c.user_id, c.posts, c.followers, c.following, c.comments)
+                for c in UserCounters.query.order_by(UserCounters.user_id)]
+
+    def test_generator_keeps_counters_consistent(self):
+        Generator(seed=1, chunk_size=50, report=lambda message: None) \
+            .run(users=30, posts=100, comments=200)
+        self.assertEqual((User.query.count(), Post.query.count(), Comment.query.count()),
+                         (30, 100, 200))
+        self.assertEqual(Follow.query.filter(Follow.follower_id == Follow.followed_id).count(), 30)
+        counters = self.counters()
+        comment_counts = [p.comment_count for p in Post.query.order_by(Post.id)]
+        UserCounters.repair()
+        Post.repair_comment_counts()
+        db.session.commit()
+        self.assertEqual(self.counters(), counters)
+        self.assertEqual([p.comment_count for p in Post.query.order_by(Post.id)],
+                         comment_counts)
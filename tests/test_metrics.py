@@ -0,0 +1,77 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from app import create_app, db, metrics
+from app.models import Role
+from app.metrics import empty_snapshot
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app.config['FLASKY_METRICS_DIR'] = None
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def value(self, text, line):
+        match = re.search('^%s (\\S+)$' % re.escape(line), text, re.M)
+        self.assertIsNotNone(match, line)
+        return float(match.group(1))
+
+    def test_requests_are_counted(self):
+        self.client.get('/')
+        self.client.get('/')
+        self.client.get('/post/12345')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertEqual(self.value(text, 'flasky_http_requests_total{endpoint="main.index",method="GET",status="200"}'), 2)
+        self.assertEqual(self.value(text, 'flasky_http_requests_total{endpoint="main.post",method="GET",status="404"}'), 1)
+        self.assertEqual(self.value(text, 'flasky_http_request_duration_seconds_bucket{endpoint="main.index",le="+Inf"}'), 2)
+        self.assertEqual(self.value(text, 'flasky_http_request_duration_seconds_count{endpoint="main.index"}'), 2)
+        self.assertGreater(self.value(text, 'flasky_db_queries_total{endpoint="main.index"}'), 0)
+        # the scrape itself is in flight
+        self.assertEqual(self.value(text, 'flasky_http_requests_in_flight'), 1)
+
+    def test_token(self):
+        self.app.config['FLASKY_METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_processes_are_aggregated(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['FLASKY_METRICS_DIR'] = directory
+        other = empty_snapshot()
+        other['requests']['main.index GET 200'] = 5
+        other['in_flight'] = 3
+        other['caches']['page'] = {'hits': 2, 'misses': 1, 'evictions': 0, 'entries': 40}
+        other['email'] = {'sent': 4, 'depth': 7, 'workers': 2}
+        # a worker that has exited: its counts stay, its in-flight goes
+        with open(os.path.join(directory, 'metrics-999999999-0123abcd.json'), 'w') as f:
+            import json
+            json.dump(other, f)
+        self.client.get('/')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertEqual(self.value(text, 'flasky_http_requests_total{endpoint="main.index",method="GET",status="200"}'), 6)
+        self.assertEqual(self.value(text, 'flasky_http_requests_in_flight'), 1)
+        self.assertEqual(self.value(text, 'flasky_mail_queue_depth'), 0)
+        self.assertEqual(self.value(text, 'flasky_mail_sent_total'), 4)
+        self.assertGreaterEqual(self.value(text, 'flasky_cache_hits_total{cache="page"}'), 2)
+        self.assertLess(self.value(text, 'flasky_cache_entries{cache="page"}'), 40)
+        # folded into the archive, so the counts survive the file
+        self.assertFalse(os.path.exists(os.path.join(directory, 'metrics-999999999-0123abcd.json')))
+        self.assertTrue(os.path.exists(os.path.join(directory, 'metrics-archive.json')))
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertEqual(self.value(text, 'flasky_http_requests_total{endpoint="main.index",method="GET",status="200"}'), 6)
+        self.assertTrue(os.path.exists(os.path.join(directory, metrics.file_name())))
+        self.assertTrue(metrics.file_name().startswith('metrics-%d-' % os.getpid()))
@@ -0,0 +1,61 @@
+import unittest
+from app import create_app, db, page_cache
+from app.models import User, Role, Post, Comment
+
+
+class PageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_PAGE_CACHE_TTL'] = 60
+        page_cache.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john',
+                         password='cat', confirmed=True)
+        self.post = Post(body='first post', author=self.user)
+        db.session.add_all([self.user, self.post])
+        db.session.commit()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_anonymous_pages_are_cached(self):
+        for url in ('/', '/post/%d' % self.post.id, '/user/john'):
+            hits = page_cache.hits
+            first = self.get(url)
+            self.assertEqual(self.get(url), first)
+            self.assertEqual(page_cache.hits, hits + 1)
+
+    def test_writes_evict_tagged_pages(self):
+        self.get('/')
+        self.get('/post/%d' % self.post.id)
+        self.get('/user/john')
+        db.session.add(Comment(body='nice words', post=self.post, author=self.user))
+        db.session.commit()
+        self.assertEqual(len(page_cache), 0)
+        self.assertIn('nice words', self.get('/post/%d' % self.post.id))
+
+        self.get('/')
+        other = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add(other)
+        db.session.commit()
+        self.assertEqual(len(page_cache), 2)
+        self.post.body = 'edited post'
+        db.session.commit()
+        self.assertIn('edited post', self.get('/'))
+
+    def test_logged_in_pages_are_not_cached(self):
+        self.client.post('/auth/login', data={
+            'email': 'john@example.com', 'password': 'cat'})
+        self.get('/')
+        self.assertEqual(len(page_cache), 0)
@@ -0,0 +1,67 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Role, Post
+from app.pagination import keyset_paginate, encode_cursor, decode_cursor
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        # two posts share each timestamp so the id tie-breaker matters
+        for i in range(10):
+            db.session.add(Post(body='post %d' % i, author=u,
+                                timestamp=now - timedelta(minutes=i // 2)))
+        db.session.commit()
+        self.expected = [p.id for p in Post.query.order_by(
+            Post.timestamp.desc(), Post.id.desc()).all()]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cursor_round_trip(self):
+        ts = datetime(2018, 1, 2, 3, 4, 5, 678)
+        cursor = encode_cursor('next', ts, 42)
+        self.assertEqual(decode_cursor(cursor), ('next', ts, 42))
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+
+    def test_walk_forward_and_back(self):
+        seen = []
+        pagination = keyset_paginate(Post.query, Post, per_page=3)
+        self.assertFalse(pagination.has_prev)
+        pages = [pagination]
+        while True:
+            seen.extend(p.id for p in pagination.items)
+            if not pagination.has_next:
+                break
+            pagination = keyset_paginate(Post.query, Post,
+                                         pagination.next_cursor, per_page=3)
+            pages.append(pagination)
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(len(pages), 4)
+
+        back = keyset_paginate(Post.query, Post, pages[-1].prev_cursor,
+                               per_page=3)
+        self.assertEqual([p.id for p in back.items],
+                         [p.id for p in pages[-2].items])
+        self.assertTrue(back.has_next)
+        self.assertTrue(back.has_prev)
+
+    def test_index_page_links(self):
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 3
+        client = self.app.test_client()
+        response = client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('cursor=' in response.get_data(as_text=True))
+        response = client.get('/?page=1')
+        self.assertEqual(response.status_code, 200)
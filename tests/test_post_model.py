@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from app import create_app, db, rerender
+from app.models import User, Role, Post, Comment
+from app.rendering import render_cache, RenderCache, Policy, POST_POLICY
+from app.rerender import render_rows, rerender_table, load_checkpoint, save_checkpoint
+
+
+class PostModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def test_comment_count(self):
+        post = Post(body='body', author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(post.comment_count, 0)
+        c1 = Comment(body='one', post=post, author=self.user)
+        c2 = Comment(body='two', post=post, author=self.user)
+        db.session.add_all([c1, c2])
+        db.session.commit()
+        self.assertEqual(post.comment_count, 2)
+        db.session.delete(c1)
+        db.session.commit()
+        self.assertEqual(post.comment_count, 1)
+
+    def test_repair_comment_counts(self):
+        post = Post(body='body', author=self.user)
+        db.session.add(post)
+        db.session.add(Comment(body='one', post=post, author=self.user))
+        db.session.commit()
+        post.comment_count = 42
+        db.session.commit()
+        Post.repair_comment_counts([post.id])
+        db.session.commit()
+        self.assertEqual(post.comment_count, 1)
+
+    def test_render_cache(self):
+        render_cache.clear()
+        hits = render_cache.hits
+        p1 = Post(body='*same* body', author=self.user)
+        p2 = Post(body='*same* body', author=self.user)
+        self.assertEqual(p1.body_html, '<p><em>same</em> body</p>')
+        self.assertEqual(p2.body_html, p1.body_html)
+        self.assertEqual(render_cache.hits, hits + 1)
+        bumped = Policy('post', POST_POLICY.version + 1, POST_POLICY.tags)
+        self.assertNotEqual(RenderCache.key(bumped, 'x'),
+                            RenderCache.key(POST_POLICY, 'x'))
+
+    def test_render_cache_eviction(self):
+        cache = RenderCache(max_bytes=10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        cache.get('a')
+        cache.set('c', '12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), '12345')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_render_rows_returns_changed_rows(self):
+        changed = render_rows(('post', [(1, '*a*', 'stale'),
+                                        (2, 'b', '<p>b</p>')]))
+        self.assertEqual(changed, [(1, '*a*', '<p><em>a</em></p>')])
+
+    def stale_posts(self, count):
+        posts = [Post(body='*post %d*' % i, author=self.user) for i in range(count)]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.execute(Post.__table__.update().values(body_html='stale'))
+        db.session.commit()
+        return posts
+
+    def body_html(self):
+        return [html for (html, ) in db.session.query(Post.body_html).order_by(Post.id)]
+
+    def test_rerender_dry_run_writes_nothing(self):
+        self.stale_posts(3)
+        path = os.path.join(self.directory, 'checkpoint.json')
+        with mock.patch.object(db.session, 'commit') as commit:
+            scanned, updated = rerender_table('posts', chunk_size=2, workers=1, dry_run=True,
+                                              checkpoint_path=path, report=lambda message: None)
+        self.assertEqual((scanned, updated), (3, 3))
+        self.assertFalse(commit.called)
+        self.assertFalse(os.path.exists(path))
+        db.session.rollback()
+        self.assertEqual(self.body_html(), ['stale'] * 3)
+
+    def test_rerender_resumes_from_checkpoint(self):
+        posts = self.stale_posts(3)
+        path = os.path.join(self.directory, 'checkpoint.json')
+        save_checkpoint(path, {'posts': posts[0].id})
+        start = load_checkpoint(path)['posts']
+        scanned, updated = rerender_table('posts', chunk_size=1, workers=1, start_id=start,
+                                          checkpoint_path=path, report=lambda message: None)
+        self.assertEqual((scanned, updated), (2, 2))
+        self.assertEqual(self.body_html(), ['stale', '<p><em>post 1</em></p>', '<p><em>post 2</em></p>'])
+        self.assertEqual(load_checkpoint(path), {'posts': posts[2].id})
+
+    def test_rerender_leaves_concurrent_edits_alone(self):
+        posts = self.stale_posts(2)
+        fetch_chunk = rerender.fetch_chunk
+
+        def fetch_then_edit(table, after_id, chunk_size):
+            if after_id == posts[0].id:
+                # committed while the first chunk is being rendered
+                db.session.execute(Post.__table__.update().where(Post.id == posts[0].id)
+                                   .values(body='edited', body_html='<p>edited</p>'))
+            return fetch_chunk(table, after_id, chunk_size)
+
+        with mock.patch.object(rerender, 'fetch_chunk', fetch_then_edit):
+            scanned, updated = rerender_table('posts', chunk_size=1, workers=1,
+                                              report=lambda message: None)
+        self.assertEqual((scanned, updated), (2, 1))
+        self.assertEqual(self.body_html(), ['<p>edited</p>', '<p><em>post 1</em></p>'])
@@ -0,0 +1,69 @@
+import json
+import unittest
+from app import create_app, db, query_profiler
+from app.models import User, Role, Post
+from app.profiler import fingerprint
+
+
+class QueryProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_QUERY_SAMPLE_RATE'] = 1.0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT *  FROM posts\nWHERE id IN (%s, %s, %s) AND body = 'it''s' LIMIT 20"),
+            'SELECT * FROM posts WHERE id IN (...) AND body = ? LIMIT ?')
+        self.assertEqual(fingerprint('SELECT anon_1.id FROM t WHERE x = :x_1'),
+                         'SELECT anon_1.id FROM t WHERE x = ?')
+        self.assertEqual(fingerprint('SELECT * FROM t WHERE id IN (?, ?)'),
+                         fingerprint('SELECT * FROM t WHERE id IN (?)'))
+
+    def test_sampled_requests_are_aggregated(self):
+        self.client.get('/')
+        self.client.get('/')
+        report = query_profiler.report()
+        self.assertEqual(report['sampled_requests'], 2)
+        rows = [row for row in report['queries'] if row['endpoint'] == 'main.index']
+        self.assertTrue(rows)
+        self.assertTrue(all(row['count'] % 2 == 0 for row in rows))
+
+        query_profiler.reset()
+        self.app.config['FLASKY_QUERY_SAMPLE_RATE'] = 0
+        self.client.get('/')
+        self.assertEqual(query_profiler.report()['sampled_requests'], 0)
+
+    def test_admin_report(self):
+        admin = User(email=self.app.config['FLASKY_ADMIN'], username='admin',
+                     password='cat', confirmed=True)
+        db.session.add(admin)
+        db.session.commit()
+        response = self.client.get('/admin/queries.json')
+        self.assertEqual(response.status_code, 302)
+        self.client.post('/auth/login', data={
+            'email': admin.email, 'password': 'cat'})
+        response = self.client.get('/admin/queries.json')
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.get_data(as_text=True))
+        self.assertTrue(report['sampled_requests'] > 0)
+        response = self.client.get('/admin/queries')
+        self.assertEqual(response.status_code, 200)
+
+        # only a form POST resets, so prefetched links cannot; sampling is
+        # off so these requests do not count themselves
+        self.app.config['FLASKY_QUERY_SAMPLE_RATE'] = 0
+        self.assertEqual(self.client.get('/admin/queries/reset').status_code, 405)
+        self.assertTrue(query_profiler.report()['sampled_requests'] > 0)
+        response = self.client.post('/admin/queries/reset')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(query_profiler.report()['sampled_requests'], 0)
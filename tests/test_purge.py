@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+from datetime import timedelta
+from app import create_app, db, timeline
+from app.models import User, Role, Post, Comment, Follow, TimelineEntry, \
+    UserCounters, PurgeJob
+from app.purge import request_purge, run_pending, purge_worker
+
+
+class PurgeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_PURGE_CHUNK_SIZE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john', password='cat')
+        self.susan = User(email='susan@example.org', username='susan', password='dog')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.susan.follow(self.john)
+        self.john.follow(self.susan)
+        db.session.commit()
+        for i in range(5):
+            post = Post(body='post %d' % i, author=self.john)
+            db.session.add(post)
+            db.session.flush()
+            timeline.push_post(post)
+            db.session.add(Comment(body='nice', post=post, author=self.susan))
+        susans = Post(body='hello', author=self.susan)
+        db.session.add(susans)
+        db.session.add_all([Comment(body='hi', post=susans, author=self.john)
+                            for i in range(3)])
+        db.session.commit()
+        self.susans = susans
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_purge_user(self):
+        john_id = self.john.id
+        job = request_purge('user', self.john, self.susan)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.deleted, 5 + 5 + 3 + 3 + 1)
+        self.assertIsNone(User.query.get(john_id))
+        self.assertEqual(Post.query.filter_by(author_id=john_id).count(), 0)
+        self.assertEqual(Comment.query.count(), 0)
+        self.assertEqual(Follow.query.count(), 1)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        self.assertIsNone(UserCounters.query.get(john_id))
+        db.session.expire_all()
+        self.assertEqual((self.susan.counts.followers, self.susan.counts.following,
+                          self.susan.counts.comments), (1, 1, 0))
+        self.assertEqual(self.susans.comment_count, 0)
+
+    def test_purge_posts_hides_then_deletes(self):
+        with mock.patch.object(purge_worker, 'wake'):
+            job = request_purge('posts', self.john, self.john)
+        self.assertEqual(job.state, 'pending')
+        # hidden by the request, deleted by the worker
+        self.assertTrue(all(p.deleted for p in self.john.posts))
+        later = Post(body='written after the request', author=self.john,
+                     timestamp=job.created_at + timedelta(seconds=1))
+        db.session.add(later)
+        db.session.commit()
+        self.assertEqual(run_pending(), 1)
+        db.session.expire_all()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(self.john.posts.all(), [later])
+        self.assertEqual(self.john.counts.posts, 1)
+        self.assertEqual(self.susan.counts.comments, 0)
+        self.assertEqual(self.susans.comments.count(), 3)
+
+    def test_hidden_rows_do_not_shorten_pages(self):
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 2
+        Post.query.filter_by(author_id=self.john.id).update({'deleted': True})
+        db.session.commit()
+        with self.app.test_request_context():
+            from app.pagination import keyset_paginate
+            page = keyset_paginate(Post.query.filter(Post.visible()), Post, per_page=2)
+        self.assertEqual(page.items, [self.susans])
+        self.assertFalse(page.has_next)
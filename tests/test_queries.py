@@ -0,0 +1,85 @@
+import unittest
+from sqlalchemy import event
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+
+
+class QueryCountTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.record)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def add_users(self, count):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat') for i in range(count)]
+        db.session.add_all(users)
+        db.session.commit()
+        return users
+
+    def count_queries(self, url):
+        db.session.remove()
+        del self.statements[:]
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(self.statements)
+
+    def identity_queries(self):
+        return [s for s in self.statements
+                if s.startswith('SELECT') and 'WHERE users.id =' in s]
+
+    def test_logged_in_user_is_cached(self):
+        user = User(email='john@example.com', username='john',
+                    password='cat', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        self.client.post('/auth/login', data={
+            'email': 'john@example.com', 'password': 'cat'})
+        self.count_queries('/')
+        self.assertEqual(len(self.identity_queries()), 1)
+        self.count_queries('/')
+        self.assertEqual(self.identity_queries(), [])
+        response = self.client.post('/edit-profile', data={
+            'name': 'John', 'location': '', 'about_me': ''})
+        self.assertEqual(response.status_code, 302)
+        self.count_queries('/')
+        self.assertEqual(len(self.identity_queries()), 1)
+
+    def test_index_loads_authors_in_one_query(self):
+        users = self.add_users(12)
+        for user in users[:2]:
+            db.session.add(Post(body='post', author=user))
+        db.session.commit()
+        few = self.count_queries('/')
+        for user in users[2:]:
+            db.session.add(Post(body='post', author=user))
+        db.session.commit()
+        self.assertEqual(self.count_queries('/'), few)
+
+    def test_post_comments_load_authors_in_one_query(self):
+        users = self.add_users(12)
+        post = Post(body='post', author=users[0])
+        db.session.add(post)
+        db.session.add_all([Comment(body='comment', post=post, author=user)
+                            for user in users[:2]])
+        db.session.commit()
+        url = '/post/%d' % post.id
+        few = self.count_queries(url)
+        db.session.add_all([Comment(body='comment', post_id=post.id, author=user)
+                            for user in users[2:]])
+        db.session.commit()
+        self.assertEqual(self.count_queries(url), few)
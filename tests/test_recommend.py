@@ -0,0 +1,70 @@
+import json
+import unittest
+from base64 import b64encode
+from app import create_app, db
+from app.models import User, Role, Recommendation, RecommendationQueue
+from app.recommend import FollowGraph, refresh
+
+
+class RecommendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.users = dict((name, User(email='%s@example.com' % name, username=name,
+                                      password='cat', confirmed=True))
+                          for name in 'abcdef')
+        db.session.add_all(self.users.values())
+        db.session.commit()
+        a, b, c, d, e, f = [self.users[name] for name in 'abcdef']
+        for follower, followed in ((a, b), (a, e), (b, c), (b, d), (e, c), (f, a)):
+            follower.follow(followed)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def names(self, user):
+        return [candidate.username for candidate in user.recommended(10)]
+
+    def test_graph(self):
+        graph = FollowGraph.load(chunk_size=2)
+        a, b = graph.index[self.users['a'].id], graph.index[self.users['b'].id]
+        self.assertEqual(sorted(graph.ids[j] for j in graph.neighbours(a)),
+                         sorted([self.users['b'].id, self.users['e'].id]))
+        followers = graph.transpose()
+        self.assertEqual([graph.ids[j] for j in followers.neighbours(a)], [self.users['f'].id])
+        self.assertEqual([graph.ids[j] for j in followers.neighbours(b)], [self.users['a'].id])
+        scores = dict((graph.ids[w], score) for w, score in graph.recommend(a, 10, 1000, followers))
+        self.assertEqual(scores, {self.users['c'].id: 2, self.users['d'].id: 1})
+
+    def test_refresh(self):
+        self.assertEqual(refresh(full=True, report=lambda message: None), 6)
+        self.assertEqual(self.names(self.users['a']), ['c', 'd'])
+        self.assertEqual(self.names(self.users['f']), ['b', 'e'])
+        self.assertEqual(RecommendationQueue.query.count(), 0)
+        self.assertEqual(refresh(report=lambda message: None), 0)
+
+        # followed since the last run: hidden right away
+        self.users['a'].follow(self.users['c'])
+        db.session.commit()
+        self.assertEqual(self.names(self.users['a']), ['d'])
+
+        # only a and its follower f are recomputed; c now leads on followers
+        self.assertEqual(refresh(report=lambda message: None), 2)
+        self.assertEqual(self.names(self.users['f']), ['c', 'b', 'e'])
+        self.assertEqual(self.names(self.users['a']), ['d'])
+
+    def test_api(self):
+        refresh(full=True, report=lambda message: None)
+        credentials = b64encode(b'a@example.com:cat').decode('utf-8')
+        response = self.app.test_client().get(
+            '/api/v1.0/users/%d/recommendations' % self.users['a'].id,
+            headers={'Authorization': 'Basic ' + credentials})
+        self.assertEqual(response.status_code, 200)
+        recommendations = json.loads(response.get_data(as_text=True))['recommendations']
+        self.assertEqual([user['username'] for user in recommendations], ['c', 'd'])
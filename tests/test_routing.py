@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+from app import create_app, db
+from app.models import User, Role
+
+
+class RoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        replica = 'sqlite:///' + os.path.join(self.directory, 'replica.sqlite')
+        self.app = create_app('testing', replicas=[replica])
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        db.session.add(User(email='john@example.com', username='john',
+                            password='cat', confirmed=True, about_me='primary'))
+        db.session.commit()
+        # a lagging copy of the primary
+        self.replica = db.get_engine(self.app, bind='replica_0')
+        db.metadata.create_all(self.replica)
+        for table in (Role.__table__, User.__table__):
+            rows = [dict(row) for row in db.engine.execute(table.select())]
+            self.replica.execute(table.insert(), rows)
+        self.replica.execute(User.__table__.update().values(about_me='replica'))
+        db.session.remove()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.replica.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def about_me(self):
+        # a column query, so the identity map cannot answer it
+        return db.session.query(User.about_me).filter_by(username='john').scalar()
+
+    def profile(self):
+        # requests share the test's app context, and so its session
+        db.session.remove()
+        return self.client.get('/user/john').get_data(as_text=True)
+
+    def test_reads_in_get_requests_use_the_replica(self):
+        with self.app.test_request_context('/', method='GET'):
+            self.assertEqual(self.about_me(), 'replica')
+        db.session.remove()
+        with self.app.test_request_context('/', method='POST'):
+            self.assertEqual(self.about_me(), 'primary')
+        db.session.remove()
+        self.assertEqual(self.about_me(), 'primary')
+
+    def test_forced_routing(self):
+        with self.app.test_request_context('/', method='GET'):
+            with db.using_primary():
+                self.assertEqual(self.about_me(), 'primary')
+        db.session.remove()
+        with db.using_replica():
+            self.assertEqual(self.about_me(), 'replica')
+
+    def test_reads_after_a_write_use_the_primary(self):
+        with self.app.test_request_context('/', method='GET'):
+            user = User.query.filter_by(username='john').one()
+            user.location = 'Paris'
+            db.session.flush()
+            self.assertEqual(self.about_me(), 'primary')
+
+    def test_clients_read_their_own_writes(self):
+        self.assertIn('replica', self.profile())
+        response = self.client.post('/auth/login', data={
+            'email': 'john@example.com', 'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.post('/edit-profile', data={
+            'name': '', 'location': '', 'about_me': 'edited'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('edited', self.profile())
+        self.client.get('/auth/logout')
+        self.assertIn('edited', self.profile())
+        with self.client.session_transaction() as session:
+            session['_db_primary_until'] = 0
+        self.assertIn('replica', self.profile())
+
+    def test_api_clients_read_their_own_writes(self):
+        headers = {
+            'Authorization': 'Basic ' + b64encode(b'john@example.com:cat').decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'}
+        # like curl: no cookie jar, and the marker is not in worker memory
+        client = self.app.test_client(use_cookies=False)
+        db.session.remove()
+        response = client.post('/api/v1.0/posts/', headers=headers,
+                               data=json.dumps({'body': 'hello'}))
+        self.assertEqual(response.status_code, 201)
+        url = response.headers['Location']
+        db.session.remove()
+        self.assertEqual(client.get(url, headers=headers).status_code, 200)
+        db.session.execute(User.__table__.update().values(last_write_at=None))
+        db.session.commit()
+        db.session.remove()
+        # the lagging replica has no such post
+        self.assertEqual(client.get(url, headers=headers).status_code, 404)
+
+    def test_pool_checkouts_are_counted(self):
+        with self.app.test_request_context('/', method='GET'):
+            self.about_me()
+        stats = db.pool_stats()
+        self.assertTrue(any(name.endswith('replica.sqlite') and pool['checkouts'] > 0
+                            for name, pool in stats.items()))
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('flasky_db_pool_checkouts_total{engine="', metrics)
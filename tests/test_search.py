@@ -0,0 +1,91 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment, SearchDocument
+from app.search import tokenize, search, reindex
+
+
+class SearchTestCase(unittest.TestCase):
+    backend = 'builtin'
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_SEARCH_BACKEND'] = self.backend
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        if self.backend == 'sqlite':
+            if db.engine.dialect.name != 'sqlite':
+                self.skipTest('needs SQLite')
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def found(self, query, **kwargs):
+        return [item for score, item in search(query, **kwargs).items]
+
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize('<p>Hello, <b>Flask</b> 全文搜索</p>')),
+                         ['hello', 'flask', '全文', '文搜', '搜索'])
+
+    def test_index_follows_edits(self):
+        flask = Post(body='flask and *sqlalchemy*', author=self.user)
+        other = Post(body='nothing to see', author=self.user)
+        db.session.add_all([flask, other])
+        db.session.commit()
+        comment = Comment(body='more flask please', post=other, author=self.user)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(set(self.found('Flask')), {flask, comment})
+        self.assertEqual(self.found('中文'), [])
+        flask.body = '全文搜索'
+        db.session.commit()
+        self.assertEqual(self.found('flask'), [comment])
+        self.assertEqual(self.found('搜索'), [flask])
+        db.session.delete(comment)
+        db.session.commit()
+        self.assertEqual(self.found('flask'), [])
+        self.assertEqual(SearchDocument.query.count(), 2)
+
+    def test_ranking_and_cursor(self):
+        posts = [Post(body=' '.join(['flask'] * (i + 1) + ['filler'] * 5), author=self.user)
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        first = search('flask', per_page=2)
+        self.assertEqual([item for score, item in first.items], [posts[4], posts[3]])
+        second = search('flask', first.next_cursor, per_page=2)
+        third = search('flask', second.next_cursor, per_page=2)
+        self.assertEqual([item for score, item in second.items + third.items],
+                         [posts[2], posts[1], posts[0]])
+        self.assertFalse(third.has_next)
+
+    def test_hidden_rows_do_not_shorten_pages(self):
+        posts = [Post(body=' '.join(['flask'] * (i + 1)), author=self.user) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        posts[3].deleted = True
+        posts[2].disabled = True
+        db.session.commit()
+        first = search('flask', per_page=1)
+        self.assertEqual([item for score, item in first.items], [posts[1]])
+        second = search('flask', first.next_cursor, per_page=1)
+        self.assertEqual([item for score, item in second.items], [posts[0]])
+        self.assertFalse(second.has_next)
+
+    def test_reindex(self):
+        db.session.add(Post(body='flask', author=self.user))
+        db.session.commit()
+        db.session.execute(SearchDocument.__table__.delete())
+        db.session.commit()
+        self.assertEqual(reindex(report=lambda message: None), 1)
+        self.assertEqual(len(self.found('flask')), 1)
+
+
+class SQLiteSearchTestCase(SearchTestCase):
+    backend = 'sqlite'
@@ -0,0 +1,88 @@
+import unittest
+from app import create_app, db, timeline
+from app.models import User, Role, Post, TimelineEntry
+
+
+class TimelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john', password='cat')
+        self.susan = User(email='susan@example.org', username='susan', password='dog')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def publish(self, author, body):
+        post = Post(body=body, author=author)
+        db.session.add(post)
+        db.session.flush()
+        timeline.push_post(post)
+        db.session.commit()
+        return post
+
+    def test_fan_out_and_unfollow(self):
+        self.susan.follow(self.john)
+        db.session.commit()
+        post = self.publish(self.john, 'hello')
+        page = timeline.timeline_paginate(self.susan)
+        self.assertEqual(page.items, [post])
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=post.id).count(), 2)
+        self.susan.unfollow(self.john)
+        timeline.remove_author(self.susan, self.john)
+        db.session.commit()
+        self.assertEqual(timeline.timeline_paginate(self.susan).items, [])
+
+    def test_backfill_and_trim(self):
+        self.app.config['FLASKY_TIMELINE_LENGTH'] = 2
+        posts = [self.publish(self.john, 'post %d' % i) for i in range(3)]
+        self.susan.follow(self.john)
+        timeline.backfill(self.susan, self.john)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.susan.id).count(), 2)
+        # the third, trimmed post is still reachable through the fallback
+        page = timeline.timeline_paginate(self.susan, per_page=2)
+        page = timeline.timeline_paginate(self.susan, page.next_cursor, per_page=2)
+        self.assertEqual(page.items, [posts[0]])
+
+    def test_celebrity_posts_are_pulled(self):
+        self.app.config['FLASKY_TIMELINE_FANOUT_LIMIT'] = 1
+        self.susan.follow(self.john)
+        db.session.commit()
+        post = self.publish(self.john, 'hello fans')
+        self.assertTrue(self.john.celebrity)
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=post.id).count(), 0)
+        own = self.publish(self.susan, 'my own post')
+        page = timeline.timeline_paginate(self.susan)
+        self.assertEqual([p.id for p in page.items], [own.id, post.id])
+        db.session.delete(own)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_trim_overflowing(self):
+        self.app.config['FLASKY_TIMELINE_LENGTH'] = 2
+        self.susan.follow(self.john)
+        db.session.commit()
+        posts = [self.publish(self.john, 'post %d' % i) for i in range(3)]
+        # publishing only inserts; the periodic job trims
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.susan.id).count(), 3)
+        self.assertEqual(timeline.trim_overflowing(report=lambda message: None), 2)
+        entries = TimelineEntry.query.filter_by(user_id=self.susan.id) \
+                .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()).all()
+        self.assertEqual([e.post_id for e in entries], [posts[2].id, posts[1].id])
+
+    def test_rebuild_with_unset_celebrity(self):
+        self.susan.follow(self.john)
+        db.session.commit()
+        post = self.publish(self.john, 'hello')
+        db.session.execute(User.__table__.update().values(celebrity=None))
+        timeline.rebuild(self.susan)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.susan.id, post_id=post.id).count(), 1)
@@ -1,8 +1,10 @@
 import unittest
 import time
 from datetime import datetime
-from app import create_app, db
-from app.models import User, AnonymousUser, Role, Permission, Follow
+from app import create_app, db, last_seen_buffer, token_cache
+from app.models import User, AnonymousUser, Role, Permission, Follow, \
+    Post, Comment, UserCounters
+from app.user_import import import_users
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -139,6 +141,32 @@ class UserModelTestCase(unittest.TestCase):
         self.assertFalse(u.can(Permission.MODERATE))
         self.assertFalse(u.can(Permission.ADMIN))
 
+    def test_construction_is_side_effect_free(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        self.assertNotIn(u, db.session)
+        self.assertIsNone(u.role)
+        self.assertEqual(User.query.count(), 0)
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.role, Role.query.filter_by(default=True).first())
+        self.assertTrue(u.is_following(u))
+        self.assertEqual(u.counts.followers, 1)
+
+    def test_import_users(self):
+        db.session.add(User(email='susan@example.com', username='susan', password='dog'))
+        db.session.commit()
+        rows = [{'email': 'user%d@example.com' % i, 'username': 'user%d' % i,
+                 'password': 'cat', 'confirmed': 'true'} for i in range(5)]
+        rows.append({'email': 'susan@example.com', 'username': 'other', 'password': 'x'})
+        rows.append({'email': 'user0@example.com', 'username': 'again', 'password': 'x'})
+        rows.append({'email': 'nobody@example.com', 'username': 'nobody'})
+        created, skipped = import_users(rows, batch_size=3, report=lambda message: None)
+        self.assertEqual((created, skipped), (5, 3))
+        u = User.query.filter_by(username='user4').first()
+        self.assertTrue(u.confirmed)
+        self.assertTrue(u.verify_password('cat'))
+        self.assertTrue(u.is_following(u))
+
     def test_timestamps(self):
         u = User(password='cat')
         db.session.add(u)
@@ -157,6 +185,49 @@ class UserModelTestCase(unittest.TestCase):
         u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
 
+    def test_ping_is_buffered(self):
+        self.app.config['FLASKY_LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        self.app.config['FLASKY_LAST_SEEN_THRESHOLD'] = 60
+        u = User(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        u.last_seen = datetime(2000, 1, 1)
+        db.session.commit()
+        u.ping()
+        u.ping()
+        self.assertFalse(u in db.session.dirty)
+        self.assertEqual(list(last_seen_buffer.pending), [u.id])
+        self.assertEqual(last_seen_buffer.flush(), 1)
+        db.session.expire(u)
+        self.assertTrue(
+            (datetime.utcnow() - u.last_seen).total_seconds() < 3)
+
+    def test_auth_token_cache(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        token = u.generate_auth_token(3600)
+        self.assertEqual(User.verify_auth_token(token), u)
+        db.session.remove()
+        statements = []
+        def count(*args):
+            statements.append(args)
+        engine = db.get_engine(self.app)
+        db.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            cached = User.verify_auth_token(token)
+            self.assertEqual(cached.email, 'john@example.com')
+            self.assertTrue(cached.can(Permission.WRITE))
+        finally:
+            db.event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+        cached.disabled = True
+        db.session.commit()
+        self.assertEqual(len(token_cache), 0)
+        self.assertTrue(User.verify_auth_token(token).disabled)
+        self.assertEqual(len(token_cache), 0)
+        self.assertIsNone(User.verify_auth_token(token + b'x'))
+
     def test_gravatar(self):
         u = User(email='john@example.com', password='cat')
         with self.app.test_request_context('/'):
@@ -207,6 +278,58 @@ class UserModelTestCase(unittest.TestCase):
         db.session.commit()
         self.assertTrue(Follow.query.count() == 1)
 
+    def test_following_state(self):
+        u = User(email='john@example.com', password='cat')
+        others = [User(email='user%d@example.com' % i, password='cat')
+                  for i in range(5)]
+        db.session.add_all([u] + others)
+        db.session.commit()
+        u.follow(others[0])
+        u.follow(others[3])
+        db.session.commit()
+        ids = [u.id] + [o.id for o in others]  # reload the expired objects
+        statements = []
+        def count(*args):
+            statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            state = u.following_state(others)
+            self.assertEqual(state, dict((o.id, o in (others[0], others[3]))
+                                         for o in others))
+            self.assertEqual(len(statements), 1)
+            self.assertTrue(u.is_following(others[3]))
+            self.assertFalse(u.is_following(others[4]))
+            self.assertEqual(len(statements), 1)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        u.unfollow(others[3])
+        db.session.commit()
+        self.assertFalse(u.is_following(others[3]))
+
+    def test_counters(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        post = Post(body='body', author=u2)
+        db.session.add_all([post, Comment(body='nice', post=post, author=u1)])
+        db.session.commit()
+        self.assertEqual((u1.counts.following, u1.counts.followers,
+                          u1.counts.comments, u1.counts.posts), (2, 1, 1, 0))
+        self.assertEqual((u2.counts.following, u2.counts.followers,
+                          u2.counts.comments, u2.counts.posts), (1, 2, 0, 1))
+        u1.unfollow(u2)
+        db.session.delete(post.comments.first())
+        db.session.commit()
+        self.assertEqual(u1.counts.comments, 0)
+        self.assertEqual(u2.counts.followers, 1)
+        u2.counters.posts = 7
+        db.session.commit()
+        UserCounters.repair([u2.id])
+        db.session.commit()
+        self.assertEqual(u2.counts.posts, 1)
+
     def test_to_json(self):
         u = User(email='john@example.com', password='cat')
         db.session.add(u)